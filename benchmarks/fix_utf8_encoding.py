@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmark of modoboa_amavis.utils.fix_utf8_encoding.
+
+Simulates the listing hot loop (SQLconnector.fetch calls
+fix_utf8_encoding on the sender and the subject of every row) and
+compares the current implementation with the previous one.
+
+Usage: python benchmarks/fix_utf8_encoding.py
+"""
+
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import timeit
+
+import chardet
+
+from django.conf import settings
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+settings.configure(AMAVIS_DEFAULT_DATABASE_ENCODING="LATIN1")
+
+from modoboa_amavis import utils  # NOQA:E402
+
+ROWS = 100
+REPEAT = 20
+
+
+def previous_fix_utf8_encoding(value):
+    """Implementation without fast path nor memoization."""
+    if len(value) == 0:
+        return ""
+    bytes_value = value.encode("raw_unicode_escape")
+    try:
+        value = bytes_value.decode("utf-8")
+    except UnicodeDecodeError:
+        encoding = chardet.detect(bytes_value)
+        try:
+            value = bytes_value.decode(encoding["encoding"], "replace")
+        except (TypeError, UnicodeDecodeError):
+            pass
+    return value
+
+
+def get_page():
+    """Return the values of a listing page.
+
+    Most values are ASCII, some contain escaped utf-8 and a spam
+    campaign repeats a few badly encoded subjects.
+    """
+    values = []
+    for i in range(ROWS):
+        values.append("sender{}@example.com".format(i))
+        if i % 4 == 0:
+            values.append("Caf\xe9 \xe0 prix r\xe9duit, offre n\xb0{}".format(
+                i % 3))
+        elif i % 4 == 1:
+            values.append("\xf0\x9f\x99\x88 Hello")
+        else:
+            values.append("Meeting report #{}".format(i))
+    return values
+
+
+def main():
+    values = get_page()
+    for name, func in [("previous", previous_fix_utf8_encoding),
+                       ("current", utils.fix_utf8_encoding)]:
+        timer = timeit.Timer(lambda: [func(value) for value in values])
+        best = min(timer.repeat(repeat=REPEAT, number=1))
+        print("{:>8}: {:8.1f} us/row".format(name, best * 1e6 / ROWS))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""Message body inverted index.
+
+The qbodyindex command streams quarantined messages, extracts the text
+of their text/* parts and stores one (token, mail_id) row per distinct
+word into the BodyToken table. Indexed messages are recorded into the
+IndexedMessage table, which provides the (time_num, mail_id) watermark
+used to find new messages (see modoboa_amavis.summary for the overlap
+window).
+
+A body search returns the messages containing every word of the
+pattern.
+"""
+
+from __future__ import unicode_literals
+
+import re
+
+from html2text import HTML2Text
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Q
+
+from . import summary
+from .models import BodyToken, IndexedMessage, Msgs, Quarantine
+from .utils import smart_bytes, smart_text
+
+try:
+    from email.feedparser import BytesFeedParser as FeedParser
+except ImportError:  # Python 2
+    from email.feedparser import FeedParser
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 64
+
+# Number of rows inserted by a single query
+BULK_SIZE = 1000
+
+
+def is_enabled():
+    """Tell if body searches are available."""
+    return getattr(settings, "AMAVIS_BODY_INDEX", False)
+
+
+def tokenize(text):
+    """Return the set of (lowercased) words found in text.
+
+    Long words are truncated so they still match.
+    """
+    return set(
+        token[:MAX_TOKEN_LENGTH] for token in TOKEN_RE.findall(text.lower())
+        if len(token) >= MIN_TOKEN_LENGTH
+    )
+
+
+def _decode_part(part):
+    """Return the content of a text part, as text."""
+    payload = part.get_payload(decode=True)
+    if not payload:
+        return ""
+    charset = part.get_content_charset() or "us-ascii"
+    try:
+        text = payload.decode(charset, "replace")
+    except LookupError:
+        text = payload.decode("utf-8", "replace")
+    if part.get_content_subtype() == "html":
+        h = HTML2Text()
+        h.ignore_images = True
+        text = h.handle(text)
+    return text
+
+
+def extract_text(chunks, max_size=None):
+    """Extract the text parts of a message.
+
+    Chunks are fed to the parser until max_size bytes have been read
+    (see AMAVIS_BODY_INDEX_MAX_SIZE). Attachments are ignored.
+
+    :param chunks: an iterable of raw chunks
+    :return: a list of strings
+    """
+    if max_size is None:
+        max_size = getattr(
+            settings, "AMAVIS_BODY_INDEX_MAX_SIZE", 1024 * 1024)
+    parser = FeedParser()
+    size = 0
+    for chunk in chunks:
+        chunk = smart_bytes(chunk)
+        parser.feed(chunk)
+        size += len(chunk)
+        if size >= max_size:
+            break
+    msg = parser.close()
+    result = []
+    for part in msg.walk():
+        if part.get_content_maintype() != "text":
+            continue
+        if part.get("Content-Disposition", "").strip().lower().startswith(
+                "attachment"):
+            continue
+        text = _decode_part(part)
+        if text:
+            result.append(text)
+    return result
+
+
+def _index_messages(connector, rows):
+    """Index a batch of messages.
+
+    :param list rows: list of (mail_id, time_num) tuples
+    :return: the number of indexed messages
+    """
+    mail_ids = [smart_text(mail_id) for mail_id, time_num in rows]
+    existing = set(IndexedMessage.objects.filter(
+        mail_id__in=mail_ids).values_list("mail_id", flat=True))
+    tokens = []
+    messages = []
+    for mail_id, time_num in rows:
+        mail_id = smart_text(mail_id)
+        if mail_id in existing:
+            continue
+        words = set()
+        for text in extract_text(connector.iter_mail_chunks(mail_id)):
+            words |= tokenize(text)
+        tokens += [BodyToken(token=word, mail_id=mail_id) for word in words]
+        messages.append(IndexedMessage(mail_id=mail_id, time_num=time_num))
+    with transaction.atomic(using="amavis"):
+        BodyToken.objects.bulk_create(tokens, batch_size=BULK_SIZE)
+        IndexedMessage.objects.bulk_create(messages, batch_size=BULK_SIZE)
+    return len(messages)
+
+
+def sync(batch_size=50, full=False):
+    """Index the bodies of new quarantined messages.
+
+    :param int batch_size: number of messages per transaction
+    :param bool full: rebuild the index from scratch
+    :return: the number of indexed messages
+    """
+    from .sql_connector import SQLconnector
+
+    if full:
+        BodyToken.objects.all().delete()
+        IndexedMessage.objects.all().delete()
+    qset = Msgs.objects.filter(
+        mail_id__in=Quarantine.objects.filter(chunk_ind=1).values("mail_id"))
+    watermark = IndexedMessage.objects.aggregate(
+        time_num=Max("time_num"))["time_num"]
+    if watermark is not None:
+        qset = qset.filter(time_num__gte=watermark - summary.get_overlap())
+    qset = qset.values_list("mail_id", "time_num").order_by(
+        "time_num", "mail_id")
+    connector = SQLconnector()
+    result = 0
+    last = None
+    while True:
+        batch = qset
+        if last is not None:
+            batch = batch.filter(
+                Q(time_num__gt=last[1]) |
+                Q(time_num=last[1], mail_id__gt=last[0])
+            )
+        rows = list(batch[:batch_size])
+        if not rows:
+            break
+        result += _index_messages(connector, rows)
+        last = rows[-1]
+        if len(rows) < batch_size:
+            break
+    return result
+
+
+def delete_messages(mail_ids):
+    """Remove deleted messages from the index."""
+    mail_ids = [smart_text(mail_id) for mail_id in mail_ids]
+    for pos in range(0, len(mail_ids), BULK_SIZE):
+        batch = mail_ids[pos:pos + BULK_SIZE]
+        BodyToken.objects.filter(mail_id__in=batch).delete()
+        IndexedMessage.objects.filter(mail_id__in=batch).delete()
+
+
+def delete_older_than(time_num):
+    """Remove messages received before time_num from the index."""
+    qset = IndexedMessage.objects.filter(time_num__lt=time_num)
+    BodyToken.objects.filter(
+        mail_id__in=qset.values("mail_id")).delete()
+    qset.delete()
+
+
+def get_matching_mail_ids(pattern):
+    """Return a queryset of the messages containing every word of pattern.
+
+    The result is meant to be used as a subquery.
+    """
+    tokens = tokenize(pattern)
+    if not tokens:
+        return BodyToken.objects.none().values("mail_id")
+    return (
+        BodyToken.objects.filter(token__in=tokens)
+        .values("mail_id")
+        .annotate(matches=Count("token"))
+        .filter(matches=len(tokens))
+        .values("mail_id")
+    )
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+"""Caching tools."""
+
+from __future__ import unicode_literals
+
+import collections
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import six
+
+
+def get_cache():
+    """Return the cache used by modoboa_amavis.
+
+    The backend can be selected with the AMAVIS_CACHE setting (a key
+    of CACHES). Expiration and eviction are handled by the backend.
+    """
+    return caches[getattr(settings, "AMAVIS_CACHE", "default")]
+
+
+def get_recipient_ids_key(user_id):
+    """Return the cache key of the recipient ids of a user."""
+    return "modoboa_amavis:recipient_ids:{}".format(user_id)
+
+
+def get_user_recipient_ids(user_id):
+    """Return the cached recipient ids entry of a user.
+
+    :return: a dictionary or None
+    """
+    return get_cache().get(get_recipient_ids_key(user_id))
+
+
+def set_user_recipient_ids(user_id, entry):
+    """Store the recipient ids entry of a user."""
+    get_cache().set(
+        get_recipient_ids_key(user_id), entry,
+        getattr(settings, "AMAVIS_RECIPIENT_IDS_CACHE_TIMEOUT", 3600)
+    )
+
+
+def invalidate_user_recipient_ids(user_ids):
+    """Remove the cached recipient ids of the given users.
+
+    :param list user_ids: list of user ids
+    """
+    get_cache().delete_many(
+        [get_recipient_ids_key(user_id) for user_id in user_ids])
+
+
+class LRUCache(object):
+    """A thread-safe LRU cache kept in process memory.
+
+    The total size of stored values is bounded: least recently used
+    entries are evicted when *max_size* is exceeded.
+    """
+
+    def __init__(self, max_size):
+        """Constructor."""
+        self.max_size = max_size
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the value stored for key, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[2] < time.time():
+                self.size -= entry[1]
+                return None
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value, size, timeout):  # NOQA:A003
+        """Store a value."""
+        if size > self.max_size:
+            return
+        with self._lock:
+            self._delete(key)
+            self._entries[key] = (value, size, time.time() + timeout)
+            self.size += size
+            while self.size > self.max_size:
+                oldest_key, entry = self._entries.popitem(last=False)
+                self.size -= entry[1]
+
+    def _delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def delete_many(self, keys):
+        """Remove several keys."""
+        with self._lock:
+            for key in keys:
+                self._delete(key)
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+_rendered_messages = LRUCache(
+    getattr(settings, "AMAVIS_RENDERED_CACHE_SIZE", 8 * 1024 * 1024))
+_rendered_messages_stats = {"hits": 0, "misses": 0}
+_rendered_messages_stats_lock = threading.Lock()
+
+RENDERED_MESSAGE_FORMATS = ["plain", "plain_full", "html", "headers"]
+
+
+def _get_rendered_messages_backend():
+    """Return the Django cache storing rendered messages, if any."""
+    name = getattr(settings, "AMAVIS_RENDERED_CACHE", None)
+    if name is None:
+        return None
+    return caches[name]
+
+
+def _get_rendered_message_key(backend, mail_id, dformat):
+    key = "modoboa_amavis:rendered:{}:{}".format(mail_id, dformat)
+    if backend is not None:
+        # Keys are versioned to allow a global invalidation
+        version = backend.get_or_set(
+            "modoboa_amavis:rendered:version", 1, None)
+        key = "{}:{}".format(key, version)
+    return key
+
+
+def _get_size(value):
+    """Return the approximative size of a rendered message."""
+    if isinstance(value, six.string_types):
+        return len(value)
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_get_size(item) for item in value)
+    return 0
+
+
+def get_rendered_message(mail_id, dformat):
+    """Return a cached rendered message, or None.
+
+    :param str mail_id: message unique identifier
+    :param str dformat: display format
+    """
+    backend = _get_rendered_messages_backend()
+    key = _get_rendered_message_key(backend, mail_id, dformat)
+    if backend is not None:
+        value = backend.get(key)
+    else:
+        value = _rendered_messages.get(key)
+    with _rendered_messages_stats_lock:
+        _rendered_messages_stats["misses" if value is None else "hits"] += 1
+    return value
+
+
+def set_rendered_message(mail_id, dformat, value):
+    """Store a rendered message."""
+    timeout = getattr(settings, "AMAVIS_RENDERED_CACHE_TIMEOUT", 600)
+    backend = _get_rendered_messages_backend()
+    key = _get_rendered_message_key(backend, mail_id, dformat)
+    if backend is not None:
+        backend.set(key, value, timeout)
+    else:
+        _rendered_messages.set(key, value, _get_size(value), timeout)
+
+
+def invalidate_rendered_messages(mail_ids):
+    """Remove the rendered versions of the given messages.
+
+    :param list mail_ids: list of message unique identifiers
+    """
+    backend = _get_rendered_messages_backend()
+    keys = [
+        _get_rendered_message_key(backend, mail_id, dformat)
+        for mail_id in mail_ids for dformat in RENDERED_MESSAGE_FORMATS
+    ]
+    if backend is not None:
+        backend.delete_many(keys)
+    else:
+        _rendered_messages.delete_many(keys)
+
+
+def clear_rendered_messages():
+    """Remove every rendered message."""
+    backend = _get_rendered_messages_backend()
+    if backend is not None:
+        try:
+            backend.incr("modoboa_amavis:rendered:version")
+        except ValueError:
+            pass
+    else:
+        _rendered_messages.clear()
+
+
+def get_rendered_messages_stats():
+    """Return statistics about the rendered messages cache.
+
+    Hits and misses are counted per process.
+    """
+    result = dict(_rendered_messages_stats)
+    if _get_rendered_messages_backend() is None:
+        result.update(
+            entries=len(_rendered_messages), size=_rendered_messages.size)
+    return result
@@ -131,6 +131,16 @@ class ParametersForm(param_forms.AdminParametersForm):
         )
     )
 
+    max_listing_count = forms.IntegerField(
+        label=ugettext_lazy("Maximum counted messages"),
+        initial=0,
+        help_text=ugettext_lazy(
+            "Stop counting quarantine messages after this number when "
+            "building a listing, useful for very large quarantines "
+            "(0 means no limit)"
+        )
+    )
+
     sep1 = form_utils.SeparatorField(label=ugettext_lazy("Messages releasing"))
 
     released_msgs_cleanup = form_utils.YesNoField(
@@ -14,7 +14,7 @@ from modoboa.admin import models as admin_models, signals as admin_signals
 from modoboa.core import signals as core_signals
 from modoboa.lib import signals as lib_signals
 from modoboa.parameters import tools as param_tools
-from . import forms
+from . import cache, forms
 from .lib import (
     create_user_and_policy, create_user_and_use_policy, delete_user,
     delete_user_and_policy, update_user_and_policy
@@ -135,6 +135,47 @@ def on_mailboxalias_deleted(sender, instance, **kwargs):
     Users.objects.filter(email__in=aliases).delete()
 
 
+@receiver(signals.post_save, sender=admin_models.Mailbox)
+@receiver(signals.pre_delete, sender=admin_models.Mailbox)
+def invalidate_mailbox_recipient_ids(sender, instance, **kwargs):
+    """Invalidate the cached recipient ids of a mailbox owner."""
+    cache.invalidate_user_recipient_ids([instance.user_id])
+
+
+@receiver(signals.post_save, sender=admin_models.Alias)
+@receiver(signals.pre_delete, sender=admin_models.Alias)
+def invalidate_alias_recipient_ids(sender, instance, **kwargs):
+    """Invalidate the cached recipient ids of alias recipients."""
+    cache.invalidate_user_recipient_ids(
+        admin_models.Mailbox.objects.filter(
+            aliasrecipient__alias=instance).values_list("user_id", flat=True)
+    )
+
+
+@receiver(signals.post_save, sender=admin_models.AliasRecipient)
+@receiver(signals.pre_delete, sender=admin_models.AliasRecipient)
+def invalidate_aliasrecipient_recipient_ids(sender, instance, **kwargs):
+    """Invalidate the cached recipient ids of an alias recipient."""
+    if instance.r_mailbox_id is None:
+        return
+    cache.invalidate_user_recipient_ids(
+        admin_models.Mailbox.objects.filter(
+            pk=instance.r_mailbox_id).values_list("user_id", flat=True)
+    )
+
+
+@receiver(signals.post_save, sender=admin_models.Domain)
+@receiver(signals.pre_delete, sender=admin_models.Domain)
+def invalidate_domain_recipient_ids(sender, instance, **kwargs):
+    """Invalidate the cached recipient ids of a domain's users."""
+    if kwargs.get("created"):
+        return
+    cache.invalidate_user_recipient_ids(
+        admin_models.Mailbox.objects.filter(
+            domain=instance).values_list("user_id", flat=True)
+    )
+
+
 @receiver(core_signals.extra_static_content)
 def extra_static_content(sender, caller, st_type, user, **kwargs):
     """Send extra javascript."""
@@ -2,11 +2,15 @@
 
 from __future__ import unicode_literals
 
+import base64
+import collections
+import io
 import os
 import re
 import socket
-import string
 import struct
+import tempfile
+import threading
 from email.utils import parseaddr
 from functools import wraps
 
@@ -16,6 +20,7 @@ from django.conf import settings
 from django.contrib.auth.views import redirect_to_login
 from django.urls import reverse
 from django.utils import six
+from django.utils.six.moves import queue
 from django.utils.translation import ugettext as _
 
 from modoboa.admin import models as admin_models
@@ -27,7 +32,7 @@ from modoboa.lib.sysutils import exec_cmd
 from modoboa.lib.web_utils import NavigationParameters
 from modoboa.parameters import tools as param_tools
 from .models import Policy, Users
-from .utils import smart_bytes, smart_text
+from .utils import ChunkReader, smart_bytes, smart_text
 
 
 def selfservice(ssfunc=None):
@@ -56,43 +61,418 @@ def selfservice(ssfunc=None):
     return decorator
 
 
-class AMrelease(object):
-    def __init__(self):
+class PDPClient(object):
+    """A client for the amavis AM.PDP protocol.
+
+    Connections (inet or unix, depending on the *am_pdp_mode*
+    parameter) are kept in a per-process pool and reused by the
+    following clients. Several requests can be pipelined over a single
+    connection and each response is read until its terminating empty
+    line.
+    """
+
+    # Maximum number of idle connections kept per server
+    MAX_IDLE_CONNECTIONS = 4
+    # Maximum number of requests sent before reading responses
+    PIPELINE_SIZE = 32
+    # Socket timeout (in seconds)
+    TIMEOUT = 30
+
+    _pool = {}
+    _pool_lock = threading.Lock()
+
+    def __init__(self, timeout=None):
+        """Constructor."""
         conf = dict(param_tools.get_global_parameters("modoboa_amavis"))
+        if conf["am_pdp_mode"] == "inet":
+            self._family = socket.AF_INET
+            self._address = (conf["am_pdp_host"], conf["am_pdp_port"])
+        else:
+            self._family = socket.AF_UNIX
+            self._address = conf["am_pdp_socket"]
+        self._timeout = timeout if timeout is not None else self.TIMEOUT
+        self._sock = None
+        self._pooled = False
+        self._buffer = b""
+
+    @classmethod
+    def clear_pool(cls):
+        """Close every idle connection."""
+        with cls._pool_lock:
+            for connections in cls._pool.values():
+                for sock in connections:
+                    sock.close()
+            cls._pool.clear()
+
+    def _pool_key(self):
+        return (self._family, self._address)
+
+    def _connect(self):
+        """Get a connection from the pool or open a new one."""
+        with self._pool_lock:
+            connections = self._pool.get(self._pool_key())
+            if connections:
+                self._sock = connections.pop()
+                self._sock.settimeout(self._timeout)
+                self._pooled = True
+                return
         try:
-            if conf["am_pdp_mode"] == "inet":
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.connect((conf["am_pdp_host"], conf["am_pdp_port"]))
-            else:
-                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                self.sock.connect(conf["am_pdp_socket"])
+            sock = socket.socket(self._family, socket.SOCK_STREAM)
+            sock.settimeout(self._timeout)
+            sock.connect(self._address)
         except socket.error as err:
             raise InternalError(
-                _("Connection to amavis failed: %s" % str(err))
+                _("Connection to amavis failed: %s") % str(err)
             )
+        self._sock = sock
+        self._pooled = False
+
+    def _discard(self):
+        """Close the current connection."""
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = None
+        self._buffer = b""
+
+    def close(self):
+        """Give the current connection back to the pool."""
+        if self._sock is None:
+            return
+        with self._pool_lock:
+            connections = self._pool.setdefault(self._pool_key(), [])
+            if not self._buffer and \
+               len(connections) < self.MAX_IDLE_CONNECTIONS:
+                connections.append(self._sock)
+                self._sock = None
+        self._discard()
+
+    @staticmethod
+    def encode(value):
+        """Encode a value using %XX notation when required."""
+        def repl(match):
+            return smart_bytes("%%%02X" % ord(match.group(0)))
 
-    def decode(self, answer):
+        return re.sub(br"[^\x21-\x7e]|%", repl, smart_bytes(value))
+
+    @staticmethod
+    def decode(value):
+        """Decode a value using %XX notation."""
         def repl(match):
-            return struct.pack("B", string.atoi(match.group(0)[1:], 16))
+            return struct.pack("B", int(match.group(1), 16))
+
+        return re.sub(br"%([0-9a-fA-F]{2})", repl, value)
+
+    def _build_release_request(self, mail_id, secret_id, recipients):
+        """Build a release request for one or more recipients."""
+        lines = [
+            b"request=release",
+            b"mail_id=" + self.encode(mail_id),
+            b"secret_id=" + self.encode(secret_id),
+            b"quar_type=Q",
+        ]
+        lines += [b"recipient=" + self.encode(rcpt) for rcpt in recipients]
+        return b"\n".join(lines) + b"\n\n"
+
+    def _read_response(self):
+        """Read a complete response (ended by an empty line)."""
+        while True:
+            match = re.search(br"\r?\n\r?\n", self._buffer)
+            if match:
+                response = self._buffer[:match.start()]
+                self._buffer = self._buffer[match.end():]
+                return self.decode(response)
+            data = self._sock.recv(4096)
+            if not data:
+                raise socket.error("connection closed by amavis")
+            self._buffer += data
+
+    def _send_requests(self, requests):
+        """Send requests and read their responses.
+
+        A connection coming from the pool may have been closed by
+        amavis in the meantime: in this case, if no response has been
+        received yet, a new connection is opened and requests are sent
+        again. Timeouts are never retried.
+        """
+        if self._sock is None:
+            self._connect()
+        responses = []
+        try:
+            self._sock.sendall(b"".join(requests))
+            for request in requests:
+                responses.append(self._read_response())
+        except socket.error as err:
+            pooled = self._pooled
+            self._discard()
+            if pooled and not responses and \
+               not isinstance(err, socket.timeout):
+                return self._send_requests(requests)
+            raise InternalError(
+                _("Communication with amavis failed: %s") % str(err)
+            )
+        return responses
 
-        return re.sub(br"%([0-9a-fA-F]{2})", repl, answer)
+    def _is_success(self, response):
+        return re.search(br"250 [\d\.]+ Ok", response) is not None
 
-    def __del__(self):
-        self.sock.close()
+    def release(self, mail_id, secret_id, recipients):
+        """Release a message for one or more recipients.
+
+        :return: True on success, False otherwise
+        """
+        request = self._build_release_request(mail_id, secret_id, recipients)
+        return self._is_success(self._send_requests([request])[0])
+
+    def release_messages(self, items):
+        """Release several messages using pipelined requests.
+
+        Recipients of the same message are grouped into a single
+        request.
+
+        :param list items: list of (mail_id, secret_id, recipient) tuples
+        :return: a dictionary {(mail_id, recipient): result}
+        """
+        groups = collections.OrderedDict()
+        for mail_id, secret_id, rcpt in items:
+            key = (smart_bytes(mail_id), smart_bytes(secret_id))
+            groups.setdefault(key, []).append(rcpt)
+        groups = list(groups.items())
+        result = {}
+        for pos in range(0, len(groups), self.PIPELINE_SIZE):
+            batch = groups[pos:pos + self.PIPELINE_SIZE]
+            responses = self._send_requests([
+                self._build_release_request(mail_id, secret_id, rcpts)
+                for (mail_id, secret_id), rcpts in batch
+            ])
+            for ((mail_id, secret_id), rcpts), response in zip(
+                    batch, responses):
+                for rcpt in rcpts:
+                    result[(mail_id, rcpt)] = self._is_success(response)
+        return result
+
+
+class ReleaseEngine(object):
+    """Release messages using several PDP connections in parallel.
+
+    Messages are split into batches (recipients of the same message
+    always belong to the same batch) which are consumed by a pool of
+    worker threads, each one owning its own connection. A batch that
+    fails (timeout, connection error) is reported as failed without
+    affecting the other ones.
+
+    The number of workers and the per-request timeout can be set using
+    the AMAVIS_RELEASE_WORKERS and AMAVIS_RELEASE_TIMEOUT settings.
+    """
+
+    def __init__(self, workers=None, timeout=None, batch_size=None):
+        """Constructor."""
+        self.workers = (
+            workers or getattr(settings, "AMAVIS_RELEASE_WORKERS", 4))
+        self.timeout = (
+            timeout or getattr(settings, "AMAVIS_RELEASE_TIMEOUT", 10))
+        self.batch_size = batch_size or PDPClient.PIPELINE_SIZE
+        self._lock = threading.Lock()
+
+    def _make_batches(self, items):
+        """Split items into batches of at most batch_size messages."""
+        groups = collections.OrderedDict()
+        for item in items:
+            groups.setdefault(smart_bytes(item[0]), []).append(item)
+        groups = list(groups.values())
+        batches = []
+        for pos in range(0, len(groups), self.batch_size):
+            batch = []
+            for group in groups[pos:pos + self.batch_size]:
+                batch += group
+            batches.append(batch)
+        return batches
+
+    def _worker(self, client, batches, results):
+        """Release batches until the queue is empty."""
+        try:
+            while True:
+                try:
+                    batch = batches.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    batch_results = client.release_messages(batch)
+                except InternalError:
+                    batch_results = dict(
+                        ((smart_bytes(mail_id), rcpt), False)
+                        for mail_id, secret_id, rcpt in batch
+                    )
+                with self._lock:
+                    results.update(batch_results)
+        finally:
+            client.close()
+
+    def run(self, items):
+        """Release messages.
+
+        :param list items: list of (mail_id, secret_id, recipient) tuples
+        :return: a dictionary {(mail_id, recipient): result}
+        """
+        batches = queue.Queue()
+        for batch in self._make_batches(items):
+            batches.put(batch)
+        results = {}
+        threads = []
+        for i in range(min(self.workers, batches.qsize())):
+            thread = threading.Thread(
+                target=self._worker,
+                args=(PDPClient(timeout=self.timeout), batches, results)
+            )
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def release(self, items, connector):
+        """Release messages and update the status of released ones.
+
+        Status updates are sent in bulk once every request is done.
+
+        :param list items: list of (mail_id, secret_id, recipient) tuples
+        :param connector: a SQLconnector instance
+        :return: a dictionary {(mail_id, recipient): result}
+        """
+        results = self.run(items)
+        connector.set_msgrcpts_status([
+            (rcpt, mail_id, "R") for mail_id, secret_id, rcpt in items
+            if results[(smart_bytes(mail_id), rcpt)]
+        ])
+        return results
+
+
+class AMrelease(PDPClient):
+    """Backward compatible release client.
+
+    Use :class:`PDPClient` instead.
+    """
 
     def sendreq(self, mailid, secretid, recipient, *others):
-        self.sock.send(smart_bytes("""request=release
-mail_id=%s
-secret_id=%s
-quar_type=Q
-recipient=%s
-
-""" % (mailid, secretid, recipient)))
-        answer = self.sock.recv(1024)
-        answer = self.decode(answer)
-        if re.search(br"250 [\d\.]+ Ok", answer):
-            return True
-        return False
+        result = self.release(mailid, secretid, [recipient] + list(others))
+        self.close()
+        return result
+
+
+class SpamdClient(object):
+    """A client for the spamd protocol.
+
+    Only the TELL command (used for learning) is supported. spamd
+    closes the connection after each response so a new one is opened
+    for every message; several messages can be sent in parallel using
+    tell_messages().
+
+    The number of parallel connections and the timeout can be set using
+    the AMAVIS_SPAMD_WORKERS and AMAVIS_SPAMD_TIMEOUT settings.
+    """
+
+    PROTOCOL = b"SPAMC/1.5"
+
+    def __init__(self, address, port, workers=None, timeout=None):
+        """Constructor."""
+        self._address = (address, int(port))
+        self.workers = (
+            workers or getattr(settings, "AMAVIS_SPAMD_WORKERS", 4))
+        self.timeout = (
+            timeout or getattr(settings, "AMAVIS_SPAMD_TIMEOUT", 30))
+        self.error = None
+        self._lock = threading.Lock()
+
+    def _build_tell_request(self, username, msg, mtype):
+        """Build a TELL request for a message."""
+        msg = smart_bytes(msg)
+        lines = [
+            b"TELL " + self.PROTOCOL,
+            b"Message-class: " + smart_bytes(mtype),
+            b"Set: local",
+            b"User: " + smart_bytes(username),
+            b"Content-length: " + smart_bytes(len(msg)),
+        ]
+        return b"\r\n".join(lines) + b"\r\n\r\n" + msg
+
+    def _send_request(self, request):
+        """Send a request and return the response headers."""
+        try:
+            sock = socket.create_connection(self._address, self.timeout)
+        except socket.error as err:
+            raise InternalError(
+                _("Connection to spamd failed: %s") % str(err))
+        response = b""
+        try:
+            sock.sendall(request)
+            while b"\r\n\r\n" not in response:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                response += data
+        except socket.error as err:
+            raise InternalError(
+                _("Communication with spamd failed: %s") % str(err))
+        finally:
+            sock.close()
+        return response
+
+    def tell(self, username, msg, mtype):
+        """Learn a message.
+
+        :param str username: spamassassin username
+        :param str msg: message content
+        :param str mtype: type of message (spam or ham)
+        """
+        response = self._send_request(
+            self._build_tell_request(username, msg, mtype))
+        match = re.match(br"SPAMD/[\d\.]+ (\d+) (.*)", response)
+        if match is None:
+            raise InternalError(_("Invalid response from spamd"))
+        if match.group(1) != b"0":
+            raise InternalError(
+                _("spamd error: %s") % smart_text(match.group(2).strip()))
+
+    def _worker(self, jobs, results):
+        """Send messages until the queue is empty."""
+        while True:
+            try:
+                pos, (username, msg, mtype) = jobs.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                self.tell(username, msg, mtype)
+            except InternalError as err:
+                with self._lock:
+                    self.error = smart_text(err)
+            else:
+                results[pos] = True
+
+    def tell_messages(self, items):
+        """Learn several messages in parallel.
+
+        :param list items: list of (username, message, type) tuples
+        :return: list of results (one per item)
+        """
+        self.error = None
+        jobs = queue.Queue()
+        for job in enumerate(items):
+            jobs.put(job)
+        results = [False] * len(items)
+        threads = []
+        for i in range(min(self.workers, len(items))):
+            thread = threading.Thread(
+                target=self._worker, args=(jobs, results))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results
+
+
+# Size of the mbox files kept in memory (bigger ones are written to disk)
+MBOX_SPOOL_SIZE = 1024 * 1024
 
 
 class SpamassassinClient(object):
@@ -115,18 +495,14 @@ class SpamassassinClient(object):
         if self._sa_is_local:
             self._learn_cmd = self._find_binary("sa-learn")
             self._learn_cmd += " --{0} --no-sync -u {1}"
+            self._learn_batch_cmd = self._learn_cmd + " --mbox"
             self._learn_cmd_kwargs = {}
             self._expected_exit_codes = [0]
             self._sync_cmd = self._find_binary("sa-learn")
             self._sync_cmd += " -u {0} --sync"
         else:
-            self._learn_cmd = self._find_binary("spamc")
-            self._learn_cmd += " -d {0} -p {1}".format(
-                conf["spamd_address"], conf["spamd_port"]
-            )
-            self._learn_cmd += " -L {0} -u {1}"
-            self._learn_cmd_kwargs = {}
-            self._expected_exit_codes = [5, 6]
+            self._spamd_client = SpamdClient(
+                conf["spamd_address"], conf["spamd_port"])
 
     def _find_binary(self, name):
         """Find path to binary."""
@@ -167,8 +543,11 @@ class SpamassassinClient(object):
             raise InternalError(_("Local domain not found"))
         return domain
 
-    def _learn(self, rcpt, msg, mtype):
-        """Internal method to call the learning command."""
+    def _get_username(self, rcpt):
+        """Return the spamassassin username to use for a recipient.
+
+        Manual learning is set up for this username if needed.
+        """
         if self._username is None:
             if self._recipient_db == "global":
                 username = self._default_username
@@ -205,14 +584,104 @@ class SpamassassinClient(object):
                     self._setup_cache[username] = True
         if username not in self._username_cache:
             self._username_cache.append(username)
-        cmd = self._learn_cmd.format(mtype, username)
-        code, output = exec_cmd(
-            cmd, pinput=smart_bytes(msg), **self._learn_cmd_kwargs)
+        return username
+
+    def _run_learn_cmd(self, cmd, data=None, stdin=None):
+        """Run a learning command, sending data (or a file) to its input."""
+        if stdin is not None:
+            code, output = exec_cmd(
+                cmd, stdin=stdin, **self._learn_cmd_kwargs)
+        else:
+            code, output = exec_cmd(
+                cmd, pinput=smart_bytes(data), **self._learn_cmd_kwargs)
         if code in self._expected_exit_codes:
             return True
         self.error = smart_text(output)
         return False
 
+    def _tell(self, items):
+        """Send messages to spamd."""
+        results = self._spamd_client.tell_messages(items)
+        if self._spamd_client.error is not None:
+            self.error = self._spamd_client.error
+        return results
+
+    def _learn(self, rcpt, msg, mtype):
+        """Internal method to call the learning command."""
+        username = self._get_username(rcpt)
+        if not self._sa_is_local:
+            return self._tell([(username, msg, mtype)])[0]
+        return self._run_learn_cmd(
+            self._learn_cmd.format(mtype, username), msg)
+
+    @staticmethod
+    def _read_message(msg):
+        """Return the content of a message given as bytes or chunks."""
+        if isinstance(msg, (six.binary_type, six.text_type)):
+            return msg
+        return b"".join(smart_bytes(chunk) for chunk in msg)
+
+    @staticmethod
+    def _write_mbox(mbox, messages):
+        """Write messages to a file using the mbox format.
+
+        Messages (bytes or iterables of chunks) are copied line by line
+        so a single one is never fully loaded.
+        """
+        for msg in messages:
+            if isinstance(msg, (six.binary_type, six.text_type)):
+                msg = [msg]
+            mbox.write(b"From MAILER-DAEMON Thu Jan  1 00:00:00 1970\n")
+            line = b""
+            for line in io.BufferedReader(ChunkReader(
+                    smart_bytes(chunk) for chunk in msg)):
+                mbox.write(re.sub(br"^(>*From )", br">\1", line))
+            if not line.endswith(b"\n"):
+                mbox.write(b"\n")
+            mbox.write(b"\n")
+
+    def learn(self, items, mtype):
+        """Learn several messages at once.
+
+        When spamassassin is local, messages are grouped by username
+        and each group is sent to a single sa-learn process (using the
+        mbox format), written to a temporary file. Otherwise, messages
+        are sent to spamd in parallel, a few at a time.
+
+        Messages can be given as iterables of chunks (see
+        SQLconnector.iter_mail_chunks), which are only read when needed.
+
+        :param list items: list of (recipient, message) tuples
+        :param str mtype: type of message (spam or ham)
+        :return: list of results (one per item)
+        """
+        if not self._sa_is_local:
+            # Only load as many messages as spamd workers
+            workers = self._spamd_client.workers
+            results = []
+            for pos in range(0, len(items), workers):
+                results += self._tell([
+                    (self._get_username(rcpt), self._read_message(msg),
+                     mtype)
+                    for rcpt, msg in items[pos:pos + workers]
+                ])
+            return results
+        results = [False] * len(items)
+        groups = collections.OrderedDict()
+        for pos, (rcpt, msg) in enumerate(items):
+            groups.setdefault(self._get_username(rcpt), []).append(pos)
+        for username, positions in groups.items():
+            cmd = self._learn_batch_cmd.format(mtype, username)
+            with tempfile.SpooledTemporaryFile(
+                    max_size=MBOX_SPOOL_SIZE) as mbox:
+                self._write_mbox(mbox, (items[pos][1] for pos in positions))
+                mbox.seek(0)
+                success = self._run_learn_cmd(cmd, stdin=mbox)
+            if success:
+                for pos in positions:
+                    results[pos] = True
+        return results
+
     def learn_spam(self, rcpt, msg):
         """Learn new spam."""
         return self._learn(rcpt, msg, "spam")
@@ -234,6 +703,9 @@ class QuarantineNavigationParameters(NavigationParameters):
     Specific NavigationParameters subclass for the quarantine.
     """
 
+    # Maximum number of page cursors kept in session
+    MAX_CURSORS = 50
+
     def __init__(self, request):
         super(QuarantineNavigationParameters, self).__init__(
             request, "quarantine_navparams"
@@ -254,6 +726,70 @@ class QuarantineNavigationParameters(NavigationParameters):
             if page is not None:
                 self["page"] = int(page)
 
+    def _get_cursors_key(self):
+        """Return a key identifying the current listing query.
+
+        Page cursors are only valid for the query and the page size
+        they were computed for.
+        """
+        values = [
+            self.get(name)
+            for name in ["order", "pattern", "criteria", "msgtype",
+                         "viewrequests"]
+        ]
+        values.append(self.request.user.parameters.get_value(
+            "messages_per_page", app="modoboa_amavis"))
+        return "|".join("%s" % value for value in values)
+
+    def get_cursor(self, page):
+        """Return the seek cursor pointing at the last row of :kw:`page`.
+
+        :param int page: page number
+        :return: a tuple or None if no cursor is known
+        """
+        cursors = self.get("cursors")
+        if not cursors or cursors["key"] != self._get_cursors_key():
+            return None
+        cursor = cursors["pages"].get(str(page))
+        if cursor is None:
+            return None
+        return tuple(
+            base64.b64decode(value[1]) if isinstance(value, list) else value
+            for value in cursor
+        )
+
+    def set_cursor(self, page, cursor):
+        """Store the seek cursor pointing at the last row of :kw:`page`.
+
+        Binary values are base64 encoded since the session must remain
+        JSON serializable.
+
+        :param int page: page number
+        :param tuple cursor: cursor as returned by the connector
+        """
+        if self.sessionkey not in self.request.session:
+            return
+        key = self._get_cursors_key()
+        cursors = self.get("cursors")
+        if not cursors or cursors["key"] != key:
+            cursors = {"key": key, "pages": {}}
+        if cursor is None:
+            cursors["pages"].pop(str(page), None)
+        else:
+            value = []
+            for item in cursor:
+                if isinstance(item, memoryview):
+                    item = item.tobytes()
+                if isinstance(item, six.binary_type):
+                    item = ["b", smart_text(base64.b64encode(item))]
+                value.append(item)
+            cursors["pages"][str(page)] = value
+            pages = sorted(cursors["pages"], key=int)
+            for old_page in pages[:-self.MAX_CURSORS]:
+                del cursors["pages"][old_page]
+        self["cursors"] = cursors
+        self.request.session.modified = True
+
     def back_to_listing(self):
         """Return the current listing URL.
 
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from ... import body_index
+from ...modo_extension import Amavis
+
+
+class Command(BaseCommand):
+    help = "Index the body of quarantined messages"  # NOQA:A003
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "--batch-size", type=int, default=50,
+            help="Number of messages indexed per transaction")
+        parser.add_argument(
+            "--full", action="store_true", default=False,
+            help="Rebuild the index from scratch")
+        parser.add_argument(
+            "--verbose", action="store_true", default=False,
+            help="Display informational messages")
+
+    def handle(self, *args, **options):
+        Amavis().load()
+        count = body_index.sync(
+            batch_size=options["batch_size"], full=options["full"])
+        if options["verbose"]:
+            print("{} message(s) indexed.".format(count))
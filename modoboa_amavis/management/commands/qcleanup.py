@@ -3,20 +3,51 @@
 
 from __future__ import print_function, unicode_literals
 
+import json
+import sys
 import time
+from collections import OrderedDict
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db.models import Count
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Count, Exists, F, Max, OuterRef, Sum
 
 from modoboa.parameters import tools as param_tools
-from ...models import Maddr, Msgrcpt, Msgs
+from ... import body_index, cache, partitions, retention, summary
+from ...models import (
+    CleanupState, Maddr, Msgrcpt, Msgs, Quarantine, QuarantineSummary
+)
 from ...modo_extension import Amavis
+from ...utils import smart_text
+
+# Orderings used to evict messages when the quarantine exceeds its budget
+EVICTION_ORDERS = {
+    "oldest": ["time_num", "mail_id"],
+    "largest": ["-size", "mail_id"],
+    "score": [F("spam_level").desc(nulls_last=True), "mail_id"],
+}
+
+
+def _take(rows, max_bytes):
+    """Return the first (mail_id, size) rows needed to reach max_bytes."""
+    result = []
+    total = 0
+    for row in rows:
+        if total >= max_bytes:
+            break
+        result.append(row)
+        total += row[1] or 0
+    return result
 
 
 class Command(BaseCommand):
     args = ""
     help = "Amavis quarantine cleanup"  # NOQA:A003
 
+    # Minimum number of seconds between two progress messages
+    PROGRESS_INTERVAL = 5
+
     def add_arguments(self, parser):
         """Add extra arguments to command line."""
         parser.add_argument(
@@ -25,11 +56,292 @@ class Command(BaseCommand):
         parser.add_argument(
             "--verbose", action="store_true", default=False,
             help="Display informational messages")
+        parser.add_argument(
+            "--batch-size", type=int,
+            default=getattr(settings, "AMAVIS_CLEANUP_BATCH_SIZE", 1000),
+            help="Number of messages deleted per transaction")
+        parser.add_argument(
+            "--daemon", "--continuous", action="store_true", default=False,
+            help="Run forever, deleting expired messages continuously")
+        parser.add_argument(
+            "--rate", type=float, default=None,
+            help=("Maximum number of rows deleted per second (defaults to "
+                  "AMAVIS_CLEANUP_RATE in daemon mode, unlimited "
+                  "otherwise)"))
+        parser.add_argument(
+            "--interval", type=int,
+            default=getattr(settings, "AMAVIS_CLEANUP_INTERVAL", 60),
+            help="Number of seconds between two passes in daemon mode")
+        parser.add_argument(
+            "--sweep-batches", type=int,
+            default=getattr(settings, "AMAVIS_CLEANUP_SWEEP_BATCHES", 10),
+            help=("Maximum number of address ranges looked at per pass in "
+                  "daemon mode"))
+        parser.add_argument(
+            "--sweep-margin", type=int,
+            default=getattr(settings, "AMAVIS_CLEANUP_SWEEP_MARGIN", 1000),
+            help=("Number of most recent addresses left alone by the "
+                  "address sweep"))
+        parser.add_argument(
+            "--budget", type=int,
+            default=getattr(settings, "AMAVIS_QUARANTINE_BUDGET", None),
+            help=("Maximum size of the quarantine, in bytes: messages are "
+                  "evicted until it fits"))
+        parser.add_argument(
+            "--eviction-order", choices=sorted(EVICTION_ORDERS.keys()),
+            default=getattr(settings, "AMAVIS_EVICTION_ORDER", "oldest"),
+            help="Messages evicted first when the budget is exceeded")
+        parser.add_argument(
+            "--dry-run", action="store_true", default=False,
+            help="Only count what would be deleted")
+        parser.add_argument(
+            "--max-runtime", type=int, default=None,
+            help="Stop (between two batches) after this number of seconds")
+        parser.add_argument(
+            "--json", action="store_true", default=False,
+            help=("Print a JSON report of each pass (informational "
+                  "messages go to stderr)"))
 
     def __vprint(self, msg):
         if not self.verbose:
             return
-        print(msg)
+        print(msg, file=sys.stderr if self.json else sys.stdout)
+
+    def _get_phase(self, name):
+        """Return the statistics of a phase of the current pass."""
+        if name not in self.stats:
+            self.stats[name] = {"rows": 0, "bytes": 0, "duration": 0.0}
+        return self.stats[name]
+
+    def _time_is_up(self):
+        """Tell if the maximum runtime has been reached."""
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.interrupted = True
+        return self.interrupted
+
+    def _report_progress(self, name, force=False):
+        """Print the progress of a phase, at most every few seconds."""
+        now = time.time()
+        if not force and now - self.last_progress < self.PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        phase = self.stats[name]
+        rate = phase["rows"] / phase["duration"] if phase["duration"] else 0
+        self.__vprint(
+            "{}: {} row(s) and {} byte(s) deleted ({:.0f} rows/s)".format(
+                name, phase["rows"], phase["bytes"], rate))
+
+    def _plan(self, name, qset, max_bytes=None):
+        """Count the messages selected by qset (dry-run mode)."""
+        phase = self._get_phase(name)
+        if max_bytes is None:
+            result = qset.aggregate(rows=Count("mail_id"), size=Sum("size"))
+            phase["rows"] += result["rows"]
+            phase["bytes"] += result["size"] or 0
+        else:
+            rows = _take(
+                qset.values_list("mail_id", "size").iterator(), max_bytes)
+            phase["rows"] += len(rows)
+            phase["bytes"] += sum(row[1] or 0 for row in rows)
+        self.__vprint("{}: {} row(s) and {} byte(s) to delete".format(
+            name, phase["rows"], phase["bytes"]))
+
+    def _delete_messages(self, mail_ids):
+        """Delete messages, using one statement per table.
+
+        Rows are removed from quarantine, msgrcpt and msgs directly,
+        without loading them, inside a short transaction.
+        """
+        connection = connections["amavis"]
+        qn = connection.ops.quote_name
+        placeholders = ", ".join(["%s"] * len(mail_ids))
+        with transaction.atomic(using="amavis"):
+            cursor = connection.cursor()
+            for model in [Quarantine, Msgrcpt, Msgs]:
+                cursor.execute(
+                    "DELETE FROM {} WHERE {} IN ({})".format(
+                        qn(model._meta.db_table), qn("mail_id"),
+                        placeholders),
+                    mail_ids
+                )
+        if summary.is_enabled():
+            summary.delete_messages(mail_ids)
+        if body_index.is_enabled():
+            body_index.delete_messages(mail_ids)
+        cache.invalidate_rendered_messages(
+            [smart_text(mail_id) for mail_id in mail_ids])
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+
+    def _throttle(self, rows, elapsed):
+        """Wait so the deletion rate stays below the budget.
+
+        The time spent processing a batch counts, so slow batches (for
+        example because of lock waits) are followed by short pauses and
+        fast ones by longer pauses.
+
+        :param int rows: number of rows processed by the last batch
+        :param float elapsed: duration of the last batch, in seconds
+        """
+        if not self.rate:
+            return
+        delay = rows / float(self.rate) - elapsed
+        if delay > 0:
+            self._sleep(delay)
+
+    def _delete_by_batches(self, name, qset, max_bytes=None):
+        """Delete the messages selected by qset, batch by batch.
+
+        Where the backend supports it, selected rows are locked using
+        SKIP LOCKED so rows in use by amavis are left for a later batch.
+
+        :param str name: phase name
+        :param qset: a Msgs queryset
+        :param int max_bytes: stop once messages of this total size
+                              have been deleted
+        """
+        if self.dry_run:
+            self._plan(name, qset, max_bytes)
+            return
+        phase = self._get_phase(name)
+        qset = qset.values_list("mail_id", "size")
+        if connections["amavis"].features.has_select_for_update_skip_locked:
+            qset = qset.select_for_update(skip_locked=True)
+        started = time.time()
+        while not self._time_is_up():
+            batch_started = time.time()
+            with transaction.atomic(using="amavis"):
+                rows = list(qset[:self.batch_size])
+                if max_bytes is not None:
+                    rows = _take(rows, max_bytes - phase["bytes"])
+                if rows:
+                    self._delete_messages([row[0] for row in rows])
+            phase["rows"] += len(rows)
+            phase["bytes"] += sum(row[1] or 0 for row in rows)
+            phase["duration"] = time.time() - started
+            self._report_progress(name)
+            self._throttle(len(rows), time.time() - batch_started)
+            if len(rows) < self.batch_size:
+                break
+        self._report_progress(name, force=True)
+
+    def _delete_partitions(self, limit):
+        """Delete the partitions which only contain old messages.
+
+        Partitions are truncated when possible, emptied by batches
+        otherwise.
+        """
+        for tag in partitions.get_expired_tags(limit):
+            if self._time_is_up():
+                break
+            name = "partition_{}".format(tag)
+            if not self.dry_run and partitions.truncate(tag):
+                self._get_phase(name)["truncated"] = True
+                # Deleted messages are unknown
+                cache.clear_rendered_messages()
+                self.__vprint("Partition {} truncated.".format(tag))
+                continue
+            self._delete_by_batches(
+                name, Msgs.objects.filter(partition_tag=tag))
+
+    def _evict(self, qset, budget, order):
+        """Delete messages until the quarantine fits into budget.
+
+        :param qset: a queryset of the messages which can be evicted
+        :param int budget: maximum size, in bytes
+        :param str order: key of EVICTION_ORDERS
+        """
+        total = Msgs.objects.aggregate(size=Sum("size"))["size"] or 0
+        if self.dry_run:
+            # Nothing has been deleted by previous phases
+            total -= sum(phase["bytes"] for phase in self.stats.values())
+        if total <= budget:
+            return
+        self.__vprint(
+            "Quarantine exceeds its budget by {} byte(s), evicting {} "
+            "messages first...".format(total - budget, order))
+        self._delete_by_batches(
+            "evicted", qset.order_by(*EVICTION_ORDERS[order]),
+            max_bytes=total - budget)
+
+    def _delete_orphan_addresses(self):
+        """Delete addresses referenced by no message.
+
+        The maddr table is walked by id ranges of batch_size rows. Each
+        range is cleaned by a single statement and the last processed
+        id is saved, so an interrupted sweep resumes where it stopped.
+        In daemon mode, each pass only looks at a few ranges and the
+        next one resumes from there.
+
+        amavis stores the addresses of a message before the message
+        itself, so the sweep stops sweep_margin ids below the newest
+        address: recent addresses are looked at by a later sweep, once
+        their messages are stored.
+
+        Returns nothing but updates the statistics of the "addresses"
+        phase.
+        """
+        phase = self._get_phase("addresses")
+        last_id = Maddr.objects.aggregate(last_id=Max("id"))["last_id"]
+        limit = (last_id or 0) - self.sweep_margin
+        if self.dry_run:
+            phase["rows"] = Maddr.objects.filter(id__lte=limit).annotate(
+                sender=Exists(Msgs.objects.filter(sid=OuterRef("id"))),
+                rcpt=Exists(Msgrcpt.objects.filter(rid=OuterRef("id")))
+            ).filter(sender=False, rcpt=False).count()
+            self.__vprint("addresses: {} row(s) to delete".format(
+                phase["rows"]))
+            return
+        connection = connections["amavis"]
+        qn = connection.ops.quote_name
+        query = (
+            "DELETE FROM {maddr} WHERE {id} > %s AND {id} <= %s "
+            "AND NOT EXISTS (SELECT 1 FROM {msgs} WHERE {msgs}.{sid} = "
+            "{maddr}.{id}) "
+            "AND NOT EXISTS (SELECT 1 FROM {msgrcpt} WHERE {msgrcpt}.{rid} = "
+            "{maddr}.{id})"
+        ).format(
+            maddr=qn(Maddr._meta.db_table), msgs=qn(Msgs._meta.db_table),
+            msgrcpt=qn(Msgrcpt._meta.db_table), id=qn("id"), sid=qn("sid"),
+            rid=qn("rid")
+        )
+        state, created = CleanupState.objects.get_or_create(
+            name="maddr_sweep", defaults={"value": 0})
+        if not created:
+            self.__vprint("Resuming after address {}...".format(state.value))
+        qset = Maddr.objects.order_by("id").values_list("id", flat=True)
+        started = time.time()
+        finished = False
+        batches = 0
+        while not self._time_is_up():
+            if self.sweep_batches is not None and \
+                    batches >= self.sweep_batches:
+                break
+            batch_started = time.time()
+            ids = list(
+                qset.filter(id__gt=state.value, id__lte=limit)
+                [:self.batch_size])
+            if not ids:
+                finished = True
+                break
+            with transaction.atomic(using="amavis"):
+                cursor = connection.cursor()
+                cursor.execute(query, [state.value, ids[-1]])
+                deleted = cursor.rowcount
+                state.value = ids[-1]
+                state.save(update_fields=["value"])
+            batches += 1
+            phase["rows"] += deleted
+            phase["duration"] = time.time() - started
+            self._report_progress("addresses")
+            self._throttle(deleted, time.time() - batch_started)
+            if len(ids) < self.batch_size:
+                finished = True
+                break
+        self._report_progress("addresses", force=True)
+        if finished:
+            state.delete()
 
     def handle(self, *args, **options):
         Amavis().load()
@@ -39,7 +351,52 @@ class Command(BaseCommand):
             log.setLevel(logging.DEBUG)
             log.addHandler(logging.StreamHandler())
         self.verbose = options["verbose"]
+        self.batch_size = options["batch_size"]
+        self.rate = options["rate"]
+        self.sweep_margin = options["sweep_margin"]
+        self.budget = options["budget"]
+        self.eviction_order = options["eviction_order"]
+        self.dry_run = options["dry_run"]
+        self.json = options["json"]
+        self.deadline = None
+        if options["max_runtime"]:
+            self.deadline = time.time() + options["max_runtime"]
+        self.interrupted = False
+        self.sweep_batches = None
+        if not options["daemon"] or self.dry_run:
+            self._cleanup()
+            return
+        if self.rate is None:
+            self.rate = getattr(settings, "AMAVIS_CLEANUP_RATE", 500)
+        self.sweep_batches = options["sweep_batches"]
+        self._run_forever(options["interval"])
+
+    def _run_forever(self, interval):
+        """Run cleanup passes until interrupted.
 
+        Database errors do not stop the loop: the connection is closed
+        and the next pass starts after the usual interval.
+        """
+        try:
+            while not self._time_is_up():
+                try:
+                    self._cleanup()
+                except DatabaseError as exc:
+                    print("Cleanup pass failed: {}".format(exc),
+                          file=sys.stderr)
+                    connections["amavis"].close()
+                if self.deadline is not None:
+                    interval = min(interval, self.deadline - time.time())
+                if interval > 0:
+                    self._sleep(interval)
+        except KeyboardInterrupt:
+            self.__vprint("Interrupted.")
+
+    def _cleanup(self):
+        """Run a cleanup pass."""
+        started = time.time()
+        self.stats = OrderedDict()
+        self.last_progress = started
         conf = dict(param_tools.get_global_parameters("modoboa_amavis"))
 
         flags = ["D"]
@@ -47,20 +404,81 @@ class Command(BaseCommand):
             flags += ["R"]
 
         self.__vprint("Deleting marked messages...")
-        ids = Msgrcpt.objects.filter(rs__in=flags).values("mail_id").distinct()
-        for msg in Msgs.objects.filter(mail_id__in=ids):
-            if not msg.msgrcpt_set.exclude(rs__in=flags).count():
-                msg.delete()
+        # Messages with at least one marked recipient and no other ones
+        marked = Msgrcpt.objects.filter(
+            mail=OuterRef("mail_id"), rs__in=flags)
+        unmarked = Msgrcpt.objects.filter(
+            mail=OuterRef("mail_id")).exclude(rs__in=flags)
+        self._delete_by_batches("marked", Msgs.objects.annotate(
+            marked=Exists(marked), unmarked=Exists(unmarked)
+        ).filter(marked=True, unmarked=False))
 
-        self.__vprint(
-            "Deleting messages older than {} days...".format(
-                conf["max_messages_age"]))
-        limit = int(time.time()) - (conf["max_messages_age"] * 24 * 3600)
-        Msgs.objects.filter(time_num__lt=limit).delete()
+        def exclude_marked(qset):
+            # Marked messages are already counted by dry runs
+            if not self.dry_run:
+                return qset
+            return qset.annotate(
+                marked=Exists(marked), unmarked=Exists(unmarked)
+            ).exclude(marked=True, unmarked=False)
+
+        rules = retention.get_rules()
+        limit = retention.get_limit(conf["max_messages_age"])
+        expired = retention.get_expired_messages(rules, limit)
+        for pos, qset in enumerate(expired[:-1]):
+            self.__vprint(
+                "Deleting messages older than {} days (rule {})...".format(
+                    rules[pos]["max_age"], pos + 1))
+            self._delete_by_batches(
+                "rule_{}".format(pos + 1), exclude_marked(qset))
+        # Keep what the longest retention period covers
+        limit = retention.get_oldest_limit(rules, limit)
+        if partitions.is_enabled():
+            self.__vprint(
+                "Deleting partitions older than {} days...".format(
+                    conf["max_messages_age"]))
+            self._delete_partitions(limit)
+        else:
+            self.__vprint(
+                "Deleting messages older than {} days...".format(
+                    conf["max_messages_age"]))
+            self._delete_by_batches("expired", exclude_marked(expired[-1]))
+
+        if self.budget is not None and not self._time_is_up():
+            qset = Msgs.objects.all()
+            if self.dry_run:
+                qset = exclude_marked(qset.filter(time_num__gte=limit))
+                for rule_qset in expired[:-1]:
+                    # Already counted by retention rules
+                    qset = qset.exclude(
+                        mail_id__in=rule_qset.values("mail_id"))
+            self._evict(qset, self.budget, self.eviction_order)
+
+        if not self.dry_run and not self._time_is_up():
+            self._cleanup_sidecars(limit)
+            self.__vprint("Deleting unreferenced e-mail addresses...")
+            self._delete_orphan_addresses()
+        elif self.dry_run:
+            self._delete_orphan_addresses()
+
+        if self.interrupted:
+            self.__vprint("Maximum runtime reached, stopping.")
+        else:
+            self.__vprint("Done.")
+        if self.json:
+            print(json.dumps(OrderedDict([
+                ("dry_run", self.dry_run),
+                ("interrupted", self.interrupted),
+                ("duration", round(time.time() - started, 3)),
+                ("phases", self.stats),
+            ])))
 
-        self.__vprint("Deleting unreferenced e-mail addresses...")
-        Maddr.objects.annotate(
-            msgs_count=Count("msgs"), msgrcpt_count=Count("msgrcpt")
-        ).filter(msgs_count=0, msgrcpt_count=0).delete()
+    def _cleanup_sidecars(self, limit):
+        """Clean tables maintained by modoboa."""
+        # Remove entries left by messages deleted by someone else
+        if summary.is_enabled():
+            self.__vprint("Cleaning up the summary table...")
+            QuarantineSummary.objects.filter(time_num__lt=limit).delete()
 
-        self.__vprint("Done.")
+        if body_index.is_enabled():
+            self.__vprint("Cleaning up the body index...")
+            body_index.delete_older_than(limit)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ... import search
+
+
+class Command(BaseCommand):
+    help = "Create (or drop) the quarantine search index"  # NOQA:A003
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "--drop", action="store_true", default=False,
+            help="Drop the search index")
+        parser.add_argument(
+            "--verbose", action="store_true", default=False,
+            help="Display executed statements")
+
+    def handle(self, *args, **options):
+        backend = search.get_backend(indexed=True)
+        if options["drop"]:
+            statements = backend.get_drop_statements()
+        else:
+            statements = backend.get_create_statements()
+        if not statements:
+            print("No search index available for this database engine.")
+            return
+        with transaction.atomic(using="amavis"):
+            cursor = backend.connection.cursor()
+            for statement in statements:
+                if options["verbose"]:
+                    print(statement)
+                cursor.execute(statement)
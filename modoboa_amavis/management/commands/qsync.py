@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from ... import summary
+from ...modo_extension import Amavis
+
+
+class Command(BaseCommand):
+    help = "Synchronize the quarantine summary table"  # NOQA:A003
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "--batch-size", type=int, default=summary.BULK_SIZE,
+            help="Number of recipients processed per query")
+        parser.add_argument(
+            "--full", action="store_true", default=False,
+            help="Rebuild the summary table from scratch")
+        parser.add_argument(
+            "--verbose", action="store_true", default=False,
+            help="Display informational messages")
+
+    def handle(self, *args, **options):
+        Amavis().load()
+        created, updated = summary.sync(
+            batch_size=options["batch_size"], full=options["full"])
+        if options["verbose"]:
+            print("{} row(s) created, {} row(s) updated.".format(
+                created, updated))
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modoboa_amavis', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuarantineSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mail_id', models.CharField(max_length=16)),
+                ('rid', models.BigIntegerField(db_index=True)),
+                ('email', models.CharField(max_length=255)),
+                ('domain', models.CharField(max_length=255, db_index=True)),
+                ('from_addr', models.CharField(max_length=765, blank=True)),
+                ('subject', models.CharField(max_length=765, blank=True)),
+                ('time_num', models.IntegerField(db_index=True)),
+                ('content', models.CharField(max_length=3)),
+                ('bspam_level', models.FloatField(null=True, blank=True)),
+                ('rs', models.CharField(max_length=3)),
+            ],
+            options={
+                'db_table': 'quarantine_summary',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='quarantinesummary',
+            unique_together=set([('mail_id', 'rid')]),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modoboa_amavis', '0002_quarantinesummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexedMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mail_id', models.CharField(max_length=16, unique=True)),
+                ('time_num', models.IntegerField(db_index=True)),
+            ],
+            options={
+                'db_table': 'quarantine_indexed_msgs',
+            },
+        ),
+        migrations.CreateModel(
+            name='BodyToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64)),
+                ('mail_id', models.CharField(max_length=16, db_index=True)),
+            ],
+            options={
+                'db_table': 'quarantine_body_tokens',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='bodytoken',
+            unique_together=set([('token', 'mail_id')]),
+        ),
+    ]
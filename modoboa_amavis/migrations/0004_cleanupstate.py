@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modoboa_amavis', '0003_body_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CleanupState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('value', models.BigIntegerField()),
+            ],
+            options={
+                'db_table': 'quarantine_cleanup_state',
+            },
+        ),
+    ]
@@ -243,3 +243,67 @@ class Wblist(models.Model):
         db_table = "wblist"
         managed = False
         unique_together = [("rid", "sid")]
+
+
+class QuarantineSummary(models.Model):
+    """Denormalized view of the quarantine, used by listings.
+
+    This table is not part of the amavis schema. It contains one row per
+    quarantined recipient, with decoded values, and is filled by the
+    qsync command (see modoboa_amavis.summary).
+    """
+
+    mail_id = models.CharField(max_length=16)
+    rid = models.BigIntegerField(db_index=True)
+    email = models.CharField(max_length=255)
+    domain = models.CharField(max_length=255, db_index=True)
+    from_addr = models.CharField(max_length=765, blank=True)
+    subject = models.CharField(max_length=765, blank=True)
+    time_num = models.IntegerField(db_index=True)
+    content = models.CharField(max_length=3)
+    bspam_level = models.FloatField(null=True, blank=True)
+    rs = models.CharField(max_length=3)
+
+    class Meta:
+        db_table = "quarantine_summary"
+        unique_together = ("mail_id", "rid")
+
+
+class IndexedMessage(models.Model):
+    """A message whose body has been indexed (see modoboa_amavis.body_index).
+
+    Not part of the amavis schema.
+    """
+
+    mail_id = models.CharField(max_length=16, unique=True)
+    time_num = models.IntegerField(db_index=True)
+
+    class Meta:
+        db_table = "quarantine_indexed_msgs"
+
+
+class BodyToken(models.Model):
+    """An entry of the message body inverted index.
+
+    Not part of the amavis schema.
+    """
+
+    token = models.CharField(max_length=64)
+    mail_id = models.CharField(max_length=16, db_index=True)
+
+    class Meta:
+        db_table = "quarantine_body_tokens"
+        unique_together = ("token", "mail_id")
+
+
+class CleanupState(models.Model):
+    """Progress of the interruptible steps of qcleanup.
+
+    Not part of the amavis schema.
+    """
+
+    name = models.CharField(max_length=64, unique=True)
+    value = models.BigIntegerField()
+
+    class Meta:
+        db_table = "quarantine_cleanup_state"
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""Support for amavis partitions ($sql_partition_tag).
+
+amavisd can tag every row it stores with a partition tag (for example
+the ISO week number of the reception date). When AMAVIS_PARTITIONS is
+set, qcleanup removes whole partitions once all their messages are
+older than the retention period, instead of deleting rows one message
+at a time.
+
+If the tables are natively partitioned (one LIST partition per tag),
+partitions are truncated. Otherwise, rows are deleted by batches.
+"""
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Max
+
+from .models import Msgrcpt, Msgs, Quarantine
+
+# Tables containing partitioned data, children first
+MODELS = [Quarantine, Msgrcpt, Msgs]
+
+
+def is_enabled():
+    """Tell if amavis uses partition tags."""
+    return getattr(settings, "AMAVIS_PARTITIONS", False)
+
+
+def get_expired_tags(limit):
+    """Return the tags of the partitions only containing old messages.
+
+    :param int limit: timestamp of the oldest message to keep
+    :return: a list of tags
+    """
+    return list(
+        Msgs.objects.values("partition_tag")
+        .annotate(newest=Max("time_num"))
+        .filter(newest__lt=limit)
+        .values_list("partition_tag", flat=True)
+    )
+
+
+def _get_postgresql_partition(cursor, table, tag):
+    cursor.execute(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = %s "
+        "AND pg_get_expr(child.relpartbound, child.oid) = %s",
+        [table, "FOR VALUES IN ({})".format(int(tag))]
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _get_mysql_partition(cursor, table, tag):
+    cursor.execute(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s "
+        "AND PARTITION_METHOD = 'LIST' AND PARTITION_DESCRIPTION = %s",
+        [table, "{}".format(int(tag))]
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def truncate(tag):
+    """Truncate the native partitions holding tag.
+
+    Nothing is done unless every table has a partition dedicated to
+    this tag.
+
+    :return: True if partitions were truncated, False otherwise
+    """
+    connection = connections["amavis"]
+    qn = connection.ops.quote_name
+    if connection.vendor == "postgresql":
+        get_partition = _get_postgresql_partition
+    elif connection.vendor == "mysql":
+        get_partition = _get_mysql_partition
+    else:
+        return False
+    with transaction.atomic(using="amavis"):
+        cursor = connection.cursor()
+        partitions = []
+        for model in MODELS:
+            table = model._meta.db_table
+            name = get_partition(cursor, table, tag)
+            if name is None:
+                return False
+            partitions.append((table, name))
+        if connection.vendor == "postgresql":
+            # A single statement, because of foreign keys
+            cursor.execute("TRUNCATE TABLE {}".format(
+                ", ".join(qn(name) for table, name in partitions)))
+        else:
+            for table, name in partitions:
+                cursor.execute("ALTER TABLE {} TRUNCATE PARTITION {}".format(
+                    qn(table), qn(name)))
+    return True
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+"""Retention rules.
+
+By default, every message is kept MAX_MESSAGES_AGE days. The
+AMAVIS_RETENTION_RULES setting defines other retention periods for some
+recipients, for example::
+
+  AMAVIS_RETENTION_RULES = [
+      # Spam above the kill level is almost never released
+      {"content": ["S"], "min_score": 20, "max_age": 3},
+      {"content": ["B", "H"], "max_age": 60},
+      {"domain": ["example.com"], "max_age": 7},
+  ]
+
+A rule matches recipients (msgrcpt rows) using the following optional
+criteria:
+
+* content: a list of message types (see constants.MESSAGE_TYPES)
+* min_score / max_score: a range of spam scores (bspam_level), the
+  upper bound being excluded
+* domain: a list of recipient domains
+
+max_age (in days) is mandatory. Each recipient is governed by the first
+rule it matches, others by MAX_MESSAGES_AGE. A message is deleted once
+the retention periods of all its recipients are over.
+"""
+
+from __future__ import unicode_literals
+
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Exists, OuterRef, Q
+
+from .constants import MESSAGE_TYPES
+from .models import Msgrcpt, Msgs
+from .sql_connector import reverse_domain_names
+
+RULE_KEYS = ["content", "min_score", "max_score", "domain", "max_age"]
+
+
+def get_rules():
+    """Return the retention rules, checking their definition."""
+    rules = getattr(settings, "AMAVIS_RETENTION_RULES", [])
+    for rule in rules:
+        unknown = set(rule.keys()) - set(RULE_KEYS)
+        if unknown:
+            raise ImproperlyConfigured(
+                "Unknown retention rule key(s): {}".format(
+                    ", ".join(sorted(unknown))))
+        if "max_age" not in rule:
+            raise ImproperlyConfigured(
+                "Retention rules must define max_age")
+        for content in rule.get("content", []):
+            if content not in MESSAGE_TYPES:
+                raise ImproperlyConfigured(
+                    "Unknown message type: {}".format(content))
+    return rules
+
+
+def get_limit(max_age):
+    """Return the timestamp of the oldest message to keep."""
+    return int(time.time()) - (max_age * 24 * 3600)
+
+
+def get_rule_filter(rule):
+    """Return a filter selecting the msgrcpt rows matched by rule."""
+    flt = Q()
+    if "content" in rule:
+        flt &= Q(content__in=rule["content"])
+    if "min_score" in rule:
+        flt &= Q(bspam_level__gte=rule["min_score"])
+    if "max_score" in rule:
+        flt &= Q(bspam_level__lt=rule["max_score"])
+    if "domain" in rule:
+        flt &= Q(rid__domain__in=reverse_domain_names(rule["domain"]))
+    if not flt:
+        # No criteria: match every row
+        flt = Q(mail__isnull=False)
+    return flt
+
+
+def get_governed_filters(rules):
+    """Return, for each rule, a filter selecting the rows it governs.
+
+    A row is governed by the first rule it matches. The last filter
+    selects the rows governed by the default retention period.
+    """
+    result = []
+    previous = Q()
+    for rule in rules:
+        flt = get_rule_filter(rule)
+        result.append(flt & ~previous if previous else flt)
+        previous |= flt
+    result.append(~previous if previous else Q())
+    return result
+
+
+def get_retained_filter(rules, default_limit):
+    """Return a filter selecting the rows still in their retention period.
+
+    :param list rules: retention rules
+    :param int default_limit: limit used by rows matching no rule
+    """
+    limits = [get_limit(rule["max_age"]) for rule in rules]
+    limits.append(default_limit)
+    flt = Q()
+    for governed, limit in zip(get_governed_filters(rules), limits):
+        flt |= governed & Q(mail__time_num__gte=limit)
+    return flt
+
+
+def get_oldest_limit(rules, default_limit):
+    """Return the limit of the longest retention period."""
+    return min(
+        [default_limit] + [get_limit(rule["max_age"]) for rule in rules])
+
+
+def get_expired_messages(rules, default_limit):
+    """Return the messages to delete, one queryset per rule.
+
+    The last queryset covers the default retention period. Querysets
+    are disjoint: a message belongs to the first rule matching one of
+    its recipients.
+
+    :param list rules: retention rules
+    :param int default_limit: limit used by rows matching no rule
+    """
+    if not rules:
+        return [Msgs.objects.filter(time_num__lt=default_limit)]
+    retained = Msgrcpt.objects.filter(
+        get_retained_filter(rules, default_limit), mail=OuterRef("mail_id"))
+    result = []
+    previous = Q()
+    for rule in rules:
+        flt = get_rule_filter(rule)
+        qset = Msgs.objects.filter(
+            time_num__lt=get_limit(rule["max_age"])
+        ).annotate(
+            matched=Exists(
+                Msgrcpt.objects.filter(flt, mail=OuterRef("mail_id"))),
+            retained=Exists(retained)
+        ).filter(matched=True, retained=False)
+        if previous:
+            qset = qset.annotate(earlier=Exists(
+                Msgrcpt.objects.filter(previous, mail=OuterRef("mail_id")))
+            ).filter(earlier=False)
+        result.append(qset)
+        previous |= flt
+    result.append(
+        Msgs.objects.filter(time_num__lt=default_limit).annotate(
+            earlier=Exists(
+                Msgrcpt.objects.filter(previous, mail=OuterRef("mail_id")))
+        ).filter(earlier=False)
+    )
+    return result
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""Quarantine search backends.
+
+Searches run against the summary table (see modoboa_amavis.summary)
+since amavis tables only contain raw, undecoded values. By default, a
+search is a set of icontains lookups, which means a full scan. Once the
+qindex command has been run and AMAVIS_SEARCH_INDEX is set, a backend
+specific to the database engine is used so searches rely on an index.
+"""
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+
+from .models import QuarantineSummary
+
+SEARCH_FIELDS = ["from_addr", "subject", "email"]
+
+
+class SearchBackend(object):
+    """Default backend, using unindexed icontains lookups."""
+
+    # Shorter patterns can't use the index, use icontains instead
+    min_length = 0
+
+    def __init__(self, connection):
+        """Constructor."""
+        self.connection = connection
+        self.table = QuarantineSummary._meta.db_table
+
+    def quote_name(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def get_create_statements(self):
+        """Return the SQL statements which build the search index."""
+        return []
+
+    def get_drop_statements(self):
+        """Return the SQL statements which remove the search index."""
+        return []
+
+    def _filter(self, queryset, fields, pattern):
+        flt = Q()
+        for field in fields:
+            flt |= Q(**{"{}__icontains".format(field): pattern})
+        return queryset.filter(flt)
+
+    def filter(self, queryset, fields, pattern):  # NOQA:A003
+        """Select rows containing pattern in at least one field.
+
+        :param queryset: a QuarantineSummary queryset
+        :param list fields: names of the fields to look into
+        :param str pattern: text to search
+        """
+        if not fields:
+            return queryset
+        if len(pattern) < self.min_length:
+            return SearchBackend._filter(self, queryset, fields, pattern)
+        return self._filter(queryset, fields, pattern)
+
+
+class PostgreSQLBackend(SearchBackend):
+    """Trigram indexes (pg_trgm).
+
+    Django translates icontains to UPPER(column::text) LIKE UPPER(%s),
+    which a GIN trigram index on the same expression can serve, so only
+    indexes are needed.
+    """
+
+    min_length = 3
+
+    def _get_index_name(self, field):
+        return "{}_{}_trgm".format(self.table, field)
+
+    def _get_existing_indexes(self):
+        """Return the names of the indexes of the summary table.
+
+        CREATE INDEX IF NOT EXISTS requires PostgreSQL 9.5.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "SELECT indexname FROM pg_indexes "
+            "WHERE schemaname = current_schema() AND tablename = %s",
+            [self.table])
+        return set(row[0] for row in cursor.fetchall())
+
+    def get_create_statements(self):
+        statements = ["CREATE EXTENSION IF NOT EXISTS pg_trgm"]
+        existing = self._get_existing_indexes()
+        for field in SEARCH_FIELDS:
+            name = self._get_index_name(field)
+            if name in existing:
+                continue
+            statements.append(
+                "CREATE INDEX {} ON {} USING gin "
+                "(UPPER({}::text) gin_trgm_ops)".format(
+                    self.quote_name(name), self.quote_name(self.table),
+                    self.quote_name(field))
+            )
+        return statements
+
+    def get_drop_statements(self):
+        return [
+            "DROP INDEX IF EXISTS {}".format(
+                self.quote_name(self._get_index_name(field)))
+            for field in SEARCH_FIELDS
+        ]
+
+
+class MySQLBackend(SearchBackend):
+    """FULLTEXT indexes using the ngram parser.
+
+    Patterns are searched as phrases in boolean mode, which gives
+    substring semantics with the ngram parser.
+    """
+
+    # Default value of ngram_token_size
+    min_length = 2
+
+    def _get_index_name(self, field):
+        return self.quote_name("{}_{}_ft".format(self.table, field))
+
+    def get_create_statements(self):
+        return [
+            "CREATE FULLTEXT INDEX {} ON {} ({}) WITH PARSER ngram".format(
+                self._get_index_name(field), self.quote_name(self.table),
+                self.quote_name(field))
+            for field in SEARCH_FIELDS
+        ]
+
+    def get_drop_statements(self):
+        return [
+            "DROP INDEX {} ON {}".format(
+                self._get_index_name(field), self.quote_name(self.table))
+            for field in SEARCH_FIELDS
+        ]
+
+    def _filter(self, queryset, fields, pattern):
+        phrase = '"{}"'.format(pattern.replace('"', " "))
+        where = " OR ".join(
+            "MATCH ({}) AGAINST (%s IN BOOLEAN MODE)".format(
+                self.quote_name(field))
+            for field in fields
+        )
+        return queryset.extra(
+            where=["({})".format(where)], params=[phrase] * len(fields))
+
+
+class SQLiteBackend(SearchBackend):
+    """An external content FTS5 table using the trigram tokenizer.
+
+    Triggers keep the FTS table in sync with the summary table.
+    """
+
+    min_length = 3
+
+    def __init__(self, connection):
+        """Constructor."""
+        super(SQLiteBackend, self).__init__(connection)
+        self.fts_table = "{}_fts".format(self.table)
+
+    def _get_trigger_name(self, action):
+        return self.quote_name("{}_{}".format(self.fts_table, action))
+
+    def get_create_statements(self):
+        fts_table = self.quote_name(self.fts_table)
+        table = self.quote_name(self.table)
+        columns = ", ".join(
+            self.quote_name(field) for field in SEARCH_FIELDS)
+        new_values = ", ".join(
+            "new.{}".format(self.quote_name(field)) for field in SEARCH_FIELDS)
+        old_values = ", ".join(
+            "old.{}".format(self.quote_name(field)) for field in SEARCH_FIELDS)
+        insert = (
+            "INSERT INTO {0} (rowid, {1}) VALUES (new.id, {2});"
+            .format(fts_table, columns, new_values)
+        )
+        delete = (
+            "INSERT INTO {0} ({0}, rowid, {1}) "
+            "VALUES ('delete', old.id, {2});"
+            .format(fts_table, columns, old_values)
+        )
+        return [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({}, "
+            "content={}, content_rowid='id', tokenize='trigram')".format(
+                fts_table, columns, self.quote_name(self.table)),
+            "CREATE TRIGGER IF NOT EXISTS {} AFTER INSERT ON {} "
+            "BEGIN {} END".format(
+                self._get_trigger_name("insert"), table, insert),
+            "CREATE TRIGGER IF NOT EXISTS {} AFTER DELETE ON {} "
+            "BEGIN {} END".format(
+                self._get_trigger_name("delete"), table, delete),
+            "CREATE TRIGGER IF NOT EXISTS {} AFTER UPDATE OF {} ON {} "
+            "BEGIN {} {} END".format(
+                self._get_trigger_name("update"), columns, table, delete,
+                insert),
+            "INSERT INTO {0} ({0}) VALUES ('rebuild')".format(fts_table),
+        ]
+
+    def get_drop_statements(self):
+        statements = [
+            "DROP TRIGGER IF EXISTS {}".format(self._get_trigger_name(action))
+            for action in ["insert", "delete", "update"]
+        ]
+        statements.append(
+            "DROP TABLE IF EXISTS {}".format(self.quote_name(self.fts_table)))
+        return statements
+
+    def _filter(self, queryset, fields, pattern):
+        query = '{{{}}}: "{}"'.format(
+            " ".join(fields), pattern.replace('"', '""'))
+        return queryset.extra(
+            where=["id IN (SELECT rowid FROM {0} WHERE {0} MATCH %s)".format(
+                self.quote_name(self.fts_table))],
+            params=[query]
+        )
+
+
+BACKENDS = {
+    "postgresql": PostgreSQLBackend,
+    "mysql": MySQLBackend,
+    "sqlite": SQLiteBackend,
+}
+
+
+def get_backend(indexed=None):
+    """Return the search backend to use.
+
+    :param bool indexed: use the backend matching the database engine
+                         (defaults to the AMAVIS_SEARCH_INDEX setting)
+    """
+    connection = connections["amavis"]
+    if indexed is None:
+        indexed = getattr(settings, "AMAVIS_SEARCH_INDEX", False)
+    if not indexed:
+        return SearchBackend(connection)
+    return BACKENDS.get(connection.vendor, SearchBackend)(connection)
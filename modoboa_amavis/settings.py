@@ -17,3 +17,28 @@ def apply(settings):
 
     settings["AMAVIS_DEFAULT_DATABASE_ENCODING"] = "LATIN1"
     # settings["SA_LOOKUP_PATH"] = ("/usr/bin", )
+    # settings["AMAVIS_CACHE"] = "default"
+    # settings["AMAVIS_RECIPIENT_IDS_CACHE_TIMEOUT"] = 3600
+    # settings["AMAVIS_RENDERED_CACHE"] = None
+    # settings["AMAVIS_RENDERED_CACHE_SIZE"] = 8 * 1024 * 1024
+    # settings["AMAVIS_RENDERED_CACHE_TIMEOUT"] = 600
+    # settings["AMAVIS_PREVIEW_MAX_SIZE"] = 1024 * 1024
+    # settings["AMAVIS_PREVIEW_MAX_TIME"] = 2
+    # settings["AMAVIS_RELEASE_WORKERS"] = 4
+    # settings["AMAVIS_RELEASE_TIMEOUT"] = 10
+    # settings["AMAVIS_SPAMD_WORKERS"] = 4
+    # settings["AMAVIS_SPAMD_TIMEOUT"] = 30
+    # settings["AMAVIS_QUARANTINE_SUMMARY"] = False
+    # settings["AMAVIS_QUARANTINE_SUMMARY_OVERLAP"] = 600
+    # settings["AMAVIS_SEARCH_INDEX"] = False
+    # settings["AMAVIS_BODY_INDEX"] = False
+    # settings["AMAVIS_BODY_INDEX_MAX_SIZE"] = 1024 * 1024
+    # settings["AMAVIS_CLEANUP_BATCH_SIZE"] = 1000
+    # settings["AMAVIS_CLEANUP_RATE"] = 500
+    # settings["AMAVIS_CLEANUP_INTERVAL"] = 60
+    # settings["AMAVIS_CLEANUP_SWEEP_BATCHES"] = 10
+    # settings["AMAVIS_CLEANUP_SWEEP_MARGIN"] = 1000
+    # settings["AMAVIS_PARTITIONS"] = False
+    # settings["AMAVIS_QUARANTINE_BUDGET"] = None
+    # settings["AMAVIS_EVICTION_ORDER"] = "oldest"
+    # settings["AMAVIS_RETENTION_RULES"] = []
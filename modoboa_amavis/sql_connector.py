@@ -5,16 +5,21 @@
 from __future__ import unicode_literals
 
 import datetime
+import io
 
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import F, Max, Q
 from django.utils import six
 
 from modoboa.admin.models import Domain
 from modoboa.lib.email_utils import decode
 
+from . import body_index, cache, partitions, search, summary
 from .lib import cleanup_email_address, make_query_args
-from .models import Maddr, Msgrcpt, Quarantine
-from .utils import ConvertFrom, fix_utf8_encoding, smart_bytes, smart_text
+from .models import Maddr, Msgrcpt, Quarantine, QuarantineSummary
+from .utils import (
+    ChunkReader, ConvertFrom, fix_utf8_encoding, smart_bytes, smart_text
+)
 
 
 def reverse_domain_names(domains):
@@ -43,16 +48,70 @@ class SQLconnector(object):
         "mail__subject",
         "mail__mail_id",
         "mail__time_num",
+        "rid_id",
     ]
 
+    # Same as above, when the summary table is used
+    SUMMARY_ORDER_TRANSLATION_TABLE = {
+        "type": "content",
+        "score": "bspam_level",
+        "date": "time_num",
+        "subject": "subject",
+        "from": "from_addr",
+        "to": "email"
+    }
+
+    SUMMARY_FIELDS = [
+        "content",
+        "bspam_level",
+        "rs",
+        "email",
+        "from_addr",
+        "subject",
+        "mail_id",
+        "time_num",
+        "rid",
+    ]
+
+    # Summary table fields corresponding to search criteria
+    SEARCH_FIELDS_TRANSLATION_TABLE = {
+        "from_addr": "from_addr",
+        "subject": "subject",
+        "to": "email"
+    }
+
+    # Sort columns which may contain NULL values. NULLs are always
+    # sorted last so seek predicates can handle them.
+    NULLABLE_ORDER_FIELDS = ["bspam_level"]
+
+    # Columns appended to every ordering so it is total, which is required
+    # by seek pagination. Each entry is (filter/order field, values() key).
+    SEEK_TIEBREAKERS = [
+        ("mail_id", "mail__mail_id"),
+        ("rid_id", "rid_id"),
+    ]
+
+    SUMMARY_SEEK_TIEBREAKERS = [
+        ("mail_id", "mail_id"),
+        ("rid", "rid"),
+    ]
+
+    # Maximum number of (mail_id, rid) pairs updated by a single query
+    BULK_UPDATE_SIZE = 250
+
     def __init__(self, user=None, navparams=None):
         """Constructor."""
         self.user = user
         self.navparams = navparams
         self.messages = None
+        self.use_summary = summary.is_enabled()
+
+        self.last_cursor = None
+        self.count_is_exact = True
 
         self._messages_count = None
         self._annotations = {}
+        self._ordering = []
 
     def _exec(self, query, args):
         """Execute a raw SQL query.
@@ -66,35 +125,109 @@ class SQLconnector(object):
             cursor = connections["amavis"].cursor()
             cursor.execute(query, args)
 
-    def _apply_msgrcpt_simpleuser_filter(self, flt):
-        """Apply specific filter for simple users."""
-        if "str_email" not in self._annotations:
-            self._annotations["str_email"] = ConvertFrom("rid__email")
+    def get_recipient_ids(self, addresses, min_id=None):
+        """Return the ids of the Maddr records matching :kw:`addresses`.
 
-        rcpts = [self.user.email]
-        if hasattr(self.user, "mailbox"):
-            rcpts += self.user.mailbox.alias_addresses
+        Addresses using a recipient delimiter extension are also
+        matched. maddr.email is a binary column (bytea on PostgreSQL),
+        on which LIKE lookups would compare a textual representation, so
+        only equality and range predicates are sent to the database (the
+        email index can serve both). The domain of extended addresses is
+        then checked here.
 
-        query_rcpts = []
-        for rcpt in rcpts:
-            query_rcpts += make_query_args(rcpt, exact_extension=False,
-                                           wildcard=".*")
+        :param list addresses: list of email addresses
+        :param int min_id: only look at records with a greater id
+        :return: a list of ids
+        """
+        wildcard = ".*"
+        exact_args = set()
+        extensions = set()
+        for address in addresses:
+            for arg in make_query_args(address, exact_extension=False,
+                                       wildcard=wildcard):
+                if wildcard + "@" not in arg:
+                    exact_args.add(arg)
+                    continue
+                prefix, domain = arg.rsplit(wildcard + "@", 1)
+                extensions.add((prefix, "@" + domain))
+        flt = Q(email__in=sorted(exact_args)) if exact_args else None
+        for prefix, suffix in extensions:
+            # Every value starting with prefix
+            nfilter = Q(
+                email__gte=prefix,
+                email__lt=prefix[:-1] + six.unichr(ord(prefix[-1]) + 1))
+            flt = nfilter if flt is None else flt | nfilter
+        if flt is None:
+            return []
+        if min_id is not None:
+            flt &= Q(id__gt=min_id)
+        result = []
+        for rid, email in Maddr.objects.filter(flt).values_list("id", "email"):
+            email = smart_text(email)
+            if email in exact_args or any(
+                    email.startswith(prefix) and email.endswith(suffix)
+                    for prefix, suffix in extensions):
+                result.append(rid)
+        return result
+
+    def _get_simpleuser_recipient_ids(self):
+        """Return the recipient ids of the current simple user.
+
+        The result is cached along with the highest maddr id known at
+        that time, so later calls only look at newer maddr records.
+        Cache entries are invalidated by admin signal handlers.
+        """
+        entry = cache.get_user_recipient_ids(self.user.pk)
+        last_id = Maddr.objects.aggregate(last_id=Max("id"))["last_id"] or 0
+        if entry is None:
+            rcpts = [self.user.email]
+            if hasattr(self.user, "mailbox"):
+                rcpts += self.user.mailbox.alias_addresses
+            entry = {
+                "addresses": rcpts,
+                "ids": self.get_recipient_ids(rcpts),
+                "last_id": last_id
+            }
+        elif last_id > entry["last_id"]:
+            entry["ids"] = sorted(set(entry["ids"]) | set(
+                self.get_recipient_ids(
+                    entry["addresses"], min_id=entry["last_id"])))
+            entry["last_id"] = last_id
+        else:
+            return entry["ids"]
+        cache.set_user_recipient_ids(self.user.pk, entry)
+        return entry["ids"]
 
-        re = "(%s)" % "|".join(query_rcpts)
-        return flt & Q(str_email__regex=re)
+    def _apply_msgrcpt_simpleuser_filter(self, flt):
+        """Apply specific filter for simple users."""
+        return flt & Q(rid_id__in=self._get_simpleuser_recipient_ids())
 
-    def _apply_msgrcpt_filters(self, flt):
+    def _apply_msgrcpt_filters(self, flt, rid_field="rid_id",
+                               domain_field="rid__domain"):
         """Apply filters based on user's role."""
         if self.user.role == "SimpleUsers":
-            flt = self._apply_msgrcpt_simpleuser_filter(flt)
+            if rid_field == "rid_id":
+                return self._apply_msgrcpt_simpleuser_filter(flt)
+            flt &= Q(**{"{}__in".format(rid_field):
+                        self._get_simpleuser_recipient_ids()})
         elif not self.user.is_superuser:
             doms = Domain.objects.get_for_admin(
                 self.user).values_list("name", flat=True)
-            flt &= Q(rid__domain__in=reverse_domain_names(doms))
+            flt &= Q(**{"{}__in".format(domain_field):
+                        reverse_domain_names(doms)})
         return flt
 
-    def _get_quarantine_content(self):
-        """Fetch quarantine content.
+    def _get_search_criteria(self):
+        """Return the list of criteria to search the pattern with."""
+        if not self.navparams.get("pattern"):
+            return []
+        criteria = self.navparams.get("criteria") or ""
+        if criteria == "both":
+            criteria = "from_addr,subject,to"
+        return criteria.split(",")
+
+    def _get_base_filter(self, **kwargs):
+        """Return the filter shared by both sources of quarantine content.
 
         Filters: rs, rid, content
         """
@@ -102,37 +235,74 @@ class SQLconnector(object):
             Q(rs__in=[" ", "V", "R", "p", "S", "H"])
             if self.navparams.get("viewrequests", "0") != "1" else Q(rs="p")
         )
-        flt = self._apply_msgrcpt_filters(flt)
-        pattern = self.navparams.get("pattern", "")
-        if pattern:
-            criteria = self.navparams.get("criteria")
-            if criteria == "both":
-                criteria = "from_addr,subject,to"
-            search_flt = None
-            for crit in criteria.split(","):
-                if crit == "from_addr":
-                    nfilter = Q(mail__from_addr__icontains=pattern)
-                elif crit == "subject":
-                    nfilter = Q(mail__subject__icontains=pattern)
-                elif crit == "to":
-                    if "str_email" not in self._annotations:
-                        self._annotations["str_email"] = ConvertFrom(
-                            "rid__email")
-                    nfilter = Q(str_email__icontains=pattern)
-                else:
-                    continue
-                search_flt = (
-                    nfilter if search_flt is None else search_flt | nfilter
-                )
-            if search_flt:
-                flt &= search_flt
+        flt = self._apply_msgrcpt_filters(flt, **kwargs)
         msgtype = self.navparams.get("msgtype", None)
         if msgtype is not None:
             flt &= Q(content=msgtype)
+        return flt
+
+    def _get_summary_content(self):
+        """Fetch quarantine content from the summary table.
 
+        Searches are delegated to a search backend, which may use an
+        index.
+        """
+        flt = self._get_base_filter(rid_field="rid", domain_field="domain")
+        qset = QuarantineSummary.objects.filter(flt)
+        criteria = self._get_search_criteria()
+        pattern = self.navparams.get("pattern", "")
+        fields = [
+            self.SEARCH_FIELDS_TRANSLATION_TABLE[crit] for crit in criteria
+            if crit in self.SEARCH_FIELDS_TRANSLATION_TABLE
+        ]
+        backend = search.get_backend()
+        if "body" not in criteria or not body_index.is_enabled():
+            return backend.filter(qset, fields, pattern)
+        body_flt = Q(
+            mail_id__in=body_index.get_matching_mail_ids(pattern))
+        if fields:
+            body_flt |= Q(id__in=backend.filter(
+                QuarantineSummary.objects.all(), fields, pattern
+            ).values("id"))
+        return qset.filter(body_flt)
+
+    def _get_quarantine_content(self):
+        """Fetch quarantine content."""
+        if self.use_summary:
+            return self._get_summary_content()
+        flt = self._get_base_filter()
+        pattern = self.navparams.get("pattern", "")
+        search_flt = None
+        for crit in self._get_search_criteria():
+            if crit == "from_addr":
+                nfilter = Q(mail__from_addr__icontains=pattern)
+            elif crit == "subject":
+                nfilter = Q(mail__subject__icontains=pattern)
+            elif crit == "to":
+                if "str_email" not in self._annotations:
+                    self._annotations["str_email"] = ConvertFrom(
+                        "rid__email")
+                nfilter = Q(str_email__icontains=pattern)
+            elif crit == "body" and body_index.is_enabled():
+                # Indexed ids are text while msgrcpt.mail_id is binary
+                if "str_mail_id" not in self._annotations:
+                    self._annotations["str_mail_id"] = ConvertFrom("mail_id")
+                nfilter = Q(
+                    str_mail_id__in=body_index.get_matching_mail_ids(pattern))
+            else:
+                continue
+            search_flt = (
+                nfilter if search_flt is None else search_flt | nfilter
+            )
+        if search_flt:
+            flt &= search_flt
         flt &= Q(
             mail__in=Quarantine.objects.filter(chunk_ind=1).values("mail_id")
         )
+        if partitions.is_enabled():
+            # amavis keys are (partition_tag, mail_id): join on both so
+            # rows of other partitions sharing a mail_id are not mixed.
+            flt &= Q(mail__partition_tag=F("partition_tag"))
 
         return (
             Msgrcpt.objects
@@ -141,48 +311,144 @@ class SQLconnector(object):
             .filter(flt)
         )
 
-    def messages_count(self):
+    def messages_count(self, limit=None):
         """Return the total number of messages living in the quarantine.
 
+        Rows are counted by the database. If :kw:`limit` is set,
+        counting stops once :kw:`limit` rows have been found and
+        :attr:`count_is_exact` is set to False.
+
         We also store the built queryset for a later use.
         """
         if self.user is None or self.navparams is None:
             return None
         if self._messages_count is None:
             self.messages = self._get_quarantine_content()
-            self.messages = self.messages.values(*self.QUARANTINE_FIELDS)
+            self.messages = self.messages.values(
+                *(self.SUMMARY_FIELDS if self.use_summary
+                  else self.QUARANTINE_FIELDS))
+
+            self._ordering = self._get_ordering()
+            self.messages = self.messages.order_by(*[
+                self._get_order_by(field, desc)
+                for field, key, desc in self._ordering
+            ])
+
+            if limit:
+                self._messages_count = self.messages[:limit].count()
+                self.count_is_exact = self._messages_count < limit
+            else:
+                self._messages_count = self.messages.count()
+                self.count_is_exact = True
 
-            order = self.navparams.get("order")
-            if order is not None:
-                sign = ""
-                if order[0] == "-":
-                    sign = "-"
-                    order = order[1:]
-                order = self.ORDER_TRANSLATION_TABLE[order]
-                self.messages = self.messages.order_by(sign + order)
+        return self._messages_count
 
-            self._messages_count = len(self.messages)
+    def _get_ordering(self):
+        """Return the ordering to apply to the quarantine content.
 
-        return self._messages_count
+        :return: a list of (field, values() key, descending) tuples
+        """
+        if self.use_summary:
+            translation_table = self.SUMMARY_ORDER_TRANSLATION_TABLE
+            tiebreakers = self.SUMMARY_SEEK_TIEBREAKERS
+        else:
+            translation_table = self.ORDER_TRANSLATION_TABLE
+            tiebreakers = self.SEEK_TIEBREAKERS
+        ordering = []
+        desc = False
+        order = self.navparams.get("order")
+        if order is not None:
+            desc = order[0] == "-"
+            field = translation_table[order.lstrip("-")]
+            ordering.append((field, field, desc))
+        ordering += [(field, key, desc) for field, key in tiebreakers]
+        return ordering
+
+    def _get_order_by(self, field, desc):
+        """Return the order_by() argument for :kw:`field`."""
+        if field in self.NULLABLE_ORDER_FIELDS:
+            expression = F(field)
+            return (
+                expression.desc(nulls_last=True) if desc
+                else expression.asc(nulls_last=True)
+            )
+        return "-" + field if desc else field
+
+    def _make_cursor(self, row):
+        """Build a seek cursor pointing at :kw:`row`.
+
+        :return: a tuple
+        """
+        return tuple(row[key] for field, key, desc in self._ordering)
 
-    def fetch(self, start=None, stop=None):
-        """Fetch a range of messages from the internal cache."""
+    def _get_seek_filter(self, cursor):
+        """Return a filter selecting rows located after :kw:`cursor`.
+
+        For an ordering (a, b, c), the result is equivalent to the row
+        value comparison (a, b, c) > (va, vb, vc), expanded so that
+        every backend can use an index on the leading column. NULL
+        values are sorted last (see :meth:`_get_order_by`).
+        """
+        flt = None
+        equal_flt = Q()
+        for (field, key, desc), value in zip(self._ordering, cursor):
+            if value is None:
+                # Nothing sorts after NULL except other NULLs.
+                equal_flt &= Q(**{"{}__isnull".format(field): True})
+                continue
+            lookup = "lt" if desc else "gt"
+            nfilter = Q(**{"{}__{}".format(field, lookup): value})
+            if field in self.NULLABLE_ORDER_FIELDS:
+                nfilter |= Q(**{"{}__isnull".format(field): True})
+            nfilter = equal_flt & nfilter
+            flt = nfilter if flt is None else flt | nfilter
+            equal_flt &= Q(**{field: value})
+        return flt
+
+    def fetch(self, start=None, stop=None, cursor=None):
+        """Fetch a range of messages from the internal cache.
+
+        If :kw:`cursor` is provided (see :attr:`last_cursor`), rows
+        following it are located using a seek predicate instead of an
+        offset, so fetching a page costs the same whatever its position
+        is.
+        """
+        if cursor is not None:
+            rows = self.messages.filter(
+                self._get_seek_filter(cursor))[:stop - start + 1]
+        else:
+            rows = self.messages[start - 1:stop]
         emails = []
-        for qm in self.messages[start - 1:stop]:
+        self.last_cursor = None
+        for qm in rows:
+            self.last_cursor = self._make_cursor(qm)
             if qm["rs"] == "D":
                 continue
-            m = {
-                "from": cleanup_email_address(
-                    fix_utf8_encoding(qm["mail__from_addr"])
-                ),
-                "to": smart_bytes(qm["rid__email"]),
-                "subject": fix_utf8_encoding(qm["mail__subject"]),
-                "mailid": smart_bytes(qm["mail__mail_id"]),
-                "date": datetime.datetime.fromtimestamp(qm["mail__time_num"]),
+            if self.use_summary:
+                # Values are already decoded
+                m = {
+                    "from": qm["from_addr"],
+                    "to": smart_bytes(qm["email"]),
+                    "subject": qm["subject"],
+                    "mailid": smart_bytes(qm["mail_id"]),
+                    "date": datetime.datetime.fromtimestamp(qm["time_num"]),
+                }
+            else:
+                m = {
+                    "from": cleanup_email_address(
+                        fix_utf8_encoding(qm["mail__from_addr"])
+                    ),
+                    "to": smart_bytes(qm["rid__email"]),
+                    "subject": fix_utf8_encoding(qm["mail__subject"]),
+                    "mailid": smart_bytes(qm["mail__mail_id"]),
+                    "date": datetime.datetime.fromtimestamp(
+                        qm["mail__time_num"]),
+                }
+            m.update({
                 "type": qm["content"],
                 "score": qm["bspam_level"],
                 "status": qm["rs"]
-            }
+            })
             if qm["rs"] in ["", " "]:
                 m["class"] = "unseen"
             elif qm["rs"] == "p":
@@ -214,6 +480,41 @@ class SQLconnector(object):
             "UPDATE msgrcpt SET rs=%s WHERE mail_id=%s AND rid=%s",
             [status, mailid, addr.id]
         )
+        if self.use_summary:
+            summary.set_status([(mailid, addr.id)], status)
+
+    def set_msgrcpts_status(self, items):
+        """Change the status (rs field) of several message recipients.
+
+        Addresses are resolved using a single query, then rows are
+        updated using one query per status and batch, inside a single
+        transaction.
+
+        :param list items: list of (address, mail_id, status) tuples
+        """
+        addresses = set(address for address, mailid, status in items)
+        if not addresses:
+            return
+        rids = {}
+        qset = Maddr.objects\
+            .annotate(str_email=ConvertFrom("email"))\
+            .filter(str_email__in=addresses)\
+            .values_list("str_email", "id")
+        for email, rid in qset:
+            rids.setdefault(smart_text(email), []).append(rid)
+        updates = {}
+        for address, mailid, status in items:
+            for rid in rids.get(address, []):
+                updates.setdefault(status, []).append((mailid, rid))
+        with transaction.atomic(using="amavis"):
+            for status, pairs in updates.items():
+                for pos in range(0, len(pairs), self.BULK_UPDATE_SIZE):
+                    flt = Q()
+                    for mailid, rid in pairs[pos:pos + self.BULK_UPDATE_SIZE]:
+                        flt |= Q(mail_id=mailid, rid_id=rid)
+                    Msgrcpt.objects.filter(flt).update(rs=status)
+                if self.use_summary:
+                    summary.set_status(pairs, status)
 
     def get_domains_pending_requests(self, domains):
         """Retrieve pending release requests for a list of domains."""
@@ -232,15 +533,68 @@ class SQLconnector(object):
             rq &= doms_q
         return Msgrcpt.objects.filter(rq).count()
 
+    def iter_mail_chunks(self, mailid, batch_size=None):
+        """Iterate over the raw chunks of a message, in order.
+
+        Chunks are returned as stored by the database driver (bytes or
+        memoryview), without any copy. On PostgreSQL, rows are read
+        through a server-side cursor.
+
+        When only the beginning of a message is needed, set batch_size
+        to fetch chunks a few at a time, using separate queries.
+        """
+        qset = Quarantine.objects.filter(mail=smart_bytes(mailid)) \
+            .order_by("chunk_ind").values_list("chunk_ind", "mail_text")
+        if batch_size is None:
+            return (mail_text for chunk_ind, mail_text in qset.iterator())
+        return self._iter_mail_chunk_batches(qset, batch_size)
+
+    def _iter_mail_chunk_batches(self, qset, batch_size):
+        """Fetch chunks by batches."""
+        chunk_ind = None
+        while True:
+            batch = qset
+            if chunk_ind is not None:
+                batch = batch.filter(chunk_ind__gt=chunk_ind)
+            rows = list(batch[:batch_size])
+            for chunk_ind, mail_text in rows:
+                yield mail_text
+            if len(rows) < batch_size:
+                return
+
+    def get_mail_file(self, mailid):
+        """Return a read-only file-like object over a message.
+
+        Chunks are fetched while the file is read.
+        """
+        return io.BufferedReader(ChunkReader(self.iter_mail_chunks(mailid)))
+
+    def get_raw_mail_content(self, mailid):
+        """Retrieve the content of a message, as bytes."""
+        return b"".join(self.iter_mail_chunks(mailid))
+
+    def get_mail_headers(self, mailid):
+        """Retrieve the header section of a message.
+
+        Chunks are fetched one by one until the end of the headers is
+        reached, so the body is never read.
+        """
+        mailfile = io.BufferedReader(
+            ChunkReader(self.iter_mail_chunks(mailid, batch_size=1)))
+        lines = []
+        for line in mailfile:
+            if not line.strip():
+                break
+            lines.append(line)
+        return decode(
+            b"".join(lines), "utf-8",
+            append_to_error=("; mail_id=%s" % smart_text(mailid))
+        )
+
     def get_mail_content(self, mailid):
         """Retrieve the content of a message."""
-        content_bytes = smart_bytes("").join([
-            smart_bytes(qmail.mail_text)
-            for qmail in Quarantine.objects.filter(
-                mail=smart_bytes(mailid))
-        ])
         content = decode(
-            content_bytes, "utf-8",
+            self.get_raw_mail_content(mailid), "utf-8",
             append_to_error=("; mail_id=%s" % smart_text(mailid))
         )
         return content
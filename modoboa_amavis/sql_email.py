@@ -6,25 +6,44 @@ An email representation based on a database record.
 
 from __future__ import unicode_literals
 
+import time
+from email.parser import Parser
+
 from html2text import HTML2Text
 
+from django.conf import settings
 from django.template.loader import render_to_string
 
 from modoboa.lib.email_utils import Email
 from .sql_connector import SQLconnector
-from .utils import fix_utf8_encoding, smart_text
+from .utils import fix_utf8_encoding, smart_bytes, smart_str, smart_text
+
+try:
+    from email.feedparser import BytesFeedParser as FeedParser
+except ImportError:  # Python 2
+    from email.feedparser import FeedParser
 
 
 class SQLemail(Email):
 
-    """The SQL version of the Email class."""
+    """The SQL version of the Email class.
+
+    Unless *full* is True, only a preview of the message is built: the
+    message is parsed incrementally until a size or time budget is
+    exhausted (see AMAVIS_PREVIEW_MAX_SIZE and AMAVIS_PREVIEW_MAX_TIME),
+    attachments are skipped and only the displayed part is decoded. The
+    *truncated* attribute tells if the message was cut.
+    """
 
     def __init__(self, *args, **kwargs):
+        self.full = kwargs.pop("full", False)
         super(SQLemail, self).__init__(*args, **kwargs)
         self.qtype = ""
         self.qreason = ""
+        self.truncated = False
+        self._header_msg = None
 
-        qreason = self.msg["X-Amavis-Alert"]
+        qreason = self.header_msg["X-Amavis-Alert"]
         if qreason:
             if "," in qreason:
                 self.qtype, qreason = qreason.split(",", 1)
@@ -39,6 +58,96 @@ class SQLemail(Email):
     def _fetch_message(self):
         return SQLconnector().get_mail_content(self.mailid)
 
+    def _fetch_headers(self):
+        return SQLconnector().get_mail_headers(self.mailid)
+
+    def _fetch_chunks(self):
+        return SQLconnector().iter_mail_chunks(self.mailid)
+
+    def _parse_preview(self):
+        """Parse the beginning of the message.
+
+        Chunks are fed to the parser until the size or time budget is
+        exhausted.
+        """
+        max_size = getattr(settings, "AMAVIS_PREVIEW_MAX_SIZE", 1024 * 1024)
+        deadline = time.time() + getattr(
+            settings, "AMAVIS_PREVIEW_MAX_TIME", 2)
+        parser = FeedParser()
+        size = 0
+        chunks = iter(self._fetch_chunks())
+        for chunk in chunks:
+            chunk = smart_bytes(chunk)
+            if size + len(chunk) > max_size:
+                chunk = chunk[:max_size - size]
+                self.truncated = True
+            parser.feed(chunk)
+            size += len(chunk)
+            if self.truncated:
+                break
+            if time.time() > deadline:
+                self.truncated = next(chunks, None) is not None
+                break
+        return parser.close()
+
+    @property
+    def msg(self):
+        if self._msg is None and not self.full:
+            self._msg = self._parse_preview()
+        return super(SQLemail, self).msg
+
+    def _parse_multipart(self, msg, level=0):
+        """Decode the displayed part only, skipping attachments."""
+        if self.full:
+            return super(SQLemail, self)._parse_multipart(msg, level)
+        level += 1
+        parts = {"plain": [], "html": [], "image": []}
+        for part in msg.walk():
+            if part.is_multipart() or \
+               "attachment" in part.get("Content-Disposition", ""):
+                continue
+            if part.get_content_maintype() == "image":
+                parts["image"].append(part)
+            elif part.get_content_type() in ["text/plain", "text/html"]:
+                parts[part.get_content_subtype()].append(part)
+        if self.dformat == "html" or not parts["plain"]:
+            displayed = "html"
+        else:
+            displayed = "plain"
+        for part in parts[displayed]:
+            self._parse_text(part, level=level)
+        if displayed == "html" and self.links:
+            for part in parts["image"]:
+                self._parse_inline_image(part, level=level)
+
+    @property
+    def header_msg(self):
+        """A message containing headers only.
+
+        If the full message has not been loaded yet, only its header
+        section is fetched and parsed.
+        """
+        if self._msg is not None and self.full:
+            return self._msg
+        if self._header_msg is None:
+            headers = smart_str(self._fetch_headers(), errors="replace")
+            self._header_msg = Parser().parsestr(headers, headersonly=True)
+        return self._header_msg
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._headers = [
+                {"name": header,
+                 "value": self.get_header(self.header_msg, header)}
+                for header in self._basic_headers
+            ]
+        return self._headers
+
+    @headers.setter
+    def headers(self, value):
+        self._headers = value
+
     @property
     def body(self):
         if self._body is None:
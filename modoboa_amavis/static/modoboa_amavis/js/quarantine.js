@@ -117,6 +117,34 @@ Quarantine.prototype = {
         this.navobj.delparam("rcpt").update();
     },
 
+    /**
+     * A new page has been received: inject it and update the total.
+     *
+     * @this Quarantine
+     * @param {Object} data - page content
+     * @param {string} direction - scroll direction (up or down)
+     */
+    add_new_page: function(data, direction) {
+        Listing.prototype.add_new_page.apply(this, arguments);
+        this.update_total(data);
+    },
+
+    /**
+     * Display the number of messages, flagged when it is capped.
+     *
+     * @param {Object} data - listing content
+     */
+    update_total: function(data) {
+        var $total = $("#listing_total");
+
+        if (data.total === undefined) {
+            return;
+        }
+        $total.text(data.total);
+        $total.attr(
+            "title", data.count_is_exact ? "" : $total.data("capped-title"));
+    },
+
     /**
      * Return extra arguments used to fetch a page.
      *
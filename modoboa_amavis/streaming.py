@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""Streaming tools for quarantined messages.
+
+Messages are read line by line from a file-like object (see
+SQLconnector.get_mail_file) so memory usage does not depend on their
+size.
+"""
+
+from __future__ import unicode_literals
+
+import binascii
+import re
+
+from .utils import smart_bytes
+
+try:
+    from email.parser import BytesHeaderParser as HeaderParser
+except ImportError:  # Python 2
+    from email.parser import HeaderParser
+
+
+def parse_headers(data):
+    """Parse a header section."""
+    parser = HeaderParser()
+    if hasattr(parser, "parsebytes"):
+        return parser.parsebytes(data)
+    return parser.parsestr(data)
+
+
+class MIMEPartReader(object):
+    """Locate and stream a single MIME part of a message.
+
+    Parts are numbered like email.message.Message.walk() does: 0 is the
+    message itself, then every part in order of appearance (multipart
+    containers included). A message/rfc822 part is followed by the
+    message it encloses, then by the parts of that message.
+    """
+
+    MAX_LINE_LENGTH = 65536
+
+    def __init__(self, fp):
+        """Constructor."""
+        self._fp = fp
+        self._boundaries = []
+        self._count = -1
+        self._line_start = True
+        self._pushed_back = None
+
+    def _readline(self):
+        """Read a line (or a piece of a very long line).
+
+        :return: a (line, starts_a_line) tuple
+        """
+        if self._pushed_back is not None:
+            result, self._pushed_back = self._pushed_back, None
+            return result
+        line = self._fp.readline(self.MAX_LINE_LENGTH)
+        line_start = self._line_start
+        self._line_start = line.endswith(b"\n")
+        return line, line_start
+
+    def _get_boundary(self, line, line_start):
+        """Return the level of the boundary found in line, or None.
+
+        :return: a (level, is_end) tuple or None
+        """
+        if not line_start or not line.startswith(b"--"):
+            return None
+        line = line.rstrip()
+        for level in range(len(self._boundaries) - 1, -1, -1):
+            boundary = b"--" + self._boundaries[level]
+            if line == boundary:
+                return level, False
+            if line == boundary + b"--":
+                return level, True
+        return None
+
+    def _read_headers(self):
+        """Read and parse the headers of the current part."""
+        lines = []
+        while True:
+            line, line_start = self._readline()
+            if not line:
+                break
+            if self._get_boundary(line, line_start) is not None:
+                self._pushed_back = (line, line_start)
+                break
+            if line_start and not line.strip():
+                break
+            lines.append(line)
+        return parse_headers(b"".join(lines))
+
+    def _skip_to_boundary(self):
+        """Skip lines until a boundary of the current level.
+
+        :return: True if a new part starts, False otherwise
+        """
+        level = len(self._boundaries) - 1
+        while True:
+            line, line_start = self._readline()
+            if not line:
+                return False
+            found = self._get_boundary(line, line_start)
+            if found is None:
+                continue
+            if found[0] != level:
+                # Boundary of an enclosing part: the current one is over
+                self._pushed_back = (line, line_start)
+                return False
+            return not found[1]
+
+    def _find(self, index):
+        headers = self._read_headers()
+        self._count += 1
+        if self._count == index:
+            return headers
+        if headers.get_content_type() == "message/rfc822":
+            # The body is a message, ending with the current part
+            return self._find(index)
+        boundary = headers.get_boundary()
+        if headers.get_content_maintype() != "multipart" or not boundary:
+            return None
+        self._boundaries.append(smart_bytes(boundary))
+        while self._skip_to_boundary():
+            found = self._find(index)
+            if found is not None:
+                return found
+        self._boundaries.pop()
+        return None
+
+    def find(self, index):
+        """Move to the body of a part.
+
+        Must be called once, before iter_body().
+
+        :param int index: part number
+        :return: the part headers (an email.message.Message) or None
+        """
+        return self._find(index)
+
+    def iter_body(self):
+        """Iterate over the (still encoded) body of the current part.
+
+        The line break preceding the next boundary belongs to the
+        boundary and is not returned.
+        """
+        previous = None
+        while True:
+            line, line_start = self._readline()
+            if not line:
+                break
+            if self._get_boundary(line, line_start) is not None:
+                if previous is not None:
+                    previous = re.sub(br"\r?\n$", b"", previous)
+                break
+            if previous is not None:
+                yield previous
+            previous = line
+        if previous:
+            yield previous
+
+
+def decode_body(lines, encoding):
+    """Incrementally decode a part body.
+
+    :param lines: an iterable of encoded lines
+    :param str encoding: the value of the Content-Transfer-Encoding header
+    """
+    encoding = (encoding or "").strip().lower()
+    if encoding == "base64":
+        rest = b""
+        for line in lines:
+            data = rest + re.sub(br"[^A-Za-z0-9+/=]", b"", line)
+            size = len(data) // 4 * 4
+            rest = data[size:]
+            if size:
+                yield binascii.a2b_base64(data[:size])
+    elif encoding == "quoted-printable":
+        # Long lines are split: an escape sequence (=XX) or a soft line
+        # break (= followed by a line break) can be cut in two.
+        rest = b""
+        for line in lines:
+            data = rest + line
+            if data.endswith(b"=") or data.endswith(b"=\r"):
+                size = len(data) - (1 if data.endswith(b"=") else 2)
+            elif data[-2:-1] == b"=" and not data.endswith(b"\n"):
+                size = len(data) - 2
+            else:
+                size = len(data)
+            rest = data[size:]
+            if size:
+                yield binascii.a2b_qp(data[:size])
+        if rest:
+            yield binascii.a2b_qp(rest)
+    else:
+        for line in lines:
+            yield line
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""Quarantine summary table maintenance.
+
+Listings normally join msgrcpt, msgs, maddr and quarantine, then decode
+every bytes column. When AMAVIS_QUARANTINE_SUMMARY is enabled, they read
+the QuarantineSummary table instead, which the qsync command fills
+incrementally.
+
+New rows are found using a (time_num, mail_id) watermark: the newest
+message already present in the summary. Since amavis stores messages
+and their content using separate statements, rows received up to
+AMAVIS_QUARANTINE_SUMMARY_OVERLAP seconds before the watermark are
+looked at again.
+"""
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q
+
+from .lib import cleanup_email_address
+from .models import Msgrcpt, Quarantine, QuarantineSummary
+from .utils import fix_utf8_encoding, smart_text
+
+# Maximum number of (mail_id, rid) pairs used by a single query
+BULK_SIZE = 250
+
+
+def is_enabled():
+    """Tell if listings must use the summary table."""
+    return getattr(settings, "AMAVIS_QUARANTINE_SUMMARY", False)
+
+
+def get_overlap():
+    """Return the number of seconds to look at again before watermarks."""
+    return getattr(settings, "AMAVIS_QUARANTINE_SUMMARY_OVERLAP", 600)
+
+
+def get_watermark():
+    """Return the time_num of the newest message in the summary, or None."""
+    return QuarantineSummary.objects.aggregate(
+        time_num=Max("time_num"))["time_num"]
+
+
+def _make_summary(row):
+    """Build a QuarantineSummary instance from a msgrcpt row."""
+    return QuarantineSummary(
+        mail_id=smart_text(row["mail__mail_id"]),
+        rid=row["rid_id"],
+        email=smart_text(row["rid__email"]),
+        domain=smart_text(row["rid__domain"]),
+        from_addr=cleanup_email_address(
+            fix_utf8_encoding(row["mail__from_addr"])),
+        subject=fix_utf8_encoding(row["mail__subject"]),
+        time_num=row["mail__time_num"],
+        content=row["content"],
+        bspam_level=row["bspam_level"],
+        rs=row["rs"],
+    )
+
+
+def _get_pair_filter(pairs, mail_id_field, rid_field):
+    """Return a filter selecting the given (mail_id, rid) pairs."""
+    flt = Q()
+    for mail_id, rid in pairs:
+        flt |= Q(**{mail_id_field: mail_id, rid_field: rid})
+    return flt
+
+
+def _sync_rows(rows):
+    """Insert or update the summary rows of a batch of msgrcpt rows.
+
+    :return: a (created, updated) tuple
+    """
+    rows = {(smart_text(row["mail__mail_id"]), row["rid_id"]): row
+            for row in rows}
+    existing = dict(
+        ((mail_id, rid), rs) for mail_id, rid, rs in
+        QuarantineSummary.objects.filter(
+            _get_pair_filter(rows.keys(), "mail_id", "rid")
+        ).values_list("mail_id", "rid", "rs")
+    )
+    created = [
+        _make_summary(row) for key, row in rows.items()
+        if key not in existing
+    ]
+    updates = {}
+    for key, rs in existing.items():
+        if rows[key]["rs"] != rs:
+            updates.setdefault(rows[key]["rs"], []).append(key)
+    with transaction.atomic(using="amavis"):
+        QuarantineSummary.objects.bulk_create(created)
+        for rs, pairs in updates.items():
+            QuarantineSummary.objects.filter(
+                _get_pair_filter(pairs, "mail_id", "rid")).update(rs=rs)
+    return len(created), sum(len(pairs) for pairs in updates.values())
+
+
+def sync(batch_size=BULK_SIZE, full=False):
+    """Copy new quarantined recipients to the summary table.
+
+    Recipients are read by batches, ordered by (time_num, mail_id, rid),
+    using a seek predicate so each batch costs the same.
+
+    :param int batch_size: number of msgrcpt rows per batch
+    :param bool full: rebuild the summary from scratch
+    :return: a (created, updated) tuple
+    """
+    if full:
+        QuarantineSummary.objects.all().delete()
+    qset = Msgrcpt.objects.filter(
+        mail__in=Quarantine.objects.filter(chunk_ind=1).values("mail_id"))
+    watermark = get_watermark()
+    if watermark is not None:
+        qset = qset.filter(mail__time_num__gte=watermark - get_overlap())
+    qset = qset.values(
+        "mail__mail_id", "mail__time_num", "mail__from_addr",
+        "mail__subject", "rid_id", "rid__email", "rid__domain",
+        "content", "bspam_level", "rs"
+    ).order_by("mail__time_num", "mail_id", "rid_id")
+    created = updated = 0
+    last = None
+    while True:
+        batch = qset
+        if last is not None:
+            time_num, mail_id, rid = last
+            batch = batch.filter(
+                Q(mail__time_num__gt=time_num) |
+                Q(mail__time_num=time_num, mail_id__gt=mail_id) |
+                Q(mail__time_num=time_num, mail_id=mail_id, rid_id__gt=rid)
+            )
+        rows = list(batch[:batch_size])
+        if not rows:
+            break
+        result = _sync_rows(rows)
+        created += result[0]
+        updated += result[1]
+        last = (rows[-1]["mail__time_num"], rows[-1]["mail__mail_id"],
+                rows[-1]["rid_id"])
+        if len(rows) < batch_size:
+            break
+    return created, updated
+
+
+def set_status(pairs, status):
+    """Change the status of summary rows.
+
+    :param list pairs: list of (mail_id, rid) tuples
+    :param str status: new status
+    """
+    pairs = [(smart_text(mail_id), rid) for mail_id, rid in pairs]
+    for pos in range(0, len(pairs), BULK_SIZE):
+        QuarantineSummary.objects.filter(
+            _get_pair_filter(pairs[pos:pos + BULK_SIZE], "mail_id", "rid")
+        ).update(rs=status)
+
+
+def delete_messages(mail_ids):
+    """Remove the summary rows of deleted messages."""
+    mail_ids = [smart_text(mail_id) for mail_id in mail_ids]
+    for pos in range(0, len(mail_ids), BULK_SIZE):
+        QuarantineSummary.objects.filter(
+            mail_id__in=mail_ids[pos:pos + BULK_SIZE]).delete()
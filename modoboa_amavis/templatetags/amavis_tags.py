@@ -12,7 +12,7 @@ from django.urls import reverse
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
 
-from .. import constants, lib
+from .. import body_index, constants, lib
 
 register = template.Library()
 
@@ -118,6 +118,8 @@ def quar_menu(user):
     :return: resulting HTML
     """
     extraopts = [{"name": "to", "label": _("To")}]
+    if body_index.is_enabled():
+        extraopts.append({"name": "body", "label": _("Body")})
     return render_to_string("modoboa_amavis/main_action_bar.html", {
         "extraopts": extraopts,
         "manual_learning": lib.manual_learning_enabled(user),
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""A local stand-in for spamd, to be used by tests."""
+
+from __future__ import unicode_literals
+
+import threading
+
+from six.moves import socketserver
+
+
+class FakeSpamdHandler(socketserver.StreamRequestHandler):
+    """Handle a single TELL request."""
+
+    def handle(self):
+        request_line = self.rfile.readline().strip()
+        headers = {}
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                break
+            name, value = line.split(b":", 1)
+            headers[name.strip().lower()] = value.strip()
+        content = self.rfile.read(int(headers[b"content-length"]))
+        if not request_line.startswith(b"TELL ") or \
+           b"message-class" not in headers:
+            self.wfile.write(b"SPAMD/1.1 76 Bad header line\r\n\r\n")
+            return
+        if b"X-Spamd-Error" in content:
+            self.wfile.write(b"SPAMD/1.1 74 EX_IOERR\r\n\r\n")
+            return
+        with self.server.lock:
+            self.server.learnt.append(
+                (headers[b"user"], headers[b"message-class"], content))
+        self.wfile.write(
+            b"SPAMD/1.1 0 EX_OK\r\nDidSet: local\r\n\r\n")
+
+
+class FakeSpamd(socketserver.ThreadingTCPServer):
+    """A fake spamd server listening on a random local port.
+
+    Learnt messages are recorded into the *learnt* attribute as
+    (username, class, content) tuples.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        """Constructor."""
+        socketserver.ThreadingTCPServer.__init__(
+            self, ("127.0.0.1", 0), FakeSpamdHandler)
+        self.learnt = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        """Start serving requests in a separate thread."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the server."""
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for body_index."""
+
+from __future__ import unicode_literals
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+
+from modoboa.core import models as core_models
+from modoboa.lib.tests import ModoTestCase
+from .. import body_index, factories, models, summary
+from ..sql_connector import SQLconnector
+from ..utils import smart_bytes, smart_text
+
+MESSAGE = """Subject: Offer
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="mixed"
+
+--mixed
+Content-Type: multipart/alternative; boundary="alt"
+
+--alt
+Content-Type: text/plain; charset=utf-8
+
+Buy {word} now
+--alt
+Content-Type: text/html; charset=iso-8859-1
+Content-Transfer-Encoding: quoted-printable
+
+<p><a href=3D"http://evil.corp/{word}">Caf=E9</a></p>
+--alt--
+--mixed
+Content-Type: text/plain; charset=utf-8
+Content-Disposition: attachment; filename="notes.txt"
+
+Attached notes
+--mixed--
+"""
+
+
+class TokenizeTestCase(SimpleTestCase):
+    """Tests for text extraction."""
+
+    def test_tokenize(self):
+        self.assertEqual(
+            body_index.tokenize("Visit http://Evil.corp/ a b ça"),
+            set(["visit", "http", "evil", "corp", "ça"]))
+        self.assertEqual(
+            body_index.tokenize("x" * 100), set(["x" * 64]))
+
+    def test_extract_text(self):
+        texts = body_index.extract_text(
+            [smart_bytes(MESSAGE.format(word="pills"))])
+        self.assertEqual(len(texts), 2)
+        self.assertIn("Buy pills now", texts[0])
+        self.assertIn("Café", texts[1])
+        self.assertIn("http://evil.corp/pills", texts[1])
+
+        content = smart_bytes(MESSAGE.format(word="pills"))
+        chunks = [content[pos:pos + 50] for pos in range(0, len(content), 50)]
+        texts = body_index.extract_text(chunks, max_size=50)
+        self.assertEqual(texts, [])
+
+
+@override_settings(AMAVIS_BODY_INDEX=True)
+class BodyIndexTestCase(ModoTestCase):
+    """Tests for body searches."""
+
+    multi_db = True
+
+    @classmethod
+    def setUpTestData(cls):  # NOQA:N802
+        """Create test data."""
+        super(BodyIndexTestCase, cls).setUpTestData()
+        cls.admin = core_models.User.objects.get(username="admin")
+
+    def _create_message(self, rcpt, word):
+        msgrcpt = factories.create_spam(rcpt)
+        models.Quarantine.objects.filter(mail=msgrcpt.mail).delete()
+        factories.QuarantineFactory(
+            mail=msgrcpt.mail,
+            mail_text=smart_bytes(MESSAGE.format(word=word)))
+        return msgrcpt
+
+    def setUp(self):
+        """Create and index messages."""
+        super(BodyIndexTestCase, self).setUp()
+        self.msgrcpt1 = self._create_message("user1@test.com", "pills")
+        self.msgrcpt2 = self._create_message("user2@test.com", "watches")
+        call_command("qbodyindex")
+
+    def _search(self, pattern, criteria="body"):
+        connector = SQLconnector(user=self.admin, navparams={
+            "pattern": pattern, "criteria": criteria, "order": "-date"})
+        connector.messages_count()
+        return sorted(row["to"] for row in connector.fetch(1, 10))
+
+    def _check_searches(self):
+        self.assertEqual(self._search("pills"), [b"user1@test.com"])
+        self.assertEqual(
+            self._search("evil.corp/watches"), [b"user2@test.com"])
+        self.assertEqual(
+            self._search("buy now"), [b"user1@test.com", b"user2@test.com"])
+        self.assertEqual(self._search("notes"), [])
+        self.assertEqual(self._search("a"), [])
+        self.assertEqual(
+            self._search("user2", "to,body"),
+            [b"user2@test.com"])
+
+    def test_sync(self):
+        self.assertEqual(models.IndexedMessage.objects.count(), 2)
+        self.assertEqual(body_index.sync(), 0)
+        self._create_message("user3@test.com", "rolex")
+        self.assertEqual(body_index.sync(batch_size=1), 1)
+        self.assertEqual(body_index.sync(full=True), 3)
+
+    def test_search(self):
+        self._check_searches()
+        with self.settings(AMAVIS_QUARANTINE_SUMMARY=True):
+            summary.sync()
+            self._check_searches()
+        with self.settings(AMAVIS_BODY_INDEX=False):
+            self.assertEqual(
+                self._search("pills"), [b"user1@test.com", b"user2@test.com"])
+
+    def test_search_sql(self):
+        """Check that matching ids are selected by a subquery."""
+        connector = SQLconnector(user=self.admin, navparams={
+            "pattern": "pills", "criteria": "body", "order": "-date"})
+        connector.messages_count()
+        sql = str(connector.messages.query)
+        self.assertIn(models.BodyToken._meta.db_table, sql)
+        self.assertNotIn(smart_text(self.msgrcpt1.mail_id), sql)
+
+    def test_search_many_matches(self):
+        """Check a body search matching more than 999 messages."""
+        models.BodyToken.objects.bulk_create([
+            models.BodyToken(token="pills", mail_id="old{}".format(i))
+            for i in range(1200)
+        ])
+        self.assertEqual(
+            body_index.get_matching_mail_ids("pills").count(), 1201)
+        self.assertEqual(self._search("pills"), [b"user1@test.com"])
+
+    def test_qcleanup(self):
+        self.msgrcpt1.rs = "D"
+        self.msgrcpt1.save(update_fields=["rs"])
+        call_command("qcleanup")
+        self.assertEqual(self._search("buy"), [b"user2@test.com"])
+        self.assertFalse(models.BodyToken.objects.filter(
+            token="pills").exists())
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for cache."""
+
+from __future__ import unicode_literals
+
+from django.test import SimpleTestCase
+
+from ..cache import LRUCache
+
+
+class LRUCacheTestCase(SimpleTestCase):
+    """Tests for modoboa_amavis.cache.LRUCache."""
+
+    def test_eviction(self):
+        lru = LRUCache(10)
+        lru.set("a", "aaaa", 4, 60)
+        lru.set("b", "bbbb", 4, 60)
+        self.assertEqual(lru.get("a"), "aaaa")
+        lru.set("c", "cccc", 4, 60)
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("a"), "aaaa")
+        self.assertEqual(lru.get("c"), "cccc")
+        self.assertEqual(lru.size, 8)
+
+        # Too big values are not stored
+        lru.set("d", "d" * 11, 11, 60)
+        self.assertIsNone(lru.get("d"))
+        self.assertEqual(len(lru), 2)
+
+        lru.delete_many(["a"])
+        self.assertEqual(lru.size, 4)
+        lru.clear()
+        self.assertEqual(len(lru), 0)
+        self.assertEqual(lru.size, 0)
+
+    def test_expiration(self):
+        lru = LRUCache(10)
+        lru.set("a", "aaaa", 4, -1)
+        self.assertIsNone(lru.get("a"))
+        self.assertEqual(lru.size, 0)
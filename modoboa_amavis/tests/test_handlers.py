@@ -13,7 +13,8 @@ from modoboa.admin import factories as admin_factories, models as admin_models
 from modoboa.core import models as core_models
 from modoboa.lib.tests import ModoTestCase
 from modoboa.transport import factories as tr_factories
-from .. import factories, lib, models
+from .. import cache, factories, lib, models
+from ..sql_connector import SQLconnector
 
 
 class DomainTestCase(ModoTestCase):
@@ -206,3 +207,49 @@ class ManualLearningTestCase(ModoTestCase):
         saclient = lib.SpamassassinClient(user, recipient_db)
         result = saclient.learn_spam(rcpt, content)
         self.assertTrue(result)
+
+
+class RecipientIdsCacheTestCase(ModoTestCase):
+    """Check recipient ids cache invalidation."""
+
+    multi_db = True
+
+    @classmethod
+    def setUpTestData(cls):  # NOQA:N802
+        """Create test data."""
+        super(RecipientIdsCacheTestCase, cls).setUpTestData()
+        admin_factories.populate_database()
+        cls.user = core_models.User.objects.get(username="user@test.com")
+
+    def setUp(self):
+        """Initiate test context."""
+        cache.invalidate_user_recipient_ids([self.user.pk])
+
+    def test_cache(self):
+        """Check cache content and invalidation."""
+        self.set_global_parameter("recipient_delimiter", "+")
+        msgrcpt = factories.create_spam("user@test.com")
+        connector = SQLconnector(user=self.user)
+        self.assertEqual(
+            connector._get_simpleuser_recipient_ids(), [msgrcpt.rid_id])
+        self.assertIsNot(cache.get_user_recipient_ids(self.user.pk), None)
+
+        # New maddr records are picked up
+        msgrcpt2 = factories.create_spam("user+ext@test.com")
+        self.assertEqual(
+            sorted(connector._get_simpleuser_recipient_ids()),
+            sorted([msgrcpt.rid_id, msgrcpt2.rid_id]))
+
+        alias = admin_factories.AliasFactory(
+            address="cachealias@test.com", domain=self.user.mailbox.domain)
+        self.assertIsNot(cache.get_user_recipient_ids(self.user.pk), None)
+        admin_factories.AliasRecipientFactory(
+            alias=alias, r_mailbox=self.user.mailbox)
+        self.assertIs(cache.get_user_recipient_ids(self.user.pk), None)
+
+        msgrcpt3 = factories.create_spam("cachealias@test.com")
+        self.assertEqual(
+            sorted(connector._get_simpleuser_recipient_ids()),
+            sorted([msgrcpt.rid_id, msgrcpt2.rid_id, msgrcpt3.rid_id]))
+        alias.delete()
+        self.assertIs(cache.get_user_recipient_ids(self.user.pk), None)
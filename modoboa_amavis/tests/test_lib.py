@@ -2,10 +2,30 @@
 
 from __future__ import unicode_literals
 
-from django.test import SimpleTestCase
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
 
+import mock
+
+from six.moves import socketserver
+
+from django.test import SimpleTestCase, override_settings
+
+from modoboa.admin import factories as admin_factories
+from modoboa.core import models as core_models
 from modoboa.lib.tests import ModoTestCase
-from modoboa_amavis.lib import cleanup_email_address, make_query_args
+from modoboa_amavis import factories
+from modoboa_amavis.lib import (
+    PDPClient, ReleaseEngine, SpamassassinClient, SpamdClient,
+    cleanup_email_address, make_query_args
+)
+from modoboa_amavis.sql_connector import SQLconnector
+from modoboa_amavis.tests.spamd import FakeSpamd
+from modoboa_amavis.utils import smart_bytes
 
 
 class MakeQueryArgsTests(ModoTestCase):
@@ -93,3 +113,225 @@ class FixUTF8EncodingTests(SimpleTestCase):
         expected_output = "john.smith@example.com"
         output = cleanup_email_address(value)
         self.assertEqual(output, expected_output)
+
+
+class FakePDPHandler(socketserver.StreamRequestHandler):
+    """A fake amavis AM.PDP server."""
+
+    def handle(self):
+        request = []
+        for line in self.rfile:
+            line = line.strip()
+            if line:
+                request.append(line)
+                continue
+            self.server.requests.append(request)
+            recipients = [
+                item for item in request if item.startswith(b"recipient=")]
+            if b"mail_id=slow" in request:
+                time.sleep(1)
+                return
+            if b"mail_id=bad" in request:
+                self.wfile.write(b"setreply=450 4.5.0 Failure\n\n")
+            else:
+                self.wfile.write(
+                    b"setreply=250 2.5.0 Ok,%20id=rel\n"
+                    b"nrecipients=" + smart_bytes(len(recipients)) + b"\n\n")
+            request = []
+
+
+class PDPClientTestCase(ModoTestCase):
+    """Tests for modoboa_amavis.lib.PDPClient."""
+
+    def setUp(self):
+        """Start a fake PDP server."""
+        super(PDPClientTestCase, self).setUp()
+        self.workdir = tempfile.mkdtemp()
+        path = os.path.join(self.workdir, "amavisd.sock")
+        self.server = socketserver.ThreadingUnixStreamServer(
+            path, FakePDPHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.set_global_parameter("am_pdp_mode", "unix")
+        self.set_global_parameter("am_pdp_socket", path)
+
+    def tearDown(self):
+        """Stop the fake PDP server."""
+        PDPClient.clear_pool()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir)
+
+    def test_decode(self):
+        self.assertEqual(PDPClient.decode(b"250%202.5.0%20Ok"), b"250 2.5.0 Ok")
+        self.assertEqual(PDPClient.encode("a b%c"), b"a%20b%25c")
+
+    def test_release(self):
+        client = PDPClient()
+        self.assertTrue(client.release("mailid1", "secret", ["a@test.com"]))
+        self.assertFalse(client.release("bad", "secret", ["a@test.com"]))
+        client.close()
+
+        # The pooled connection is reused
+        client = PDPClient()
+        self.assertTrue(client.release("mailid2", "secret", ["b@test.com"]))
+        client.close()
+
+    def test_release_messages(self):
+        client = PDPClient()
+        client.PIPELINE_SIZE = 2
+        result = client.release_messages([
+            ("mailid1", "secret1", "a@test.com"),
+            ("mailid2", "secret2", "a@test.com"),
+            ("mailid1", "secret1", "b@test.com"),
+            ("bad", "secret3", "a@test.com"),
+        ])
+        client.close()
+        self.assertEqual(result, {
+            (b"mailid1", "a@test.com"): True,
+            (b"mailid1", "b@test.com"): True,
+            (b"mailid2", "a@test.com"): True,
+            (b"bad", "a@test.com"): False,
+        })
+        # Recipients of the same message share a single request
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertIn(b"recipient=b@test.com", self.server.requests[0])
+
+
+class ReleaseEngineTestCase(PDPClientTestCase):
+    """Tests for modoboa_amavis.lib.ReleaseEngine."""
+
+    multi_db = True
+
+    def test_run(self):
+        items = [
+            ("mailid{}".format(i), "secret", "a@test.com")
+            for i in range(10)
+        ]
+        items += [
+            ("mailid1", "secret", "b@test.com"),
+            ("bad", "secret", "a@test.com"),
+            ("slow", "secret", "a@test.com"),
+        ]
+        engine = ReleaseEngine(workers=3, timeout=0.2, batch_size=1)
+        result = engine.run(items)
+        self.assertEqual(len(result), 13)
+        for i in range(10):
+            self.assertTrue(result[(smart_bytes("mailid{}".format(i)),
+                                    "a@test.com")])
+        self.assertTrue(result[(b"mailid1", "b@test.com")])
+        self.assertFalse(result[(b"bad", "a@test.com")])
+        self.assertFalse(result[(b"slow", "a@test.com")])
+        # Recipients of the same message share a single request
+        self.assertEqual(len(self.server.requests), 12)
+
+    def test_release(self):
+        msgrcpt1 = factories.create_spam("user@test.com")
+        msgrcpt2 = factories.create_spam("user@test.com")
+        result = ReleaseEngine().release([
+            (msgrcpt1.mail.mail_id, msgrcpt1.mail.secret_id, "user@test.com"),
+            ("bad", msgrcpt2.mail.secret_id, "user@test.com"),
+        ], SQLconnector())
+        self.assertEqual(list(result.values()).count(True), 1)
+        msgrcpt1.refresh_from_db()
+        self.assertEqual(msgrcpt1.rs, "R")
+        msgrcpt2.refresh_from_db()
+        self.assertEqual(msgrcpt2.rs, " ")
+
+
+@override_settings(SA_LOOKUP_PATH=(os.path.dirname(__file__), ))
+class SpamassassinClientTestCase(ModoTestCase):
+    """Tests for modoboa_amavis.lib.SpamassassinClient."""
+
+    @classmethod
+    def setUpTestData(cls):  # NOQA:N802
+        """Create test data."""
+        super(SpamassassinClientTestCase, cls).setUpTestData()
+        admin_factories.populate_database()
+        cls.admin = core_models.User.objects.get(username="admin")
+
+    def test_write_mbox(self):
+        mbox = io.BytesIO()
+        SpamassassinClient._write_mbox(mbox, [
+            iter([b"Subject: 1\n\nFr", b"om here\n>From there"]),
+            b"Subject: 2\n"
+        ])
+        self.assertEqual(
+            mbox.getvalue(),
+            b"From MAILER-DAEMON Thu Jan  1 00:00:00 1970\n"
+            b"Subject: 1\n\n>From here\n>>From there\n\n"
+            b"From MAILER-DAEMON Thu Jan  1 00:00:00 1970\n"
+            b"Subject: 2\n\n"
+        )
+
+    def test_learn(self):
+        """Check that messages are grouped by username."""
+        self.set_global_parameter("domain_level_learning", True)
+        saclient = SpamassassinClient(self.admin, "domain")
+        items = [
+            ("user@test.com", "Subject: 1\n"),
+            ("admin@test2.com", "Subject: 2\n"),
+            ("admin@test.com", "Subject: 3\n"),
+        ]
+        inputs = []
+
+        def fake_exec_cmd(cmd, stdin, **kwargs):
+            inputs.append(stdin.read())
+            return 0, b""
+
+        with mock.patch("modoboa_amavis.lib.exec_cmd",
+                        side_effect=fake_exec_cmd) as mock_exec_cmd:
+            result = saclient.learn(items, "spam")
+        self.assertEqual(result, [True, True, True])
+        self.assertEqual(mock_exec_cmd.call_count, 2)
+        cmd = mock_exec_cmd.call_args_list[0][0][0]
+        self.assertTrue(cmd.endswith("--spam --no-sync -u test.com --mbox"))
+        self.assertIn(b"Subject: 1\n", inputs[0])
+        self.assertIn(b"Subject: 3\n", inputs[0])
+
+        with mock.patch("modoboa_amavis.lib.exec_cmd") as mock_exec_cmd:
+            mock_exec_cmd.side_effect = [(1, b"error"), (0, b"")]
+            result = saclient.learn(items, "ham")
+        self.assertEqual(result, [False, True, False])
+        self.assertEqual(saclient.error, "error")
+
+
+class SpamdClientTestCase(SimpleTestCase):
+    """Tests for modoboa_amavis.lib.SpamdClient."""
+
+    def setUp(self):
+        """Start a fake spamd server."""
+        self.spamd = FakeSpamd()
+        self.spamd.start()
+        self.addCleanup(self.spamd.stop)
+
+    def test_tell_messages(self):
+        client = SpamdClient(*self.spamd.server_address, workers=2)
+        items = [
+            ("user{}@test.com".format(i), "Subject: {}\n".format(i), "spam")
+            for i in range(5)
+        ]
+        items.append(("user@test.com", "X-Spamd-Error: 1\n", "ham"))
+        result = client.tell_messages(items)
+        self.assertEqual(result, [True] * 5 + [False])
+        self.assertEqual(client.error, "spamd error: EX_IOERR")
+        self.assertEqual(
+            sorted(self.spamd.learnt),
+            [(smart_bytes("user{}@test.com".format(i)), b"spam",
+              smart_bytes("Subject: {}\n".format(i))) for i in range(5)]
+        )
+
+        # Errors of previous calls are forgotten
+        self.assertEqual(client.tell_messages(items[:1]), [True])
+        self.assertIsNone(client.error)
+
+    def test_connection_error(self):
+        address = self.spamd.server_address
+        self.spamd.stop()
+        client = SpamdClient(*address)
+        self.assertEqual(
+            client.tell_messages([("user@test.com", "Subject: 1", "ham")]),
+            [False])
+        self.assertTrue(client.error.startswith("Connection to spamd failed"))
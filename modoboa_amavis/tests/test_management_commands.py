@@ -4,22 +4,33 @@
 
 from __future__ import unicode_literals
 
+import json
+import time
+
+import mock
 from dateutil.relativedelta import relativedelta
+from six import StringIO
 
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management import call_command
+from django.test import override_settings
 from django.utils import timezone
 
 from modoboa.lib.tests import ModoTestCase
 from .. import factories, models
+from ..management.commands import qcleanup
+from ..utils import smart_text
 
 
 class ManagementCommandTestCase(ModoTestCase):
     """Management commands tests."""
 
+    multi_db = True
+
     def test_qcleanup(self):
         """Test qcleanup command."""
         factories.create_spam("user@test.com", rs="D")
-        call_command("qcleanup")
+        call_command("qcleanup", sweep_margin=0)
         self.assertEqual(models.Quarantine.objects.count(), 0)
         self.assertEqual(models.Msgs.objects.count(), 0)
         self.assertEqual(models.Maddr.objects.count(), 0)
@@ -44,3 +55,302 @@ class ManagementCommandTestCase(ModoTestCase):
         call_command("qcleanup")
         with self.assertRaises(models.Msgrcpt.DoesNotExist):
             msgrcpt.refresh_from_db()
+
+    def test_qcleanup_batches(self):
+        """Check that messages are deleted by batches."""
+        for i in range(5):
+            factories.create_spam("user@test.com", rs="D")
+        kept = [smart_text(factories.create_spam("user@test.com").mail_id)
+                for i in range(2)]
+        call_command("qcleanup", batch_size=2)
+        self.assertEqual(
+            sorted(models.Msgs.objects.values_list("mail_id", flat=True)),
+            sorted(kept))
+        self.assertEqual(
+            sorted(models.Quarantine.objects.values_list(
+                "mail_id", flat=True)),
+            sorted(kept))
+        self.assertEqual(models.Msgrcpt.objects.count(), 2)
+
+    def test_qcleanup_rendered_cache(self):
+        """Check that only deleted messages leave the rendered cache."""
+        deleted = factories.create_spam("user@test.com", rs="D")
+        factories.create_spam("user@test.com")
+        with mock.patch.object(qcleanup.cache, "clear_rendered_messages") \
+                as mock_clear, \
+                mock.patch.object(qcleanup.cache,
+                                  "invalidate_rendered_messages") \
+                as mock_invalidate:
+            call_command("qcleanup")
+        self.assertFalse(mock_clear.called)
+        mock_invalidate.assert_called_once_with(
+            [smart_text(deleted.mail_id)])
+
+    def test_qcleanup_addresses(self):
+        """Check the resumable sweep of unreferenced addresses."""
+        msgrcpt = factories.create_spam("user@test.com")
+        orphans = [factories.MaddrFactory().id for i in range(5)]
+        models.CleanupState.objects.create(
+            name="maddr_sweep", value=orphans[1])
+        call_command("qcleanup", batch_size=2, sweep_margin=0)
+        # Resumed after the second orphan
+        self.assertEqual(
+            sorted(models.Maddr.objects.filter(
+                id__in=orphans).values_list("id", flat=True)),
+            orphans[:2])
+        self.assertFalse(models.CleanupState.objects.exists())
+
+        call_command("qcleanup", batch_size=2, sweep_margin=0)
+        self.assertFalse(models.Maddr.objects.filter(id__in=orphans).exists())
+        self.assertEqual(models.Maddr.objects.filter(
+            id__in=[msgrcpt.rid_id, msgrcpt.mail.sid_id]).count(), 2)
+
+    def test_qcleanup_recent_addresses(self):
+        """Check that the most recent addresses are left alone."""
+        orphans = [factories.MaddrFactory().id for i in range(3)]
+        call_command("qcleanup", batch_size=2, sweep_margin=2)
+        # The two newest ones may belong to messages not stored yet
+        self.assertEqual(
+            sorted(models.Maddr.objects.filter(
+                id__in=orphans).values_list("id", flat=True)),
+            orphans[1:])
+        self.assertFalse(models.CleanupState.objects.exists())
+
+        stdout = StringIO()
+        with mock.patch("sys.stdout", stdout):
+            call_command(
+                "qcleanup", dry_run=True, json=True, sweep_margin=1)
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(report["phases"]["addresses"]["rows"], 1)
+
+    def test_qcleanup_daemon_sweep(self):
+        """Check that the address sweep is spread over daemon passes."""
+        factories.create_spam("user@test.com")
+        referenced = sorted(models.Maddr.objects.values_list("id", flat=True))
+        orphans = [factories.MaddrFactory().id for i in range(3)]
+        sleeps = []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            if seconds == 3600:
+                raise KeyboardInterrupt
+
+        with mock.patch.object(qcleanup.Command, "_sleep",
+                               side_effect=fake_sleep):
+            call_command(
+                "qcleanup", daemon=True, interval=3600, batch_size=2,
+                rate=0.001, sweep_batches=1, sweep_margin=0)
+        # Only referenced addresses were scanned: no throttling
+        self.assertEqual(sleeps, [3600])
+        self.assertEqual(
+            models.CleanupState.objects.get(name="maddr_sweep").value,
+            referenced[1])
+        self.assertEqual(
+            models.Maddr.objects.filter(id__in=orphans).count(), 3)
+
+    def test_qcleanup_daemon(self):
+        """Check the continuous mode and its throttling."""
+        for i in range(3):
+            factories.create_spam("user@test.com", rs="D")
+        sleeps = []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            if seconds == 3600:
+                raise KeyboardInterrupt
+
+        with mock.patch.object(qcleanup.Command, "_sleep",
+                               side_effect=fake_sleep):
+            call_command(
+                "qcleanup", daemon=True, interval=3600, batch_size=1,
+                rate=0.5)
+        self.assertEqual(models.Msgs.objects.count(), 0)
+        self.assertEqual(sleeps[-1], 3600)
+        # 1 row per batch at 0.5 row/s
+        throttling = sleeps[:-1]
+        self.assertTrue(throttling)
+        for seconds in throttling:
+            self.assertTrue(0 < seconds <= 2)
+
+    def test_qcleanup_dry_run(self):
+        """Check that the dry-run mode only counts rows."""
+        factories.create_spam("user@test.com", rs="D")
+        msgrcpt = factories.create_spam("user@test.com", rs="D")
+        factories.create_spam("user@test.com")
+        models.Msgs.objects.filter(mail_id=msgrcpt.mail_id).update(
+            time_num=int(
+                (timezone.now() - relativedelta(days=40)).strftime("%s")))
+        factories.MaddrFactory()
+        stdout = StringIO()
+        with mock.patch("sys.stdout", stdout):
+            call_command(
+                "qcleanup", dry_run=True, json=True, sweep_margin=0)
+        report = json.loads(stdout.getvalue())
+        self.assertTrue(report["dry_run"])
+        self.assertFalse(report["interrupted"])
+        self.assertEqual(report["phases"]["marked"]["rows"], 2)
+        self.assertEqual(
+            report["phases"]["marked"]["bytes"],
+            sum(models.Msgs.objects.filter(
+                msgrcpt__rs="D").values_list("size", flat=True)))
+        # Already counted as marked
+        self.assertEqual(report["phases"]["expired"]["rows"], 0)
+        self.assertEqual(report["phases"]["addresses"]["rows"], 1)
+        self.assertEqual(models.Msgs.objects.count(), 3)
+        self.assertEqual(models.Maddr.objects.count(), 3)
+
+    def test_qcleanup_max_runtime(self):
+        """Check that the runtime cap stops between two batches."""
+        for i in range(3):
+            factories.create_spam("user@test.com", rs="D")
+        clock = [1000.0]
+
+        def fake_sleep(seconds):
+            clock[0] += seconds
+
+        stdout = StringIO()
+        with mock.patch.object(qcleanup.Command, "_sleep",
+                               side_effect=fake_sleep), \
+                mock.patch("time.time", side_effect=lambda: clock[0]), \
+                mock.patch("sys.stdout", stdout):
+            call_command(
+                "qcleanup", batch_size=1, rate=1, max_runtime=2, json=True)
+        report = json.loads(stdout.getvalue())
+        self.assertTrue(report["interrupted"])
+        self.assertEqual(report["phases"]["marked"]["rows"], 2)
+        self.assertNotIn("addresses", report["phases"])
+        self.assertEqual(models.Msgs.objects.count(), 1)
+
+    def test_qcleanup_budget(self):
+        """Check the eviction of messages once the budget is exceeded."""
+        now = int(time.time())
+        messages = {}
+        for name, age, size, score in [("old", 300, 100, 1.0),
+                                       ("large", 200, 500, 2.0),
+                                       ("spammy", 100, 100, 50.0),
+                                       ("recent", 0, 100, None)]:
+            msgrcpt = factories.create_spam("user@test.com")
+            models.Msgs.objects.filter(mail_id=msgrcpt.mail_id).update(
+                time_num=now - age, size=size, spam_level=score)
+            messages[name] = smart_text(msgrcpt.mail_id)
+
+        def remaining():
+            return sorted(
+                name for name, mail_id in messages.items()
+                if models.Msgs.objects.filter(mail_id=mail_id).exists())
+
+        stdout = StringIO()
+        with mock.patch("sys.stdout", stdout):
+            call_command("qcleanup", budget=500, dry_run=True, json=True)
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(report["phases"]["evicted"]["rows"], 2)
+        self.assertEqual(report["phases"]["evicted"]["bytes"], 600)
+        self.assertEqual(len(remaining()), 4)
+
+        call_command("qcleanup", budget=700, eviction_order="score")
+        self.assertEqual(remaining(), ["large", "old", "recent"])
+        call_command("qcleanup", budget=600, eviction_order="oldest")
+        self.assertEqual(remaining(), ["large", "recent"])
+        # Already within the budget
+        call_command("qcleanup", budget=600, eviction_order="largest")
+        self.assertEqual(remaining(), ["large", "recent"])
+        call_command("qcleanup", budget=100, eviction_order="largest")
+        self.assertEqual(remaining(), ["recent"])
+
+    @override_settings(AMAVIS_RETENTION_RULES=[
+        {"content": ["S"], "min_score": 20, "max_age": 3},
+        {"content": ["B"], "max_age": 60},
+        {"domain": ["test2.com"], "max_age": 7},
+    ])
+    def test_qcleanup_retention_rules(self):
+        """Check per content type, score and domain retention rules."""
+        messages = {}
+        for name, rcpt, content, score, age in [
+                ("high_score", "user@test.com", "S", 999.0, 5),
+                ("low_score", "user@test.com", "S", 5.0, 5),
+                ("banned", "user@test.com", "B", None, 40),
+                ("old_banned", "user@test.com", "B", None, 70),
+                ("domain", "user@test2.com", "S", 5.0, 10),
+                ("recent_domain", "user@test2.com", "S", 5.0, 5),
+                ("default", "user@test.com", "V", None, 40)]:
+            msgrcpt = factories.create_spam(rcpt)
+            models.Msgrcpt.objects.filter(mail_id=msgrcpt.mail_id).update(
+                content=content, bspam_level=score)
+            models.Maddr.objects.filter(id=msgrcpt.rid_id).update(
+                domain=".".join(reversed(rcpt.split("@")[1].split("."))))
+            models.Msgs.objects.filter(mail_id=msgrcpt.mail_id).update(
+                time_num=int(
+                    (timezone.now() - relativedelta(days=age)).strftime(
+                        "%s")))
+            messages[name] = smart_text(msgrcpt.mail_id)
+
+        stdout = StringIO()
+        with mock.patch("sys.stdout", stdout):
+            call_command("qcleanup", dry_run=True, json=True)
+        phases = json.loads(stdout.getvalue())["phases"]
+        self.assertEqual(
+            [phases[name]["rows"]
+             for name in ["rule_1", "rule_2", "rule_3", "expired"]],
+            [1, 1, 1, 1])
+
+        # Messages counted by rules are not evicted again
+        models.Msgs.objects.update(size=100)
+        models.Msgs.objects.filter(mail_id=messages["high_score"]).update(
+            size=10000)
+        stdout = StringIO()
+        with mock.patch("sys.stdout", stdout):
+            call_command(
+                "qcleanup", dry_run=True, json=True, budget=0,
+                eviction_order="largest")
+        phases = json.loads(stdout.getvalue())["phases"]
+        self.assertEqual(phases["evicted"]["rows"], 3)
+        self.assertEqual(phases["evicted"]["bytes"], 300)
+
+        call_command("qcleanup")
+        remaining = sorted(
+            name for name, mail_id in messages.items()
+            if models.Msgs.objects.filter(mail_id=mail_id).exists())
+        self.assertEqual(
+            remaining, ["banned", "low_score", "recent_domain"])
+
+    @override_settings(AMAVIS_RETENTION_RULES=[{"content": ["Z"]}])
+    def test_qcleanup_invalid_retention_rules(self):
+        """Check that invalid rules are rejected."""
+        with self.assertRaises(ImproperlyConfigured):
+            call_command("qcleanup")
+
+    @override_settings(AMAVIS_PARTITIONS=True)
+    def test_qcleanup_partitions(self):
+        """Check that only partitions older than max age are deleted."""
+        old_time = int(
+            (timezone.now() - relativedelta(days=40)).strftime("%s"))
+        for tag, received in [(1, old_time), (1, old_time),
+                              (2, old_time), (2, None)]:
+            msgrcpt = factories.create_spam("user@test.com")
+            models.Msgs.objects.filter(mail_id=msgrcpt.mail_id).update(
+                partition_tag=tag, time_num=received or msgrcpt.mail.time_num)
+            models.Msgrcpt.objects.filter(mail_id=msgrcpt.mail_id).update(
+                partition_tag=tag)
+            models.Quarantine.objects.filter(mail_id=msgrcpt.mail_id).update(
+                partition_tag=tag)
+        call_command("qcleanup", batch_size=1)
+        self.assertEqual(
+            list(models.Msgs.objects.values_list(
+                "partition_tag", flat=True)), [2, 2])
+        self.assertEqual(models.Quarantine.objects.count(), 2)
+        self.assertEqual(models.Msgrcpt.objects.count(), 2)
+
+    @override_settings(AMAVIS_QUARANTINE_SUMMARY=True)
+    def test_qsync(self):
+        """Test qsync command and summary cleanup."""
+        factories.create_spam("user@test.com", rs="D")
+        msgrcpt = factories.create_spam("user@test.com")
+        call_command("qsync")
+        self.assertEqual(models.QuarantineSummary.objects.count(), 2)
+
+        msgrcpt.mail.time_num = int(
+            (timezone.now() - relativedelta(days=40)).strftime("%s"))
+        msgrcpt.mail.save(update_fields=["time_num"])
+        models.QuarantineSummary.objects.update(time_num=msgrcpt.mail.time_num)
+        call_command("qcleanup")
+        self.assertEqual(models.QuarantineSummary.objects.count(), 0)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for search."""
+
+from __future__ import unicode_literals
+
+import mock
+
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import override_settings
+
+from modoboa.core import models as core_models
+from modoboa.lib.tests import ModoTestCase
+from .. import factories, models, search, summary
+from ..sql_connector import SQLconnector
+
+
+@override_settings(AMAVIS_QUARANTINE_SUMMARY=True)
+class SearchTestCase(ModoTestCase):
+    """Tests for modoboa_amavis.search."""
+
+    multi_db = True
+
+    @classmethod
+    def setUpTestData(cls):  # NOQA:N802
+        """Create test data."""
+        super(SearchTestCase, cls).setUpTestData()
+        cls.admin = core_models.User.objects.get(username="admin")
+
+    def setUp(self):
+        """Create and index messages."""
+        super(SearchTestCase, self).setUp()
+        call_command("qindex")
+        for i in range(3):
+            msgrcpt = factories.create_spam(
+                "user{}@test.com".format(i),
+                sender="Spammer {0} <spammer{0}@evil.corp>".format(i))
+            msgrcpt.mail.from_addr = msgrcpt.mail.sid.email
+            msgrcpt.mail.subject = "Cheap PILLS number {}".format(i)
+            msgrcpt.mail.save(update_fields=["from_addr", "subject"])
+        summary.sync()
+
+    def _search(self, pattern, criteria="both"):
+        connector = SQLconnector(user=self.admin, navparams={
+            "pattern": pattern, "criteria": criteria, "order": "-date"})
+        connector.messages_count()
+        return sorted(
+            row["to"] for row in connector.fetch(1, 10))
+
+    def test_backend(self):
+        self.assertIs(type(search.get_backend()), search.SearchBackend)
+        with self.settings(AMAVIS_SEARCH_INDEX=True):
+            self.assertIs(type(search.get_backend()), search.SQLiteBackend)
+
+    def test_postgresql_statements(self):
+        """Check that existing indexes are not created again."""
+        connection = mock.Mock()
+        connection.ops.quote_name = lambda name: '"{}"'.format(name)
+        cursor = connection.cursor.return_value
+        cursor.fetchall.return_value = [("quarantine_summary_email_trgm",)]
+        backend = search.PostgreSQLBackend(connection)
+        statements = backend.get_create_statements()
+        self.assertEqual(len(statements), 3)
+        self.assertNotIn("IF NOT EXISTS", " ".join(statements[1:]))
+        self.assertNotIn("email", " ".join(statements))
+
+    def test_search(self):
+        """Check that indexed and unindexed searches are equivalent."""
+        cases = [
+            ("pills", "subject", [b"user0@test.com", b"user1@test.com",
+                                  b"user2@test.com"]),
+            ("er 1", "subject", [b"user1@test.com"]),
+            ("1", "both", [b"user1@test.com"]),
+            ("spammer2", "from_addr", [b"user2@test.com"]),
+            ("user0@", "to", [b"user0@test.com"]),
+            ("user0@", "from_addr,subject", []),
+            ('"quoted"', "both", []),
+        ]
+        for pattern, criteria, expected in cases:
+            self.assertEqual(self._search(pattern, criteria), expected)
+            with self.settings(AMAVIS_SEARCH_INDEX=True):
+                self.assertEqual(self._search(pattern, criteria), expected)
+
+    @override_settings(AMAVIS_SEARCH_INDEX=True)
+    def test_index_updates(self):
+        """Check that the index follows the summary table."""
+        self.assertEqual(self._search("pills", "subject"), [
+            b"user0@test.com", b"user1@test.com", b"user2@test.com"])
+        factories.create_spam("user3@test.com")
+        summary.sync()
+        self.assertEqual(self._search("user3", "to"), [b"user3@test.com"])
+        summary.delete_messages(
+            models.QuarantineSummary.objects.filter(email="user0@test.com")
+            .values_list("mail_id", flat=True))
+        self.assertEqual(self._search("pills", "subject"), [
+            b"user1@test.com", b"user2@test.com"])
+
+        call_command("qindex", drop=True)
+        with self.assertRaises(DatabaseError):
+            self._search("pills", "subject")
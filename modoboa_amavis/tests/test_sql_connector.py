@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for sql_connector."""
+
+from __future__ import unicode_literals
+
+from django.db import connections
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from modoboa.core import models as core_models
+from modoboa.lib.tests import ModoTestCase
+from .. import factories, models, summary
+from ..sql_connector import SQLconnector
+from ..utils import smart_bytes, smart_text
+
+
+class SQLconnectorTestCase(ModoTestCase):
+    """Tests for modoboa_amavis.sql_connector.SQLconnector."""
+
+    multi_db = True
+
+    @classmethod
+    def setUpTestData(cls):  # NOQA:N802
+        """Create test data."""
+        super(SQLconnectorTestCase, cls).setUpTestData()
+        cls.admin = core_models.User.objects.get(username="admin")
+        for i in range(3):
+            factories.create_spam("user{}@test.com".format(i))
+            factories.create_virus("user{}@test.com".format(i))
+
+    def _fetch_all_pages(self, order, use_cursor, per_page=2):
+        """Fetch every page and return mail ids."""
+        connector = SQLconnector(user=self.admin, navparams={"order": order})
+        total = connector.messages_count()
+        result = []
+        cursor = None
+        for start in range(1, total + 1, per_page):
+            rows = connector.fetch(
+                start, start + per_page - 1, cursor if use_cursor else None)
+            result += [(row["mailid"], row["to"]) for row in rows]
+            cursor = connector.last_cursor
+        return result
+
+    def test_seek_pagination(self):
+        """Check that seek and offset pagination return the same rows."""
+        for order in ["-date", "date", "-score", "type", "-from", "to"]:
+            expected = self._fetch_all_pages(order, False)
+            self.assertEqual(len(expected), 6)
+            self.assertEqual(self._fetch_all_pages(order, True), expected)
+
+    def test_messages_count(self):
+        """Check exact and capped counts."""
+        connector = SQLconnector(user=self.admin, navparams={"order": "-date"})
+        self.assertEqual(connector.messages_count(), 6)
+        self.assertTrue(connector.count_is_exact)
+
+        connector = SQLconnector(user=self.admin, navparams={"order": "-date"})
+        self.assertEqual(connector.messages_count(limit=4), 4)
+        self.assertFalse(connector.count_is_exact)
+
+        connector = SQLconnector(user=self.admin, navparams={"order": "-date"})
+        self.assertEqual(connector.messages_count(limit=10), 6)
+        self.assertTrue(connector.count_is_exact)
+
+    @override_settings(AMAVIS_PARTITIONS=True, AMAVIS_QUARANTINE_SUMMARY=False)
+    def test_partitions(self):
+        """Check that rows are joined using partition tags."""
+        msgrcpt = factories.create_spam("user@test.com")
+        models.Msgrcpt.objects.filter(mail_id=msgrcpt.mail_id).update(
+            partition_tag=1)
+        connector = SQLconnector(user=self.admin, navparams={"order": "-date"})
+        self.assertEqual(connector.messages_count(), 6)
+
+        # Messages of a new partition are listed right away
+        models.Msgs.objects.filter(mail_id=msgrcpt.mail_id).update(
+            partition_tag=1)
+        connector = SQLconnector(user=self.admin, navparams={"order": "-date"})
+        self.assertEqual(connector.messages_count(), 7)
+
+    def test_get_recipient_ids(self):
+        """Check recipient resolution (with extensions)."""
+        self.set_global_parameter("recipient_delimiter", "+")
+        expected = [
+            factories.create_spam("user@test.com").rid_id,
+            factories.create_spam("user+foo@test.com").rid_id,
+        ]
+        factories.create_spam("user@test.com.evil")
+        factories.create_spam("user+foo@other.com")
+        factories.create_spam("xuser@test.com")
+        ids = SQLconnector().get_recipient_ids(["user@test.com"])
+        self.assertEqual(sorted(ids), sorted(expected))
+        ids = SQLconnector().get_recipient_ids(["user+foo@test.com"])
+        self.assertEqual(sorted(ids), sorted(expected))
+        self.assertEqual(
+            SQLconnector().get_recipient_ids(["nobody@test.com"]), [])
+
+    def test_get_recipient_ids_sql(self):
+        """Check that no LIKE lookup is used on the binary email column."""
+        self.set_global_parameter("recipient_delimiter", "+")
+        with CaptureQueriesContext(connections["amavis"]) as ctx:
+            SQLconnector().get_recipient_ids(["user@test.com"])
+        self.assertEqual(len(ctx.captured_queries), 1)
+        sql = ctx.captured_queries[0]["sql"]
+        self.assertNotIn("LIKE", sql.upper())
+        self.assertNotIn("::text", sql)
+        self.assertIn('"maddr"."email" >= \'user+\'', sql)
+        self.assertIn('"maddr"."email" < \'user,\'', sql)
+
+    def test_set_msgrcpts_status(self):
+        """Check bulk status updates."""
+        msgrcpt1 = factories.create_spam("user@test.com")
+        msgrcpt2 = factories.create_virus("user@test.com")
+        msgrcpt3 = factories.create_spam("other@test.com")
+        connector = SQLconnector()
+        connector.BULK_UPDATE_SIZE = 1
+        connector.set_msgrcpts_status([
+            ("user@test.com", smart_text(msgrcpt1.mail.mail_id), "D"),
+            ("user@test.com", smart_text(msgrcpt2.mail.mail_id), "D"),
+            ("other@test.com", smart_text(msgrcpt3.mail.mail_id), "R"),
+            ("other@test.com", smart_text(msgrcpt1.mail.mail_id), "R"),
+            ("unknown@test.com", smart_text(msgrcpt1.mail.mail_id), "R"),
+        ])
+        for msgrcpt, status in [(msgrcpt1, "D"), (msgrcpt2, "D"),
+                                (msgrcpt3, "R")]:
+            msgrcpt.refresh_from_db()
+            self.assertEqual(msgrcpt.rs, status)
+
+    def test_set_status_lookups(self):
+        """Check that single and bulk updates find the same recipients."""
+        address = "üser@tést.com"
+        msgrcpt = factories.create_spam(address)
+        mail_id = smart_text(msgrcpt.mail.mail_id)
+        connector = SQLconnector()
+        connector.set_msgrcpt_status(address, mail_id, "D")
+        msgrcpt.refresh_from_db()
+        self.assertEqual(msgrcpt.rs, "D")
+        connector.set_msgrcpts_status([(address, mail_id, "R")])
+        msgrcpt.refresh_from_db()
+        self.assertEqual(msgrcpt.rs, "R")
+
+    def test_get_mail_content(self):
+        """Check raw, decoded and file-like retrieval."""
+        msgrcpt = factories.create_spam("user@test.com")
+        mail = msgrcpt.mail
+        models.Quarantine.objects.filter(mail=mail).delete()
+        text = "Subject: tést\n\nline 1\nline 2\n"
+        factories.QuarantineFactory(mail=mail, mail_text=smart_bytes(text))
+        connector = SQLconnector()
+        self.assertEqual(
+            connector.get_raw_mail_content(mail.mail_id), smart_bytes(text))
+        self.assertEqual(connector.get_mail_content(mail.mail_id), text)
+        mailfile = connector.get_mail_file(mail.mail_id)
+        self.assertEqual(mailfile.readline(), smart_bytes("Subject: tést\n"))
+        self.assertEqual(mailfile.read(), b"\nline 1\nline 2\n")
+
+    def test_get_mail_headers(self):
+        """Check that only headers are returned."""
+        msgrcpt = factories.create_spam("user@test.com")
+        connector = SQLconnector()
+        headers = connector.get_mail_headers(msgrcpt.mail.mail_id)
+        self.assertIn("Subject: Sample message", headers)
+        self.assertNotIn("\n\n", headers)
+        content = connector.get_mail_content(msgrcpt.mail.mail_id)
+        self.assertTrue(content.startswith(headers))
+        self.assertGreater(len(content), len(headers) + 2)
+
+
+@override_settings(AMAVIS_QUARANTINE_SUMMARY=True)
+class SummarySQLconnectorTestCase(SQLconnectorTestCase):
+    """Same tests, using the summary table."""
+
+    def setUp(self):
+        """Fill the summary table."""
+        super(SummarySQLconnectorTestCase, self).setUp()
+        summary.sync()
+
+    def test_sync(self):
+        """Check incremental synchronization."""
+        self.assertEqual(models.QuarantineSummary.objects.count(), 6)
+        self.assertEqual(summary.sync(), (0, 0))
+
+        msgrcpt = factories.create_spam("user@test.com")
+        msgrcpt.mail.time_num -= 3600
+        msgrcpt.mail.subject = "t\xc3\xa9st"
+        msgrcpt.mail.save(update_fields=["time_num", "subject"])
+        # Too old for the overlap window
+        self.assertEqual(summary.sync(), (0, 0))
+        self.assertEqual(summary.sync(batch_size=2, full=True), (7, 0))
+
+        models.Msgrcpt.objects.filter(mail=msgrcpt.mail).update(rs="p")
+        factories.create_virus("user@test.com")
+        self.assertEqual(summary.sync(batch_size=2), (1, 0))
+        with self.settings(AMAVIS_QUARANTINE_SUMMARY_OVERLAP=7200):
+            self.assertEqual(summary.sync(), (0, 1))
+        row = models.QuarantineSummary.objects.get(
+            mail_id=smart_text(msgrcpt.mail.mail_id))
+        self.assertEqual(row.rs, "p")
+        self.assertEqual(row.email, "user@test.com")
+        self.assertEqual(row.subject, "tést")
+
+    def test_status_update(self):
+        """Check that status changes are applied to the summary."""
+        connector = SQLconnector(user=self.admin, navparams={})
+        self.assertEqual(connector.messages_count(), 6)
+        row = connector.fetch(1, 1)[0]
+        connector.set_msgrcpt_status(
+            smart_text(row["to"]), row["mailid"], "D")
+        connector = SQLconnector(user=self.admin, navparams={})
+        self.assertEqual(connector.messages_count(), 5)
@@ -6,7 +6,7 @@ from __future__ import unicode_literals
 
 import os
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils.encoding import smart_bytes, smart_text
 
 from ..sql_email import SQLemail
@@ -26,6 +26,46 @@ class EmailTestImplementation(SQLemail):
 
         return mail_text
 
+    def _fetch_chunks(self):
+        mail_text = self._fetch_message()
+        return [mail_text[pos:pos + 1000]
+                for pos in range(0, len(mail_text), 1000)]
+
+    def _fetch_headers(self):
+        mail_text = self._fetch_message()
+        return mail_text[:mail_text.index(b"\n\n")]
+
+
+class RawEmail(EmailTestImplementation):
+
+    def _fetch_message(self):
+        return MULTIPART_MESSAGE
+
+
+MULTIPART_MESSAGE = b"""Subject: Multipart
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="mixed"
+
+--mixed
+Content-Type: multipart/alternative; boundary="alt"
+
+--alt
+Content-Type: text/plain; charset=utf-8
+
+Plain version
+--alt
+Content-Type: text/html; charset=utf-8
+
+<p>HTML version</p>
+--alt--
+--mixed
+Content-Type: text/plain; charset=utf-8
+Content-Disposition: attachment; filename="notes.txt"
+
+Attached notes
+--mixed--
+"""
+
 
 class EmailTests(TestCase):
     """Tests for modoboa_amavis.sql_email.SQLEmail
@@ -63,7 +103,48 @@ class EmailTests(TestCase):
                          "Non-encoded non-ASCII data (and not UTF-8) (char 85 "
                          "hex): Subject: I think I saw you in my dreams\\x{85}")
 
+    def test_headers_only(self):
+        """Check that headers are parsed without loading the message."""
+        email = EmailTestImplementation("quarantined")
+        self.assertEqual(email.headers[0]["name"], "From")
+        self.assertIsNone(email._msg)
+        self.assertEqual(
+            email.header_msg.get_payload(), "")
+
     def test_email_multipart_with_no_text(self):
         """for a multipart message without a text/plain part convert the
            text/html to text/plain"""
         self._test_email("quarantined")
+
+    def test_preview_parts(self):
+        """Check that only the displayed part is decoded."""
+        email = RawEmail("multipart")
+        self.assertIn("Plain version", email.body)
+        self.assertEqual(email.contents["html"], "")
+        self.assertNotIn("Attached notes", email.body)
+
+        email = RawEmail("multipart", dformat="html")
+        self.assertIn("HTML version", email.body)
+        self.assertEqual(email.contents["plain"], "")
+
+        email = RawEmail("multipart", full=True)
+        self.assertIn("Attached notes", email.body)
+
+    @override_settings(AMAVIS_PREVIEW_MAX_SIZE=3000)
+    def test_preview_size_budget(self):
+        """Check that big messages are truncated."""
+        email = EmailTestImplementation("quarantined")
+        self.assertTrue(email.body)
+        self.assertTrue(email.truncated)
+
+        expected_output = self._get_expected_output("quarantined")
+        email = EmailTestImplementation("quarantined", full=True)
+        self.assertEqual(email.body, expected_output)
+        self.assertFalse(email.truncated)
+
+    @override_settings(AMAVIS_PREVIEW_MAX_TIME=-1)
+    def test_preview_time_budget(self):
+        """Check that parsing stops when the time budget is exhausted."""
+        email = EmailTestImplementation("quarantined")
+        email.msg
+        self.assertTrue(email.truncated)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for streaming."""
+
+from __future__ import unicode_literals
+
+import binascii
+import email
+import io
+
+from django.test import SimpleTestCase
+
+from ..streaming import MIMEPartReader, decode_body
+
+ATTACHMENT = b"".join(bytes(bytearray([i % 256])) for i in range(1000))
+
+MESSAGE = b"""Subject: Streaming
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="mixed"
+
+Preamble
+--mixed
+Content-Type: multipart/alternative; boundary="alt"
+
+--alt
+Content-Type: text/plain; charset=utf-8
+Content-Transfer-Encoding: quoted-printable
+
+Caf=C3=A9 au lait, a very long line which is split using a soft line =
+break.
+--alt
+Content-Type: text/html; charset=utf-8
+
+<p>Caf\xc3\xa9</p>
+--alt--
+--mixed
+Content-Type: application/octet-stream
+Content-Transfer-Encoding: base64
+Content-Disposition: attachment; filename="data.bin"
+
+""" + b"".join(
+    binascii.b2a_base64(ATTACHMENT[pos:pos + 57])
+    for pos in range(0, len(ATTACHMENT), 57)
+) + b"""--mixed--
+Epilogue
+"""
+
+
+class MIMEPartReaderTestCase(SimpleTestCase):
+    """Tests for modoboa_amavis.streaming.MIMEPartReader."""
+
+    def _get_part(self, index, message=MESSAGE):
+        reader = MIMEPartReader(io.BufferedReader(io.BytesIO(message), 16))
+        reader.MAX_LINE_LENGTH = 20
+        headers = reader.find(index)
+        if headers is None:
+            return None, None
+        body = b"".join(decode_body(
+            reader.iter_body(), headers["Content-Transfer-Encoding"]))
+        return headers, body
+
+    def test_parts(self):
+        headers, body = self._get_part(2)
+        self.assertEqual(headers.get_content_type(), "text/plain")
+        self.assertEqual(
+            body,
+            "Café au lait, a very long line which is split using a soft "
+            "line break.".encode("utf-8"))
+
+        headers, body = self._get_part(3)
+        self.assertEqual(headers.get_content_type(), "text/html")
+        self.assertEqual(body, "<p>Café</p>".encode("utf-8"))
+
+        headers, body = self._get_part(4)
+        self.assertEqual(headers.get_filename(), "data.bin")
+        self.assertEqual(body, ATTACHMENT)
+
+        self.assertEqual(self._get_part(5), (None, None))
+
+    def test_message(self):
+        headers, body = self._get_part(0)
+        self.assertEqual(headers["Subject"], "Streaming")
+        self.assertTrue(body.startswith(b"Preamble\n--mixed\n"))
+        self.assertTrue(body.endswith(b"Epilogue\n"))
+
+    def test_enclosed_message(self):
+        message = MESSAGE.replace(b"""--mixed--""", b"""--mixed
+Content-Type: message/rfc822
+
+Subject: Forwarded
+Content-Type: multipart/mixed; boundary="fwd"
+
+--fwd
+Content-Type: text/plain
+
+Forwarded text
+--fwd
+Content-Type: text/plain
+
+Forwarded attachment
+--fwd--
+--mixed
+Content-Type: text/plain
+
+Last part
+--mixed--""")
+        parser = getattr(email, "message_from_bytes", email.message_from_string)
+        parts = list(parser(message).walk())
+        self.assertEqual(len(parts), 10)
+        for index, part in enumerate(parts):
+            headers, body = self._get_part(index, message)
+            self.assertEqual(
+                headers.get_content_type(), part.get_content_type())
+            if not part.is_multipart():
+                self.assertEqual(
+                    body, part.get_payload(decode=True).rstrip(b"\n"))
+        self.assertEqual(self._get_part(7, message)[1], b"Forwarded text")
+        self.assertEqual(self._get_part(10, message), (None, None))
+
+    def test_quoted_printable_split(self):
+        lines = [b"caf=C", b"3=A9 au=", b"\r", b"\nlait=", b"3D=", b"\n!\n"]
+        self.assertEqual(
+            b"".join(decode_body(lines, "quoted-printable")),
+            "café aulait=!\n".encode("utf-8"))
+        self.assertEqual(
+            b"".join(decode_body([b"end=3"], "quoted-printable")),
+            binascii.a2b_qp(b"end=3"))
+
+    def test_crlf(self):
+        message = MESSAGE.replace(b"\n", b"\r\n")
+        headers, body = self._get_part(3, message)
+        self.assertEqual(body, "<p>Café</p>".encode("utf-8"))
+        headers, body = self._get_part(4, message)
+        self.assertEqual(body, ATTACHMENT)
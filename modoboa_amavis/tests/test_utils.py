@@ -2,9 +2,28 @@
 
 from __future__ import unicode_literals
 
+import io
+
+import mock
+
 from django.test import SimpleTestCase
 
-from modoboa_amavis.utils import fix_utf8_encoding
+from modoboa_amavis import utils
+from modoboa_amavis.utils import ChunkReader, fix_utf8_encoding
+
+
+class ChunkReaderTests(SimpleTestCase):
+
+    """Tests for modoboa_amavis.utils.ChunkReader."""
+
+    def test_read(self):
+        chunks = [b"Subject: test\n", memoryview(b"\nline 1\nli"), b"",
+                  b"ne 2\n"]
+        reader = io.BufferedReader(ChunkReader(chunks), buffer_size=4)
+        self.assertEqual(reader.readline(), b"Subject: test\n")
+        self.assertEqual(reader.read(3), b"\nli")
+        self.assertEqual(reader.read(), b"ne 1\nline 2\n")
+        self.assertEqual(reader.read(), b"")
 
 
 class FixUTF8EncodingTests(SimpleTestCase):
@@ -22,3 +41,28 @@ class FixUTF8EncodingTests(SimpleTestCase):
         expected_output = "\xf0\x9f\x99"
         output = fix_utf8_encoding(value)
         self.assertEqual(output, expected_output)
+
+    def test_ascii(self):
+        value = "Buy cheap pills"
+        with mock.patch("chardet.detect") as mock_detect:
+            self.assertIs(fix_utf8_encoding(value), value)
+        self.assertFalse(mock_detect.called)
+
+    def test_memo(self):
+        value = "Caf\xe9 gratuit \xa0 {}".format(id(self))
+        with mock.patch("chardet.detect", wraps=utils.chardet.detect) \
+                as mock_detect:
+            output = fix_utf8_encoding(value)
+            self.assertEqual(fix_utf8_encoding(value), output)
+        self.assertEqual(mock_detect.call_count, 1)
+        self.assertIn(value, utils._fix_utf8_encoding_memo)
+
+    def test_chardet_sample(self):
+        value = "\xe9" * (utils.FIX_UTF8_ENCODING_MEMO_MAX_LENGTH + 1)
+        value = value * 10
+        with mock.patch("chardet.detect", wraps=utils.chardet.detect) \
+                as mock_detect:
+            fix_utf8_encoding(value)
+        self.assertEqual(
+            len(mock_detect.call_args[0][0]), utils.CHARDET_SAMPLE_SIZE)
+        self.assertNotIn(value, utils._fix_utf8_encoding_memo)
@@ -5,6 +5,7 @@
 from __future__ import unicode_literals
 
 import os
+import re
 
 import mock
 
@@ -16,8 +17,9 @@ from django.urls import reverse
 from modoboa.admin import factories as admin_factories
 from modoboa.core import models as core_models
 from modoboa.lib.tests import ModoTestCase
-from .. import factories
-from ..utils import smart_text
+from .. import cache, factories, lib, models, views
+from ..utils import smart_bytes, smart_text
+from .spamd import FakeSpamd
 
 
 class TestDataMixin(object):
@@ -34,6 +36,8 @@ class TestDataMixin(object):
 class ViewsTestCase(TestDataMixin, ModoTestCase):
     """Test views."""
 
+    multi_db = True
+
     @classmethod
     def setUpTestData(cls):  # NOQA:N802
         """Create test data."""
@@ -46,6 +50,9 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
         self.msgrcpt.save(update_fields=["rs"])
         self.set_global_parameter("domain_level_learning", False)
         self.set_global_parameter("user_level_learning", False)
+        self.set_global_parameter("sa_is_local", True)
+        lib.PDPClient.clear_pool()
+        cache.clear_rendered_messages()
 
     def test_index(self):
         """Test index view."""
@@ -69,6 +76,59 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
             "<tr id=\"{}\">".format(smart_text(self.msgrcpt.mail.mail_id)),
             response["listing"])
 
+    def test_listing_page(self):
+        """Test listing pages (seek pagination)."""
+        admin = core_models.User.objects.get(username="admin")
+        admin.parameters.set_value(
+            "messages_per_page", 1, app="modoboa_amavis")
+        admin.save()
+        for i in range(5):
+            factories.create_spam("user@test.com")
+        url = reverse("modoboa_amavis:_mail_list")
+        response = self.ajax_get(url)
+        first_page = re.findall(r"<tr id=\"(\w+)\">", response["listing"])
+        self.assertEqual(len(first_page), 1)
+        self.assertIn(">6</span>", response["listing"])
+
+        url = reverse("modoboa_amavis:mail_page")
+        response = self.ajax_get("{}?page=2".format(url))
+        self.assertEqual(response["pages"], [2])
+        second_page = re.findall(r"<tr id=\"(\w+)\">", response["rows"])
+        self.assertEqual(len(second_page), 1)
+        self.assertNotEqual(first_page, second_page)
+        self.assertIn("2", self.client.session[
+            "quarantine_navparams"]["cursors"]["pages"])
+
+        # Cursors are dropped when the page size changes
+        rows = []
+        for page in range(1, 5):
+            response = self.ajax_get("{}?page={}".format(url, page))
+            rows += re.findall(r"<tr id=\"(\w+)\">", response["rows"])
+        self.assertEqual(len(set(rows)), 4)
+        admin.parameters.set_value(
+            "messages_per_page", 2, app="modoboa_amavis")
+        admin.save()
+        response = self.ajax_get("{}?page=2".format(url))
+        self.assertEqual(
+            re.findall(r"<tr id=\"(\w+)\">", response["rows"]), rows[2:4])
+        admin.parameters.set_value(
+            "messages_per_page", 1, app="modoboa_amavis")
+        admin.save()
+        response = self.ajax_get("{}?page=2".format(url))
+
+        self.assertEqual(response["total"], "6")
+        self.assertTrue(response["count_is_exact"])
+
+        # Capped count mode
+        self.set_global_parameter("max_listing_count", 1)
+        response = self.ajax_get("{}?page=2".format(url))
+        self.assertEqual(response["pages"], [2])
+        response = self.ajax_get("{}?page=1".format(url))
+        self.assertEqual(response["total"], "2+")
+        self.assertFalse(response["count_is_exact"])
+        response = self.ajax_get(reverse("modoboa_amavis:_mail_list"))
+        self.assertIn(">2+</span>", response["listing"])
+
     def test_viewmail(self):
         """Test view_mail view."""
         mail_id = smart_text(self.msgrcpt.mail.mail_id)
@@ -112,6 +172,83 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(AMAVIS_PREVIEW_MAX_SIZE=100)
+    def test_getmailcontent_preview(self):
+        """Check that big messages are truncated."""
+        mail_id = smart_text(self.msgrcpt.mail.mail_id)
+        url = reverse("modoboa_amavis:mailcontent_get", args=[mail_id])
+        response = self.client.get(url)
+        self.assertContains(response, "Load the full message")
+        self.assertContains(response, "?full=1")
+        response = self.client.get(url + "?full=1")
+        self.assertNotContains(response, "Load the full message")
+
+    def test_getrawmessage(self):
+        """Test raw message download."""
+        mail_id = smart_text(self.msgrcpt.mail.mail_id)
+        rcpt = smart_text(self.msgrcpt.rid.email)
+        url = reverse("modoboa_amavis:mail_raw", args=[mail_id])
+        response = self.client.get("{}?rcpt={}".format(url, rcpt))
+        self.assertEqual(response["Content-Type"], "message/rfc822")
+        content = b"".join(response.streaming_content)
+        self.assertEqual(
+            content,
+            smart_bytes(self.msgrcpt.mail.quarantine_set.first().mail_text))
+
+        response = self.client.get("{}?rcpt=unknown@test.com".format(url))
+        self.assertEqual(response.status_code, 404)
+
+        # Simple users can only download their own messages
+        user = core_models.User.objects.get(username="user@test.com")
+        self.client.force_login(user)
+        response = self.client.get("{}?rcpt=admin@test.com".format(url))
+        self.assertEqual(response.status_code, 403)
+
+        # Self-service mode
+        self.client.logout()
+        self.set_global_parameter("self_service", True)
+        secret_id = smart_text(self.msgrcpt.mail.secret_id)
+        response = self.client.get(
+            "{}?rcpt={}&secret_id={}".format(url, rcpt, secret_id))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(
+            "{}?rcpt={}&secret_id=bad".format(url, rcpt))
+        self.assertContains(response, "Invalid request")
+
+    def test_getmessagepart(self):
+        """Test message part download."""
+        msgrcpt = factories.create_spam("user@test.com")
+        models.Quarantine.objects.filter(mail=msgrcpt.mail).delete()
+        factories.QuarantineFactory(
+            mail=msgrcpt.mail, mail_text=smart_bytes(factories.VIRUS_BODY))
+        mail_id = smart_text(msgrcpt.mail.mail_id)
+        url = reverse("modoboa_amavis:mail_part", args=[mail_id, 2])
+        response = self.client.get("{}?rcpt=user@test.com".format(url))
+        self.assertEqual(
+            response["Content-Type"], "application/x-msdos-program")
+        self.assertIn("eicar.com", response["Content-Disposition"])
+        self.assertIn(
+            b"EICAR-STANDARD-ANTIVIRUS-TEST-FILE",
+            b"".join(response.streaming_content))
+
+        url = reverse("modoboa_amavis:mail_part", args=[mail_id, 10])
+        response = self.client.get("{}?rcpt=user@test.com".format(url))
+        self.assertEqual(response.status_code, 404)
+
+        # Filenames are sanitized or encoded
+        models.Quarantine.objects.filter(mail=msgrcpt.mail).update(
+            mail_text=smart_bytes(factories.VIRUS_BODY.replace(
+                "filename=\"eicar.com\"",
+                "filename*=utf-8''caf%C3%A9%0D.com")))
+        url = reverse("modoboa_amavis:mail_part", args=[mail_id, 2])
+        response = self.client.get("{}?rcpt=user@test.com".format(url))
+        self.assertEqual(
+            response["Content-Disposition"],
+            "attachment; filename*=utf-8''caf%C3%A9%0D.com")
+        self.assertEqual(
+            views.get_content_disposition("evil\r\nname\".txt"),
+            "attachment; filename=\"evilname.txt\"")
+
     def test_viewheaders(self):
         """Test headers display."""
         mail_id = smart_text(self.msgrcpt.mail.mail_id)
@@ -119,6 +256,33 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
         response = self.client.get(url)
         self.assertContains(response, b"X-Spam-Flag: YES")
 
+    def test_rendered_message_cache(self):
+        """Check that rendered messages are cached."""
+        msgrcpt = factories.create_spam("user@test.com")
+        models.Quarantine.objects.filter(mail=msgrcpt.mail).delete()
+        factories.QuarantineFactory(
+            mail=msgrcpt.mail,
+            mail_text=b"Subject: Cached message\n\nCached body\n")
+        mail_id = smart_text(msgrcpt.mail.mail_id)
+        url = reverse("modoboa_amavis:mailcontent_get", args=[mail_id])
+        stats = cache.get_rendered_messages_stats()
+        response = self.client.get(url)
+        self.assertContains(response, "Cached body")
+        with mock.patch("modoboa_amavis.views.SQLemail") as mock_email:
+            cached_response = self.client.get(url)
+        self.assertFalse(mock_email.called)
+        self.assertEqual(cached_response.content, response.content)
+        new_stats = cache.get_rendered_messages_stats()
+        self.assertEqual(new_stats["misses"], stats["misses"] + 1)
+        self.assertEqual(new_stats["hits"], stats["hits"] + 1)
+        self.assertEqual(new_stats["entries"], 1)
+
+        # Deletion invalidates entries
+        self.ajax_get(reverse("modoboa_amavis:_mail_list"))
+        url = reverse("modoboa_amavis:mail_delete", args=[mail_id])
+        self.ajax_post(url, {"rcpt": smart_text(msgrcpt.rid.email)})
+        self.assertEqual(cache.get_rendered_messages_stats()["entries"], 0)
+
     def test_delete_msg(self):
         """Test delete view."""
 
@@ -157,7 +321,8 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
         url = reverse("modoboa_amavis:_mail_list")
         response = self.ajax_get(url)
 
-        mock_socket.return_value.recv.return_value = b"250 1234 Ok\r\n"
+        mock_socket.return_value.recv.return_value = (
+            b"setreply=250 1234 Ok\r\n\r\n")
         mail_id = smart_text(self.msgrcpt.mail.mail_id)
         url = reverse("modoboa_amavis:mail_release", args=[mail_id])
         data = {"rcpt": smart_text(self.msgrcpt.rid.email)}
@@ -170,7 +335,8 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
     @mock.patch("socket.socket")
     def test_release_selfservice(self, mock_socket):
         """Test release view."""
-        mock_socket.return_value.recv.return_value = b"250 1234 Ok\r\n"
+        mock_socket.return_value.recv.return_value = (
+            b"setreply=250 1234 Ok\r\n\r\n")
         self.client.logout()
         mail_id = smart_text(self.msgrcpt.mail.mail_id)
         base_url = reverse("modoboa_amavis:mail_release", args=[mail_id])
@@ -233,12 +399,18 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
 
         self.msgrcpt.rs = " "
         self.msgrcpt.save(update_fields=["rs"])
+        spamd = FakeSpamd()
+        spamd.start()
+        self.addCleanup(spamd.stop)
         self.set_global_parameter("sa_is_local", False)
+        self.set_global_parameter("spamd_port", spamd.server_address[1])
         response = self.ajax_post(url, data)
         self.assertEqual(
             response["message"], "1 message processed successfully")
         self.msgrcpt.refresh_from_db()
         self.assertEqual(self.msgrcpt.rs, status)
+        self.assertEqual(len(spamd.learnt), 1)
+        self.assertEqual(spamd.learnt[0][1], smart_bytes(action))
 
     def test_mark_as_ham(self):
         """Test mark_as_ham view."""
@@ -307,7 +479,8 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
                 smart_text(msgrcpt.mail.mail_id)),
         ]
         mock_socket.return_value.recv.side_effect = (
-            b"250 1234 Ok\r\n", b"250 1234 Ok\r\n")
+            b"setreply=250 1234 Ok\r\n\r\n",
+            b"setreply=250 1234 Ok\r\n\r\n")
         data = {
             "action": "release",
             "rcpt": smart_text(self.msgrcpt.rid.email),
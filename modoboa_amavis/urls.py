@@ -27,4 +27,8 @@ urlpatterns = [
     url(r'^(?P<mail_id>[\w\-\+]+)/$', views.viewmail, name="mail_detail"),
     url(r'^(?P<mail_id>[\w\-\+]+)/headers/$', views.viewheaders,
         name="headers_detail"),
+    url(r'^(?P<mail_id>[\w\-\+]+)/raw/$', views.getrawmessage,
+        name="mail_raw"),
+    url(r'^(?P<mail_id>[\w\-\+]+)/parts/(?P<index>\d+)/$',
+        views.getmessagepart, name="mail_part"),
 ]
@@ -4,6 +4,11 @@
 
 from __future__ import unicode_literals
 
+import collections
+import io
+import re
+import threading
+
 import chardet
 
 from django.conf import settings
@@ -48,6 +53,32 @@ def smart_text(value, *args, **kwargs):
     return django_smart_text(value, *args, **kwargs)
 
 
+# Only short values (subjects, addresses) are memoized
+FIX_UTF8_ENCODING_MEMO_SIZE = 1024
+FIX_UTF8_ENCODING_MEMO_MAX_LENGTH = 1024
+# Number of bytes given to chardet to guess an encoding
+CHARDET_SAMPLE_SIZE = 4096
+
+_RE_NON_ASCII = re.compile(r"[^\x00-\x7f]")
+_fix_utf8_encoding_memo = collections.OrderedDict()
+_fix_utf8_encoding_memo_lock = threading.Lock()
+
+
+def _fix_utf8_encoding(value):
+    bytes_value = value.encode("raw_unicode_escape")
+    try:
+        value = bytes_value.decode("utf-8")
+    except UnicodeDecodeError:
+        encoding = chardet.detect(bytes_value[:CHARDET_SAMPLE_SIZE])
+        try:
+            value = bytes_value.decode(encoding["encoding"], "replace")
+        except (TypeError, UnicodeDecodeError, LookupError):
+            # ??? use the original value, we've done our best to try and
+            # convert it to a clean utf-8 string.
+            pass
+    return value
+
+
 def fix_utf8_encoding(value):
     """Fix utf-8 strings that contain utf-8 escaped characters.
 
@@ -58,27 +89,31 @@ def fix_utf8_encoding(value):
     Didn't even know the raw_unicode_escape encoding existed :)
     https://docs.python.org/2/library/codecs.html?highlight=raw_unicode_escape#python-specific-encodings
     https://docs.python.org/3/library/codecs.html?highlight=raw_unicode_escape#python-specific-encodings
+
+    ASCII values are returned as is and results for short values are
+    kept in a bounded LRU memo (spam campaigns tend to repeat subjects).
     """
     assert isinstance(value, six.text_type), \
         ("value should be of type %s" % six.text_type.__name__)
 
-    if len(value) == 0:
-        # short circuit for empty strings
-        return ""
+    if not _RE_NON_ASCII.search(value):
+        # short circuit for ASCII (and empty) strings
+        return value
 
-    bytes_value = value.encode("raw_unicode_escape")
-    try:
-        value = bytes_value.decode("utf-8")
-    except UnicodeDecodeError:
-        encoding = chardet.detect(bytes_value)
-        try:
-            value = bytes_value.decode(encoding["encoding"], "replace")
-        except (TypeError, UnicodeDecodeError):
-            # ??? use the original value, we've done our best to try and
-            # convert it to a clean utf-8 string.
-            pass
+    if len(value) > FIX_UTF8_ENCODING_MEMO_MAX_LENGTH:
+        return _fix_utf8_encoding(value)
 
-    return value
+    with _fix_utf8_encoding_memo_lock:
+        result = _fix_utf8_encoding_memo.pop(value, None)
+        if result is not None:
+            _fix_utf8_encoding_memo[value] = result
+            return result
+    result = _fix_utf8_encoding(value)
+    with _fix_utf8_encoding_memo_lock:
+        _fix_utf8_encoding_memo[value] = result
+        while len(_fix_utf8_encoding_memo) > FIX_UTF8_ENCODING_MEMO_SIZE:
+            _fix_utf8_encoding_memo.popitem(last=False)
+    return result
 
 
 class ConvertFrom(Func):
@@ -113,3 +148,30 @@ class ConvertFrom(Func):
             template="%(expressions)s",
             arity=1,
         )
+
+
+class ChunkReader(io.RawIOBase):
+    """A read-only file-like object over an iterable of chunks.
+
+    Chunks (bytes or memoryview) are consumed lazily and never
+    concatenated: data is only copied into the buffer given by the
+    reader. Wrap it with io.BufferedReader to get readline() support.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._current = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self._current):
+            try:
+                self._current = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._current))
+        b[:size] = self._current[:size]
+        self._current = self._current[size:]
+        return size
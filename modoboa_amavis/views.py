@@ -6,13 +6,19 @@ Amavis quarantine views.
 
 from __future__ import unicode_literals
 
+import re
+
 import six
 
 from django.contrib.auth.decorators import login_required
-from django.http import Http404, HttpResponseRedirect
+from django.core.exceptions import PermissionDenied
+from django.http import (
+    Http404, HttpResponseRedirect, StreamingHttpResponse
+)
 from django.shortcuts import render
 from django.template import loader
 from django.urls import reverse
+from django.utils.six.moves.urllib.parse import quote
 from django.utils.translation import ugettext as _, ungettext
 
 from modoboa.admin.models import Domain, Mailbox
@@ -20,17 +26,18 @@ from modoboa.lib.exceptions import BadRequest
 from modoboa.lib.paginator import Paginator
 from modoboa.lib.web_utils import getctx, render_to_json_response
 from modoboa.parameters import tools as param_tools
-from . import constants
+from . import cache, constants
 from .forms import LearningRecipientForm
 from .lib import (
-    AMrelease, QuarantineNavigationParameters, SpamassassinClient,
-    manual_learning_enabled, selfservice
+    PDPClient, QuarantineNavigationParameters, ReleaseEngine,
+    SpamassassinClient, manual_learning_enabled, selfservice
 )
 from .models import Msgrcpt
 from .sql_connector import SQLconnector
 from .sql_email import SQLemail
+from .streaming import MIMEPartReader, decode_body
 from .templatetags.amavis_tags import quar_menu, viewm_menu
-from .utils import smart_text
+from .utils import smart_bytes, smart_text
 
 
 def empty_quarantine():
@@ -46,21 +53,38 @@ def empty_quarantine():
 
 def get_listing_pages(request, connector):
     """Return listing pages."""
-    paginator = Paginator(
-        connector.messages_count(),
-        request.user.parameters.get_value("messages_per_page")
-    )
+    messages_per_page = request.user.parameters.get_value("messages_per_page")
     page_id = int(connector.navparams.get("page"))
+    count_limit = param_tools.get_global_parameter("max_listing_count")
+    if count_limit:
+        # Always count past the requested page so we know if another
+        # one follows.
+        count_limit = max(count_limit, page_id * messages_per_page + 1)
+    paginator = Paginator(
+        connector.messages_count(count_limit), messages_per_page)
     page = paginator.getpage(page_id)
     if not page:
         return None
     pages = [page]
     if not page.has_next and page.has_previous and page.items < 40:
         pages = [paginator.getpage(page_id - 1)] + pages
+    navparams = connector.navparams
     email_list = []
     for page in pages:
-        email_list += connector.fetch(page.id_start, page.id_stop)
-    return {"pages": [page.number for page in pages], "rows": email_list}
+        cursor = (
+            navparams.get_cursor(page.number - 1) if page.number > 1
+            else None
+        )
+        email_list += connector.fetch(page.id_start, page.id_stop, cursor)
+        navparams.set_cursor(page.number, connector.last_cursor)
+    total = "{}".format(paginator.total)
+    if not connector.count_is_exact:
+        # Counting stopped at max_listing_count
+        total += "+"
+    return {
+        "pages": [page.number for page in pages], "rows": email_list,
+        "total": total, "count_is_exact": connector.count_is_exact
+    }
 
 
 @login_required
@@ -104,7 +128,9 @@ def _listing(request):
     context["listing"] = loader.render_to_string(
         "modoboa_amavis/email_list.html", {
             "email_list": context["rows"],
-            "message_types": constants.MESSAGE_TYPES
+            "message_types": constants.MESSAGE_TYPES,
+            "total": context["total"],
+            "count_is_exact": context["count_is_exact"]
         }, request
     )
     del context["rows"]
@@ -130,21 +156,49 @@ def index(request):
     return render(request, "modoboa_amavis/index.html", context)
 
 
-def getmailcontent_selfservice(request, mail_id):
-    mail = SQLemail(mail_id, dformat="plain")
+def get_rendered_mail_content(mail_id, full=False):
+    """Return the rendered headers and body of a message.
+
+    Results are cached.
+    """
+    dformat = "plain_full" if full else "plain"
+    content = cache.get_rendered_message(mail_id, dformat)
+    if content is None:
+        mail = SQLemail(mail_id, dformat="plain", full=full)
+        content = {
+            "headers": mail.render_headers(),
+            "mailbody": mail.body,
+            "truncated": mail.truncated
+        }
+        cache.set_rendered_message(mail_id, dformat, content)
+    return content
+
+
+def render_mail_content(request, mail_id):
+    """Render a message, or a preview if it is too big."""
+    content = get_rendered_mail_content(
+        mail_id, full=request.GET.get("full") == "1")
+    mailbody = content["mailbody"]
+    if content["truncated"]:
+        params = request.GET.copy()
+        params["full"] = "1"
+        mailbody = loader.render_to_string(
+            "modoboa_amavis/_truncated_notice.html",
+            {"url": "?{}".format(params.urlencode())}
+        ) + mailbody
     return render(request, "common/viewmail.html", {
-        "headers": mail.render_headers(),
-        "mailbody": mail.body
+        "headers": content["headers"],
+        "mailbody": mailbody
     })
 
 
+def getmailcontent_selfservice(request, mail_id):
+    return render_mail_content(request, mail_id)
+
+
 @selfservice(getmailcontent_selfservice)
 def getmailcontent(request, mail_id):
-    mail = SQLemail(mail_id, dformat="plain")
-    return render(request, "common/viewmail.html", {
-        "headers": mail.render_headers(),
-        "mailbody": mail.body
-    })
+    return render_mail_content(request, mail_id)
 
 
 def viewmail_selfservice(request, mail_id,
@@ -183,16 +237,109 @@ def viewmail(request, mail_id):
 @login_required
 def viewheaders(request, mail_id):
     """Display message headers."""
-    email = SQLemail(mail_id)
-    headers = []
-    for name in email.msg.keys():
-        headers.append((name, email.get_header(email.msg, name)))
+    headers = cache.get_rendered_message(mail_id, "headers")
+    if headers is None:
+        email = SQLemail(mail_id)
+        headers = []
+        for name in email.header_msg.keys():
+            headers.append((name, email.get_header(email.header_msg, name)))
+        cache.set_rendered_message(mail_id, "headers", headers)
     context = {
         "headers": headers
     }
     return render(request, "modoboa_amavis/viewheader.html", context)
 
 
+def get_accessible_message(request, mail_id, selfservice=False):
+    """Return a message recipient the current user can access.
+
+    The recipient is given by the *rcpt* parameter. In self-service
+    mode, *secret_id* must match the message.
+    """
+    rcpt = request.GET.get("rcpt", None)
+    if rcpt is None:
+        raise BadRequest(_("Invalid request"))
+    if not selfservice:
+        valid_addresses = get_user_valid_addresses(request.user)
+        if valid_addresses and rcpt not in valid_addresses:
+            raise PermissionDenied
+    try:
+        msgrcpt = SQLconnector().get_recipient_message(rcpt, mail_id)
+    except Msgrcpt.DoesNotExist:
+        raise Http404
+    if selfservice and \
+       request.GET.get("secret_id") != smart_text(msgrcpt.mail.secret_id):
+        raise BadRequest(_("Invalid request"))
+    return msgrcpt
+
+
+def get_content_disposition(filename):
+    """Return a Content-Disposition header value for an attachment.
+
+    Filenames come from quarantined messages: non-ASCII ones are
+    encoded following RFC 2231, control characters (which are not
+    allowed in a header) are removed from others.
+    """
+    filename = smart_text(filename)
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        return "attachment; filename*=utf-8''{}".format(
+            quote(filename.encode("utf-8"), safe=""))
+    return "attachment; filename=\"{}\"".format(
+        re.sub(r"[\x00-\x1f\x7f\"\\]", "", filename))
+
+
+def stream_raw_message(mail_id):
+    """Return a response streaming a message as stored by amavis."""
+    chunks = SQLconnector().iter_mail_chunks(mail_id)
+    response = StreamingHttpResponse(
+        (smart_bytes(chunk) for chunk in chunks),
+        content_type="message/rfc822")
+    response["Content-Disposition"] = (
+        "attachment; filename=\"{}.eml\"".format(mail_id))
+    return response
+
+
+def stream_message_part(mail_id, index):
+    """Return a response streaming a single (decoded) MIME part."""
+    reader = MIMEPartReader(SQLconnector().get_mail_file(mail_id))
+    headers = reader.find(int(index))
+    if headers is None:
+        raise Http404
+    response = StreamingHttpResponse(
+        decode_body(reader.iter_body(),
+                    headers.get("Content-Transfer-Encoding")),
+        content_type=headers.get_content_type())
+    response["Content-Disposition"] = get_content_disposition(
+        headers.get_filename() or "part_{}".format(index))
+    return response
+
+
+def getrawmessage_selfservice(request, mail_id):
+    get_accessible_message(request, mail_id, selfservice=True)
+    return stream_raw_message(mail_id)
+
+
+@selfservice(getrawmessage_selfservice)
+def getrawmessage(request, mail_id):
+    """Download a message."""
+    get_accessible_message(request, mail_id)
+    return stream_raw_message(mail_id)
+
+
+def getmessagepart_selfservice(request, mail_id, index):
+    get_accessible_message(request, mail_id, selfservice=True)
+    return stream_message_part(mail_id, index)
+
+
+@selfservice(getmessagepart_selfservice)
+def getmessagepart(request, mail_id, index):
+    """Download a single part of a message."""
+    get_accessible_message(request, mail_id)
+    return stream_message_part(mail_id, index)
+
+
 def check_mail_id(request, mail_id):
     if isinstance(mail_id, six.string_types):
         if "rcpt" in request.POST:
@@ -224,6 +371,7 @@ def delete_selfservice(request, mail_id):
         SQLconnector().set_msgrcpt_status(rcpt, mail_id, "D")
     except Msgrcpt.DoesNotExist:
         raise BadRequest(_("Invalid request"))
+    cache.invalidate_rendered_messages([mail_id])
     return render_to_json_response(_("Message deleted"))
 
 
@@ -234,13 +382,15 @@ def delete(request, mail_id):
     :param str mail_id: message unique identifier
     """
     mail_id = check_mail_id(request, mail_id)
-    connector = SQLconnector()
     valid_addresses = get_user_valid_addresses(request.user)
+    items = []
     for mid in mail_id:
         r, i = mid.split()
         if valid_addresses and r not in valid_addresses:
             continue
-        connector.set_msgrcpt_status(r, i, "D")
+        items.append((r, i, "D"))
+    SQLconnector().set_msgrcpts_status(items)
+    cache.invalidate_rendered_messages([item[1] for item in items])
     message = ungettext("%(count)d message deleted successfully",
                         "%(count)d messages deleted successfully",
                         len(mail_id)) % {"count": len(mail_id)}
@@ -267,8 +417,9 @@ def release_selfservice(request, mail_id):
         connector.set_msgrcpt_status(rcpt, mail_id, "p")
         msg = _("Request sent")
     else:
-        amr = AMrelease()
-        result = amr.sendreq(mail_id, secret_id, rcpt)
+        client = PDPClient()
+        result = client.release(mail_id, secret_id, [rcpt])
+        client.close()
         if result:
             connector.set_msgrcpt_status(rcpt, mail_id, "R")
             msg = _("Message released")
@@ -294,10 +445,10 @@ def release(request, mail_id):
         msgrcpts += [connector.get_recipient_message(r, i)]
     if request.user.role == "SimpleUsers" and \
        not param_tools.get_global_parameter("user_can_release"):
-        for msgrcpt in msgrcpts:
-            connector.set_msgrcpt_status(
-                smart_text(msgrcpt.rid.email), msgrcpt.mail.mail_id, "p"
-            )
+        connector.set_msgrcpts_status([
+            (smart_text(msgrcpt.rid.email), msgrcpt.mail.mail_id, "p")
+            for msgrcpt in msgrcpts
+        ])
         message = ungettext("%(count)d request sent",
                             "%(count)d requests sent",
                             len(mail_id)) % {"count": len(mail_id)}
@@ -306,25 +457,21 @@ def release(request, mail_id):
             "url": QuarantineNavigationParameters(request).back_to_listing()
         })
 
-    amr = AMrelease()
-    error = None
-    for rcpt in msgrcpts:
-        result = amr.sendreq(
-            rcpt.mail.mail_id, rcpt.mail.secret_id, rcpt.rid.email
-        )
-        if result:
-            connector.set_msgrcpt_status(
-                smart_text(rcpt.rid.email), rcpt.mail.mail_id, "R")
-        else:
-            error = result
-            break
+    results = ReleaseEngine().release([
+        (rcpt.mail.mail_id, rcpt.mail.secret_id, smart_text(rcpt.rid.email))
+        for rcpt in msgrcpts
+    ], connector)
+    failures = len([result for result in results.values() if not result])
 
+    error = failures > 0
     if not error:
         message = ungettext("%(count)d message released successfully",
                             "%(count)d messages released successfully",
                             len(mail_id)) % {"count": len(mail_id)}
     else:
-        message = error
+        message = ungettext("%(count)d message could not be released",
+                            "%(count)d messages could not be released",
+                            failures) % {"count": failures}
     status = 400 if error else 200
     return render_to_json_response({
         "message": message,
@@ -347,14 +494,15 @@ def mark_messages(request, selection, mtype, recipient_db=None):
     selection = check_mail_id(request, selection)
     connector = SQLconnector()
     saclient = SpamassassinClient(request.user, recipient_db)
-    for item in selection:
-        rcpt, mail_id = item.split()
-        content = connector.get_mail_content(mail_id)
-        result = saclient.learn_spam(rcpt, content) if mtype == "spam" \
-            else saclient.learn_ham(rcpt, content)
-        if not result:
-            break
-        connector.set_msgrcpt_status(rcpt, mail_id, mtype[0].upper())
+    selection = [item.split() for item in selection]
+    results = saclient.learn([
+        (rcpt, connector.iter_mail_chunks(mail_id))
+        for rcpt, mail_id in selection
+    ], mtype)
+    connector.set_msgrcpts_status([
+        (rcpt, mail_id, mtype[0].upper())
+        for (rcpt, mail_id), result in zip(selection, results) if result
+    ])
     if saclient.error is None:
         saclient.done()
         message = ungettext("%(count)d message processed successfully",